@@ -10,6 +10,34 @@ var infowindow;
 var focusZoom = 17;
 var locationMarker;
 var allResourceBounds;
+// Associations of resources by id, filled by fetchAssociations
+var associationsCache = {};
+// Number of listed resources whose associations are fetched up front
+var ASSOCIATIONS_PREFETCH_COUNT = 50;
+
+// Fetch the associations of the resources with the given ids that are not
+// cached yet, in one request, then call callback (if any).
+function fetchAssociations(ids, callback) {
+  var uncached = ids.filter(function(id) {
+    return !(id in associationsCache);
+  });
+  if (uncached.length === 0) {
+    if (callback) {
+      callback();
+    }
+    return;
+  }
+  $.get('/get-associations', { ids: uncached.join(',') })
+    .done(function(associationsString) {
+      var associations = JSON.parse(associationsString);
+      for (var id in associations) {
+        associationsCache[id] = associations[id];
+      }
+      if (callback) {
+        callback();
+      }
+    });
+}
 
 // Click listener for a marker.
 function markerListener(marker, event) {
@@ -40,6 +68,9 @@ function markerListener(marker, event) {
     map.setZoom(17);
   }
 
+  // Fetch associations now so "more information" can be shown right away
+  fetchAssociations([marker.resourceID]);
+
   // Show marker info bubble
   var markerInfoWindowTemplate = $("#marker-info-window-template").html();
   var compiledMarkerInfoWindowTemplate =
@@ -97,14 +128,14 @@ function displayPhoneNumbers(descriptors) {
 // on a marker
 function displayDetailedResourceView(marker) {
   // get descriptor information as associations
-  $.get('get-associations/' + marker.resourceID).done(function(associations) {
+  fetchAssociations([marker.resourceID], function() {
 
     $("#map").hide();
     $('#map-footer').hide();
     $("#resource-info").empty();
     $("#resource-info").show();
 
-    var associationObject = JSON.parse(associations);
+    var associationObject = associationsCache[marker.resourceID];
     var descriptors = [];
     for (var key in associationObject) {
       var value = associationObject[key];
@@ -493,6 +524,11 @@ function populateListDiv() {
   var listView = compiledListTemplate(context);
   $("#list").html(listView);
 
+  fetchAssociations(markersToShow.slice(0, ASSOCIATIONS_PREFETCH_COUNT)
+    .map(function(markerToShow) {
+      return markerToShow.resourceID;
+    }));
+
   // Can only add handlers to elements in template after compilation
   $(".list-resource").each(function(i, element) {
     element.addEventListener('click', function() {
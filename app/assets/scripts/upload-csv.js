@@ -1,3 +1,6 @@
+// Number of CSV rows sent to the server in each request
+var ROWS_PER_REQUEST = 100;
+
 // Helper to initialize CSV Upload components in templates/bulk_resource/upload.html
 function initializeUpload() {
   $('.ui.radio.checkbox').checkbox();
@@ -136,35 +139,49 @@ function submitCsvData(numRows, rowObjects, fields) {
   var ajaxReqs = [];
   var resetOrUpdate = document.getElementById('reset').checked
     ? 'reset' : 'update';
+  // Identifies the file so that the server can resume an interrupted upload
+  // of it
+  var file = $('#csv-file')[0].files[0];
+  var fileKey = file ? [file.name, file.size, file.lastModified].join(':')
+    : null;
   if (resetOrUpdate === 'reset') {
     ajaxReqs.push({
       action: 'fields-reset',
       fields: fields,
+      fileKey: fileKey,
     });
   } else {
     ajaxReqs.push({
       action: 'fields-update',
       fields: fields,
+      fileKey: fileKey,
     });
   }
 
+  // Rows are sent in batches, each stored by the server with one commit
   if (rowObjects.length > 0) {
     var action = resetOrUpdate === 'reset' ? 'reset-update' : 'update';
-    rowObjects.forEach(function(obj) {
+    for (var i = 0; i < rowObjects.length; i += ROWS_PER_REQUEST) {
       ajaxReqs.push({
         action: action,
-        row: obj,
+        rows: rowObjects.slice(i, i + ROWS_PER_REQUEST),
+        firstRow: i,
       });
-    });
+    }
   }
 
   // Finished action to move onto next step
+  // Rows that failed are not stored, so the server checks that all the
+  // rows of the file are before moving on
   ajaxReqs.push({
     action: 'finished',
+    numRows: rowObjects.length,
   });
 
 
   var moveToNextStep = true;
+  // Rows already stored by an interrupted upload of the same file
+  var resumeFrom = 0;
 
   // DeferredAjax object definition
   // Each Ajax request will be executed as a DeferredAjax object to enforce
@@ -174,18 +191,26 @@ function submitCsvData(numRows, rowObjects, fields) {
     this.options = opts;
     this.deferred = $.Deferred();
     this.action = opts.action;
-    this.row = opts.row;
+    this.rows = opts.rows;
+    this.firstRow = opts.firstRow;
     this.fields = opts.fields;
-    this.count = opts.count;
+    this.fileKey = opts.fileKey;
+    this.numRows = opts.numRows;
   }
 
   DeferredAjax.prototype.invoke = function() {
     var self = this;
+    if (self.rows && self.firstRow + self.rows.length <= resumeFrom) {
+      self.deferred.resolve();
+      return;
+    }
     var data = {
       action: self.action,
-      row: self.row,
+      rows: self.rows,
+      firstRow: self.firstRow,
       fields: self.fields,
-      count: self.count,
+      fileKey: self.fileKey,
+      numRows: self.numRows,
     };
     return $.ajax({
       type: "POST",
@@ -196,14 +221,31 @@ function submitCsvData(numRows, rowObjects, fields) {
         if (res.redirect) {
             window.location.href = res.redirect;
         }
+        if (res.resumeFrom) {
+          resumeFrom = res.resumeFrom;
+          $("#status-success").append(
+            "<div class='item'>Resuming the upload after row " +
+            resumeFrom + "</div>"
+          );
+        }
         if (res.status === 'Success') {
           $("#status-success").append(
             "<div class='item'>" + res.message + "</div>"
           );
         } else if (res.status === 'Error') {
-          $("#status-errors").append(
-            "<div class='item'>" + res.message + "</div>"
-          );
+          if (res.errors) {
+            // Per-row errors, numbered like the rows of the CSV file
+            res.errors.forEach(function(error) {
+              $("#status-errors").append(
+                "<div class='item'>Row " + (self.firstRow + error.row + 2) +
+                ": " + error.message + "</div>"
+              );
+            });
+          } else {
+            $("#status-errors").append(
+              "<div class='item'>" + res.message + "</div>"
+            );
+          }
           moveToNextStep = false;
         }
         self.deferred.resolve();
@@ -227,16 +269,18 @@ function submitCsvData(numRows, rowObjects, fields) {
   $('#upload-progress').progress('set total', numReqs);
 
   // Execute each Ajax request sequentially, waiting for the previous to
-  // finish before executing the next so we can process each row one by one.
-  // If one of the rows fails, we abort the entire operation
+  // finish before executing the next so we can process each batch of rows
+  // in order. If one of the rows fails, we abort the entire operation
   prevAjax = $.Deferred();
   prevAjax.resolve();
   $.each(ajaxReqs, function(idx, el) {
     var nextAjax = new DeferredAjax({
       action: el.action,
-      row: el.row,
+      rows: el.rows,
+      firstRow: el.firstRow,
       fields: el.fields,
-      count: idx,
+      fileKey: el.fileKey,
+      numRows: el.numRows,
     });
     $.when(prevAjax).then(
       function() { /* success */
@@ -1,5 +1,5 @@
 from flask.ext.wtf import Form
-from flask_wtf.file import InputRequired
+from flask_wtf.file import FileAllowed, FileField, FileRequired, InputRequired
 from wtforms.fields import (FieldList, FormField, RadioField, SelectField,
                             SelectMultipleField, SubmitField)
 
@@ -35,5 +35,20 @@ class DetermineOptionsForm(Form):
 
 class SaveCsvDataForm(Form):
     submit = SubmitField('Save')
+    submit_plan = SubmitField('Preview changes')
     submit_cancel = SubmitField('Cancel')
     submit_back = SubmitField('Back')
+
+
+class UploadCsvFileForm(Form):
+    csv = FileField(
+        'CSV File',
+        validators=[
+            FileRequired(),
+            FileAllowed(['csv'], 'Only .csv files are accepted.')
+        ])
+    mode = RadioField(
+        'Mode',
+        choices=[('update', 'Update'), ('reset', 'Reset')],
+        default='update')
+    submit = SubmitField('Upload')
@@ -0,0 +1,115 @@
+import os
+
+from flask.ext.rq import get_connection
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, get_current_job
+
+from writer import CsvSaveError, save_csv_storage
+
+from .. import create_app, db
+from ..geocoding import get_geocoding_service
+from ..models import CsvStorage
+
+
+class JobProgress(object):
+    """Records the phase and progress of a save in the meta data of an RQ
+    job, where the status endpoint reads them."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def __call__(self, phase, rows_processed=0, rows_total=0):
+        if self.job is None:
+            return
+        self.job.meta.update(
+            phase=phase, rows_processed=rows_processed, rows_total=rows_total)
+        self.job.save()
+
+
+def run_save_csv(csv_storage_id, progress=None, resumable=True):
+    """Save the CSV storage with the given id to the catalog and commit.
+    Unless resumable is False, the save commits a checkpoint every few
+    thousand rows geocoded or, for resets, saved to the next generation,
+    and running it again after a failure resumes from the last one. The
+    live catalog is only written by the final commit. Returns the counts of
+    resources added, modified, unchanged and removed."""
+    csv_storage = CsvStorage.query.get(csv_storage_id)
+    if csv_storage is None:
+        raise CsvSaveError('The CSV to save no longer exists.')
+
+    def checkpoint(phase, row_offset, counts=None):
+        csv_storage.set_checkpoint(phase, row_offset, counts)
+        db.session.commit()
+
+    try:
+        counts = save_csv_storage(
+            csv_storage, get_geocoding_service().geocode_many, progress,
+            checkpoint if resumable else None)
+        if progress is not None:
+            progress('committing')
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+    return counts
+
+
+def save_csv_job(csv_storage_id, user_id=None):
+    """RQ job saving a staged CSV. Its progress, and the reason it failed if
+    it does, are kept in the job's meta data. user_id is the owner of the
+    CSV, who alone may follow the job: the CSV is deleted once saved."""
+    app = create_app(os.getenv('FLASK_CONFIG') or 'default')
+    with app.app_context():
+        job = get_current_job()
+        try:
+            return run_save_csv(csv_storage_id, JobProgress(job))
+        except Exception as e:
+            if job is not None:
+                job.meta['error'] = str(e) if isinstance(
+                    e, CsvSaveError) else 'The CSV could not be saved.'
+                job.save()
+            raise
+
+
+def _fetch_job(job_id, user_id):
+    try:
+        job = Job.fetch(job_id, connection=get_connection())
+    except NoSuchJobError:
+        return None
+    if (job.kwargs or {}).get('user_id') != user_id:
+        return None
+    return job
+
+
+def save_csv_job_status(job_id, user_id):
+    """Return a dict with the status of the save_csv_job with the given id
+    ('queued', 'started', 'finished' or 'failed'), its phase and rows
+    processed, and its counts once finished or error once failed. Returns
+    None if there is no such job saving a CSV of the user with user_id."""
+    job = _fetch_job(job_id, user_id)
+    if job is None:
+        return None
+    status = {
+        'status': job.get_status(),
+        'phase': job.meta.get('phase'),
+        'rows_processed': job.meta.get('rows_processed', 0),
+        'rows_total': job.meta.get('rows_total', 0)
+    }
+    if job.is_finished:
+        status['counts'] = job.result
+    elif job.is_failed:
+        status['error'] = job.meta.get('error',
+                                       'The CSV could not be saved.')
+    return status
+
+
+def report_save_csv_job(job_id, user_id):
+    """Return whether the finished save_csv_job with the given id, of the
+    user with user_id, has not been reported to the user yet, and mark it
+    reported."""
+    job = _fetch_job(job_id, user_id)
+    if job is None or not job.is_finished or job.meta.get('reported'):
+        return False
+    job.meta['reported'] = True
+    job.save()
+    return True
@@ -1,24 +1,33 @@
-import datetime
+import csv
 import json
-import os
+from datetime import datetime
 
-import geocoder
-from flask import (abort, flash, jsonify, redirect, render_template, request,
-                   url_for)
+from flask import (abort, current_app, flash, jsonify, redirect,
+                   render_template, request, url_for)
 from flask.ext.login import current_user, login_required
+from flask.ext.rq import get_queue
 
 from app import csrf
 from forms import (DetermineDescriptorTypesForm, DetermineOptionsForm,
                    DetermineRequiredOptionDescriptorForm,
-                   RequiredOptionDescriptorMissingForm, SaveCsvDataForm)
+                   RequiredOptionDescriptorMissingForm, SaveCsvDataForm,
+                   UploadCsvFileForm)
+from jobs import report_save_csv_job, save_csv_job, save_csv_job_status
+from writer import plan_csv_storage
 
 from . import bulk_resource
 from .. import db
-from ..models import (CsvDescriptor, CsvDescriptorRemove, CsvRow, CsvStorage,
-                      Descriptor, GeocoderCache, OptionAssociation, Rating,
+from ..geocoding import get_geocoding_service
+from ..models import (ColumnStats, CsvDescriptor, CsvDescriptorRemove,
+                      CsvRowBlock, CsvStorage, Descriptor, GeocoderCache,
                       RequiredOptionDescriptor,
-                      RequiredOptionDescriptorConstructor, Resource,
-                      ResourceSuggestion, TextAssociation)
+                      RequiredOptionDescriptorConstructor, Resource)
+
+
+# Rows of a CSV file parsed on the server that are stored together
+ROWS_PER_BATCH = 500
+# Errors after which checking an uploaded CSV file stops
+MAX_UPLOAD_ERRORS = 100
 
 
 @csrf.exempt
@@ -29,6 +38,20 @@ def upload():
     return render_template('bulk_resource/upload.html')
 
 
+@bulk_resource.route('/upload-file', methods=['GET', 'POST'])
+@login_required
+def upload_file():
+    """Upload new resources in bulk with a CSV file parsed on the server."""
+    form = UploadCsvFileForm()
+    if form.validate_on_submit():
+        errors = ingest_csv(form.csv.data.stream, form.mode.data)
+        if not errors:
+            return redirect(url_for('bulk_resource.set_descriptor_types'))
+        for error in errors:
+            flash(error, 'form-error')
+    return render_template('bulk_resource/upload_file.html', form=form)
+
+
 ''' Processes each Deferred Ajax request '''
 
 
@@ -38,28 +61,19 @@ def upload_row():
     data = json.loads(request.form['json'])
 
     # Store CSV fields as descriptors
-    if data['action'] == 'fields-reset':  # Reset operation
+    if data['action'] in ('fields-reset', 'fields-update'):
         try:
-            fields = data['fields']
-
-            # Temporary storage area for CSV data
-            csv_storage = CsvStorage(
-                date_uploaded=datetime.now(),
-                user=current_user,
-                action='reset', )
-
-            # Store new descriptors
-            fields = [
-                f.strip() for f in fields
-                if f.strip() and f.strip() != 'Name' and f.strip() != 'Address'
-            ]
-            for f in fields:
-                desc = CsvDescriptor(
-                    csv_storage=csv_storage,
-                    name=f,
-                    values=set(), )
-                db.session.add(desc)
-            db.session.add(csv_storage)
+            action = 'reset' if data['action'] == 'fields-reset' else 'update'
+            csv_storage = resumable_storage(data['fields'], action,
+                                            data.get('fileKey'))
+            if csv_storage is not None:
+                return jsonify({
+                    "status": "Success",
+                    "message": "Resuming the previous upload of this file",
+                    "resumeFrom":
+                    csv_storage.get_checkpoint('staging').row_offset
+                })
+            store_fields(data['fields'], action, data.get('fileKey'))
             db.session.commit()
             return jsonify({
                 "status": "Success",
@@ -68,170 +82,27 @@ def upload_row():
         except:
             db.session.rollback()
             abort(404)
-    if data['action'] == 'fields-update':  # Update operation
-        try:
-            fields = data['fields']
-            csv_storage = CsvStorage(
-                date_uploaded=datetime.now(),
-                user=current_user,
-                action='update', )
-
-            # get old fields
-            descriptors = Descriptor.query.all()
-            descriptors = dict([(d.name, d) for d in descriptors])
-            old_d = descriptors.keys()
-
-            # compare with new fields
-            new_d = [
-                f.strip() for f in fields
-                if f.strip() and f.strip() != 'Name' and f.strip() != 'Address'
-            ]
-
-            # store descriptors to remove
-            removed = set(old_d) - set(new_d)
-            for f in removed:
-                old_desc = Descriptor.query.filter_by(name=f).first()
-                desc = CsvDescriptorRemove(
-                    csv_storage=csv_storage,
-                    descriptor_id=old_desc.id,
-                    name=old_desc.name, )
-                db.session.add(desc)
-
-            # store old descriptors not removed
-            keep = set(old_d).intersection(set(new_d))
-            for f in keep:
-                existing_desc = descriptors.get(f)
-                existing_type = 'option' if existing_desc.values else 'text'
-                # CSVDescriptor only stores values from CSV, not existing
-                # values in app
-                desc = CsvDescriptor(
-                    csv_storage=csv_storage,
-                    name=f,
-                    values=set(),
-                    descriptor_id=existing_desc.id,
-                    descriptor_type=existing_type, )
-                db.session.add(desc)
-
-            # store new descriptors
-            added = set(new_d) - set(old_d)
-            for f in added:
-                desc = CsvDescriptor(
-                    csv_storage=csv_storage,
-                    name=f,
-                    values=set(), )
-                db.session.add(desc)
-
-            db.session.add(csv_storage)
-            db.session.commit()
-            return jsonify({
-                "status": "Success",
-                "message": "Successfully added fields"
-            })
-        except:
-            db.session.rollback()
-            abort(404)
 
-    # Store CSV rows
-    if data['action'] == 'reset-update':  # Reset operation
+    # Store CSV rows, a batch at a time
+    if data['action'] in ('reset-update', 'update'):
+        rows = data.get('rows')
+        if rows is None:
+            rows = [data['row']]
         try:
-            row = data['row']
-            clean_row = {k.strip(): v.strip() for k, v in row.iteritems()}
-
-            # Validate addresses
-            address = clean_row['Address']
-            # See if address exists in cache
-            cached = GeocoderCache.query.filter_by(address=address).first()
-            if cached is None:
-                # Toggle API to avoid Google geocoder API limit - temp solution
-                if data['count'] % 45 == 0:
-                    if os.environ.get('GOOGLE_API_KEY') == os.environ.get(
-                            'GOOGLE_API_1'):
-                        os.environ['GOOGLE_API_KEY'] = os.environ.get(
-                            'GOOGLE_API_2')
-                    else:
-                        os.environ['GOOGLE_API_KEY'] = os.environ.get(
-                            'GOOGLE_API_1')
-                g = geocoder.google(
-                    address, key=os.environ.get('GOOGLE_API_KEY'))
-                if g.status != 'OK':
-                    msg = 'Address cannot be geocoded due to ' + g.status + \
-                          ": " + address
-                    return jsonify({"status": "Error", "message": msg})
-                else:
-                    geo = GeocoderCache(
-                        address=address,
-                        latitude=g.latlng[0],
-                        longitude=g.latlng[1])
-                    db.session.add(geo)
-
-            csv_storage = CsvStorage.most_recent(user=current_user)
-            if csv_storage is None:
-                abort(404)
-
-            csv_row = CsvRow(
-                csv_storage=csv_storage,
-                data=clean_row, )
-            db.session.add(csv_row)
-            db.session.commit()
-            return jsonify({
-                "status": "Success",
-                "message": "Successfully added row"
-            })
+            errors = save_rows(rows, first_row=data.get('firstRow'))
         except:
             db.session.rollback()
             abort(404)
-    if data['action'] == 'update':  # Update operation
-        try:
-            row = data['row']
-            clean_row = {k.strip(): v.strip() for k, v in row.iteritems()}
-
-            # Validate addresses
-            address = clean_row['Address']
-            # See if address exists in cache
-            cached = GeocoderCache.query.filter_by(address=address).first()
-            if cached is None:
-                # Toggle API to avoid Google geocoder API limit - temp solution
-                if data['count'] % 45 == 0:
-                    if os.environ.get('GOOGLE_API_KEY') == os.environ.get(
-                            'GOOGLE_API_1'):
-                        os.environ['GOOGLE_API_KEY'] = os.environ.get(
-                            'GOOGLE_API_2')
-                    else:
-                        os.environ['GOOGLE_API_KEY'] = os.environ.get(
-                            'GOOGLE_API_1')
-                g = geocoder.google(
-                    address, key=os.environ.get('GOOGLE_API_KEY'))
-                if g.status != 'OK':
-                    msg = 'Address cannot be geocoded due to ' + g.status + \
-                          ": " + address
-                    return jsonify({"status": "Error", "message": msg})
-                else:
-                    geo = GeocoderCache(
-                        address=address,
-                        latitude=g.latlng[0],
-                        longitude=g.latlng[1])
-                    db.session.add(geo)
-
-            csv_storage = CsvStorage.most_recent(user=current_user)
-            if csv_storage is None:
-                abort(404)
-
-            csv_row = CsvRow(csv_storage=csv_storage, data=clean_row)
-            # See if resource already exists
-            existing_resource = Resource.query.filter_by(
-                name=row['Name']).first()
-            if existing_resource is not None:
-                csv_row.resource_id = existing_resource.id
-
-            db.session.add(csv_row)
-            db.session.commit()
+        if errors:
             return jsonify({
-                "status": "Success",
-                "message": "Successfully added row"
+                "status": "Error",
+                "message": "\n".join(e['message'] for e in errors),
+                "errors": errors
             })
-        except:
-            db.session.rollback()
-            abort(404)
+        return jsonify({
+            "status": "Success",
+            "message": "Successfully added {} row(s)".format(len(rows))
+        })
 
     # Done processing CSV, move onto next step
     if data['action'] == 'finished':
@@ -239,15 +110,269 @@ def upload_row():
         if csv_storage is None:
             abort(404)
 
-        if len(csv_storage.csv_rows) == 0:
+        if csv_storage.count_rows() == 0:
             return jsonify({
                 "status": "Error",
                 "message": 'No resources to update from CSV'
             })
+        # Rows that failed to geocode are left out until they are sent again
+        num_rows = data.get('numRows')
+        if num_rows is not None and \
+                csv_storage.staged_through() < num_rows:
+            return jsonify({
+                "status": "Error",
+                "message": '{} rows of the CSV are not stored yet'.format(
+                    num_rows - csv_storage.count_rows())
+            })
+        if csv_storage.action == 'update':
+            csv_storage.link_resources()
+        csv_storage.set_checkpoint('staging', csv_storage.count_rows(),
+                                   done=True)
+        db.session.commit()
 
         return jsonify(redirect=url_for('bulk_resource.set_descriptor_types'))
 
 
+def resumable_storage(fields, action, source_key):
+    """Return the current user's most recent CSV storage if it is an
+    interrupted upload of the file identified by source_key, with the same
+    header and action, otherwise None."""
+    if not source_key:
+        return None
+    csv_storage = CsvStorage.most_recent(user=current_user)
+    if csv_storage is None or csv_storage.source_key != source_key or \
+            csv_storage.action != action or \
+            csv_storage.header != [f.strip() for f in fields if f.strip()]:
+        return None
+    checkpoint = csv_storage.get_checkpoint('staging')
+    if checkpoint is None or checkpoint.done:
+        return None
+    return csv_storage
+
+
+def store_fields(fields, action, source_key=None):
+    """Create a CSV storage for the current user with a CSV descriptor for
+    each of fields, the header of the CSV. In 'update' mode, fields are
+    linked to the existing descriptors with the same names and descriptors
+    missing from fields are marked for removal. Returns the storage, which
+    is added to the session but not committed."""
+    # Temporary storage area for CSV data
+    csv_storage = CsvStorage(
+        date_uploaded=datetime.now(),
+        user=current_user,
+        action=action,
+        header=[f.strip() for f in fields if f.strip()],
+        source_key=source_key)
+    # Rows are counted as they are staged, so that the upload can resume
+    csv_storage.set_checkpoint('staging', 0)
+    new_d = [
+        f.strip() for f in fields
+        if f.strip() and f.strip() != 'Name' and f.strip() != 'Address'
+    ]
+
+    if action == 'reset':
+        # Store new descriptors
+        for f in new_d:
+            desc = CsvDescriptor(
+                csv_storage=csv_storage,
+                name=f,
+                values=set(), )
+            db.session.add(desc)
+        db.session.add(csv_storage)
+        return csv_storage
+
+    # get old fields
+    descriptors = Descriptor.query.all()
+    descriptors = dict([(d.name, d) for d in descriptors])
+    old_d = descriptors.keys()
+
+    # store descriptors to remove
+    removed = set(old_d) - set(new_d)
+    for f in removed:
+        old_desc = descriptors.get(f)
+        desc = CsvDescriptorRemove(
+            csv_storage=csv_storage,
+            descriptor_id=old_desc.id,
+            name=old_desc.name, )
+        db.session.add(desc)
+
+    # store old descriptors not removed
+    keep = set(old_d).intersection(set(new_d))
+    for f in keep:
+        existing_desc = descriptors.get(f)
+        existing_type = 'option' if existing_desc.values else 'text'
+        # CSVDescriptor only stores values from CSV, not existing
+        # values in app
+        desc = CsvDescriptor(
+            csv_storage=csv_storage,
+            name=f,
+            values=set(),
+            descriptor_id=existing_desc.id,
+            descriptor_type=existing_type, )
+        db.session.add(desc)
+
+    # store new descriptors
+    added = set(new_d) - set(old_d)
+    for f in added:
+        desc = CsvDescriptor(
+            csv_storage=csv_storage,
+            name=f,
+            values=set(), )
+        db.session.add(desc)
+
+    db.session.add(csv_storage)
+    return csv_storage
+
+
+def ingest_csv(csv_file, action):
+    """Parse the CSV file csv_file as it is read and store it in a new CSV
+    storage for the current user, like the 'fields-*', row and 'finished'
+    actions of /_upload would. Rows are checked as in upload-csv.js and stored
+    ROWS_PER_BATCH at a time, so memory use does not depend on the size of
+    the file. Addresses are not geocoded here, which could take longer than
+    a request may, but by the save job. Returns a list of error messages;
+    if there are any, nothing is kept."""
+    reader = csv.reader(csv_file)
+    try:
+        fields = [f.decode('utf-8-sig').strip() for f in next(reader, [])]
+    except UnicodeDecodeError:
+        return ['The CSV file must be encoded as UTF-8.']
+    errors = []
+    if 'Name' not in fields:
+        errors.append("'Name' is a required column name.")
+    if 'Address' not in fields:
+        errors.append("'Address' is a required column name.")
+    if errors:
+        return errors
+
+    csv_storage = store_fields(fields, action)
+    db.session.commit()
+    batch = []
+    num_rows = 0
+
+    def save_batch():
+        save_rows(batch, csv_storage, geocode=False)
+        del batch[:]
+
+    try:
+        # Row numbers count the header as row 1, like spreadsheets do
+        for row_num, values in enumerate(reader, 2):
+            values = [v.decode('utf-8').strip() for v in values]
+            # Skip empty lines
+            if not any(values):
+                continue
+            row = dict((f, v) for f, v in zip(fields, values) if f)
+            if len(values) != len(fields):
+                errors.append(
+                    'Row {} has the incorrect number of columns: {}. '
+                    'Expected: {}'.format(row_num, len(values), len(fields)))
+            elif not row['Name']:
+                errors.append(
+                    "Row {} is missing a required 'Name' value.".format(
+                        row_num))
+            elif not row['Address']:
+                errors.append(
+                    "Row {} is missing a required 'Address' value.".format(
+                        row_num))
+            if len(errors) >= MAX_UPLOAD_ERRORS:
+                break
+            if errors:
+                # Only keep checking the remaining rows
+                continue
+            batch.append(row)
+            num_rows += 1
+            if len(batch) == ROWS_PER_BATCH:
+                save_batch()
+        if batch and not errors:
+            save_batch()
+    except (csv.Error, UnicodeDecodeError) as e:
+        errors.append('The CSV file could not be read: {}'.format(e))
+
+    if not errors and num_rows == 0:
+        errors.append('No resources to update from CSV')
+    if not errors:
+        if action == 'update':
+            csv_storage.link_resources()
+        csv_storage.set_checkpoint('staging', num_rows, done=True)
+        db.session.commit()
+    if errors:
+        db.session.rollback()
+        CsvRowBlock.query.filter_by(csv_storage_id=csv_storage.id).delete()
+        db.session.delete(csv_storage)
+        db.session.commit()
+    return errors
+
+
+def save_rows(rows, csv_storage=None, first_row=None, geocode=True):
+    """Store a batch of CSV rows in csv_storage, by default the current
+    user's most recent CSV storage, as one block and with one commit.
+    Unless geocode is False, addresses are looked up in the geocoder cache
+    and the ones not cached are geocoded in parallel; otherwise they are
+    geocoded when the CSV is saved. Rows are linked to existing resources
+    once all of them are stored, by CsvStorage.link_resources. Returns a
+    list of errors, each with the index of its row in the batch and a
+    message. The rows without an error are stored, and the others are left
+    out, to be sent again once e.g. a geocoding outage is over or their
+    address is fixed.
+
+    If given, first_row is the number of the first row of the batch in the
+    CSV. Rows are then stored in blocks of consecutive rows at their row
+    numbers, rows of a batch sent again that are already stored are
+    skipped, and the staging checkpoint is moved past the rows stored
+    without gaps."""
+    if csv_storage is None:
+        csv_storage = CsvStorage.most_recent(user=current_user)
+    if csv_storage is None:
+        abort(404)
+    clean_rows = [
+        dict((k.strip(), v.strip()) for k, v in row.iteritems())
+        for row in rows
+    ]
+    pending = range(len(clean_rows))
+    if first_row is not None:
+        # Stored by an earlier attempt
+        staged = csv_storage.staged_rows(first_row, len(clean_rows))
+        pending = [i for i in pending if first_row + i not in staged]
+
+    # Validate addresses
+    geocodes = {}
+    if geocode:
+        geocodes = GeocoderCache.resolve_many(
+            (clean_rows[i]['Address'] for i in pending),
+            get_geocoding_service().geocode_many)
+    failed = {}
+    for address, g in geocodes.iteritems():
+        if g.status != 'OK':
+            failed[address] = 'Address cannot be geocoded due to ' + \
+                g.status + ": " + address
+
+    errors = [{'row': i, 'message': failed[clean_rows[i]['Address']]}
+              for i in pending if clean_rows[i]['Address'] in failed]
+    stored = [i for i in pending if clean_rows[i]['Address'] not in failed]
+    if first_row is None:
+        csv_storage.append_rows([clean_rows[i] for i in stored])
+    else:
+        for run in _consecutive_runs(stored):
+            csv_storage.append_rows([clean_rows[i] for i in run],
+                                    first_row=first_row + run[0])
+        checkpoint = csv_storage.get_checkpoint('staging')
+        csv_storage.set_checkpoint('staging', csv_storage.staged_through(
+            checkpoint.row_offset if checkpoint else 0))
+    db.session.commit()
+    return errors
+
+
+def _consecutive_runs(numbers):
+    """Split a sorted list of numbers into lists of consecutive numbers."""
+    runs = []
+    for n in numbers:
+        if runs and runs[-1][-1] == n - 1:
+            runs[-1].append(n)
+        else:
+            runs.append([n])
+    return runs
+
+
 ''' Sets each descriptor in the CSV to be an option or a text descriptor '''
 
 
@@ -292,11 +417,14 @@ def set_descriptor_types():
             db.session.commit()
             return redirect(url_for('bulk_resource.upload'))
 
-    # Add one text/option toggle for each new CSV descriptor
+    # Add one text/option toggle for each new CSV descriptor, preset to the
+    # type suggested by the statistics of its column
     num = 0
+    column_stats = []
     for desc in csv_storage.csv_descriptors:
         # We don't allow setting a new type for existing descriptors
         if not desc.descriptor_id:
+            column_stats.append((desc.name, ColumnStats(desc.stats)))
             form.descriptor_types.append_entry()
             form.descriptor_types[num].label = desc.name
             if desc.descriptor_type == 'option' or \
@@ -322,7 +450,8 @@ def set_descriptor_types():
         form=form,
         existing_descs=existing_descs,
         num=num,
-        remove_descs=remove_descs)
+        remove_descs=remove_descs,
+        column_stats=column_stats)
 
 
 @bulk_resource.route('/review-desc-options', methods=['GET', 'POST'])
@@ -494,43 +623,15 @@ def validate_required_option_descriptor():
         abort(404)
     req_opt_desc_const = RequiredOptionDescriptorConstructor.query.all()[0]
     req_opt_desc = req_opt_desc_const.name
-    missing_resources = set()
     form = RequiredOptionDescriptorMissingForm()
 
-    # Find resources in the CSV that lack association with chosen required
-    # option descriptor
-    csv_resources = set()
-    for row in csv_storage.csv_rows:
-        csv_resources.add(row.data['Name'])
-        if req_opt_desc not in row.data or row.data[
-                req_opt_desc].strip() == '':
-            missing_resources.add(row.data['Name'])
-
-    # Find all existing resources that lack an
-    # association with the chosen required option descriptor
-    if csv_storage.action == 'update':
-        # Check if there is a required option descriptor already
-        curr_req_opt_desc = RequiredOptionDescriptor.query.all()
-        curr_req = ''
-        if curr_req_opt_desc:
-            curr_req_opt_desc = curr_req_opt_desc[0]
-            if curr_req_opt_desc.descriptor_id != -1:
-                req_descriptor = Descriptor.query.filter_by(
-                    id=curr_req_opt_desc.descriptor_id).first()
-                if req_descriptor is not None:
-                    curr_req = req_descriptor.name
-
-        resources = Resource.query.all()
-        for r in resources:
-            # If no previous required option descriptor
-            # or new required is not same as old
-            if curr_req == '' or req_opt_desc != curr_req:
-                if r.name not in csv_resources:
-                    missing_resources.add(r.name)
-            # Same required option descriptor
-            elif req_opt_desc == curr_req:
-                if r.name in missing_resources:
-                    missing_resources.remove(r.name)
+    # Find the resources that will lack an association with the chosen
+    # required option descriptor once the CSV is saved, once per choice
+    if req_opt_desc_const.missing_names is None:
+        req_opt_desc_const.missing_names = sorted(
+            missing_required_names(csv_storage, req_opt_desc))
+        db.session.commit()
+    missing_resources = req_opt_desc_const.missing_names
 
     # For form submission
     if request.method == 'POST':
@@ -577,6 +678,35 @@ def validate_required_option_descriptor():
         required=req_opt_desc, )
 
 
+def missing_required_names(csv_storage, name):
+    """Return the set of names of the resources that will have no value for
+    the option descriptor called name once csv_storage is saved: the rows
+    of the CSV with no value for it and, for updates, the existing
+    resources without one that the CSV leaves as they are. Existing
+    resources are checked with one anti-join."""
+    update = csv_storage.action == 'update'
+    in_csv = name in (csv_storage.header or [])
+    csv_names = set()
+    missing = set()
+    # Rows of resources whose value is kept if they already have one
+    kept = {}
+    for _, data, resource_id in csv_storage.iter_rows():
+        csv_names.add(data['Name'])
+        if (data.get(name) or '').strip():
+            continue
+        if update and not in_csv and resource_id is not None:
+            kept[resource_id] = data['Name']
+        else:
+            missing.add(data['Name'])
+    if update:
+        descriptor = Descriptor.query.filter_by(name=name).first()
+        lacking = dict(Resource.missing_option(
+            descriptor.id if descriptor is not None else None))
+        missing.update(n for i, n in kept.iteritems() if i in lacking)
+        missing.update(set(lacking.itervalues()) - csv_names)
+    return missing
+
+
 ''' Last step in CSV workflow to update the resource and descriptor data
 models'''
 
@@ -607,179 +737,68 @@ def save_csv():
             db.session.delete(csv_storage)
             db.session.commit()
             return redirect(url_for('bulk_resource.upload'))
+        elif form.data['submit_plan']:
+            # Dry run: show what saving would change, without writing
+            return render_template('bulk_resource/save.html', form=form,
+                                   plan=plan_csv_storage(csv_storage))
+
+        # A save already queued or running is followed rather than started
+        # twice. A failed one is started again, and resumes from its last
+        # checkpoint.
+        if csv_storage.save_job_id is not None:
+            status = save_csv_job_status(csv_storage.save_job_id,
+                                         current_user.id)
+            if status is not None and \
+                    status['status'] in ('queued', 'started'):
+                return redirect(url_for('bulk_resource.save_csv_progress',
+                                        job_id=csv_storage.save_job_id))
+
+        # Large imports take longer than a request may, so the save runs
+        # on the task queue while the user watches its progress
+        job = get_queue().enqueue_call(
+            save_csv_job,
+            args=(csv_storage.id, ),
+            kwargs={'user_id': current_user.id},
+            timeout=current_app.config['CSV_SAVE_JOB_TIMEOUT'])
+        csv_storage.save_job_id = job.id
+        db.session.commit()
+        return redirect(url_for('bulk_resource.save_csv_progress',
+                                job_id=job.id))
+    return render_template('bulk_resource/save.html', form=form)
 
-        RequiredOptionDescriptor.query.delete()
-        if csv_storage.action == 'reset':
-            OptionAssociation.query.delete()
-            TextAssociation.query.delete()
-            # on delete suggestions linked to resources
-            ResourceSuggestion.query.filter(
-                ResourceSuggestion.resource_id is not None).delete()
-            Rating.query.delete()
-            Descriptor.query.delete()
-            Resource.query.delete()
-
-        # Create/Update descriptors
-        for desc in csv_storage.csv_descriptors:
-            # if existing descriptor, add new descriptor values
-            if csv_storage.action == 'update' and desc.descriptor_id:
-                if desc.descriptor_type == 'option':
-                    existing_descriptor = Descriptor.query.filter_by(
-                        id=desc.descriptor_id).first()
-                    values = existing_descriptor.values
-                    values.extend(desc.values)
-                    existing_descriptor.values = list(set(values))
-                    db.session.add(existing_descriptor)
-            else:
-                descriptor = Descriptor(
-                    name=desc.name,
-                    values=list(desc.values),
-                    is_searchable=True, )
-                db.session.add(descriptor)
-
-        # Remove descriptors not in the CSV
-        for desc in csv_storage.csv_descriptors_remove:
-            d = Descriptor.query.get(desc.descriptor_id)
-            if d is None:
-                db.session.rollback()
-                abort(404)
-            db.session.delete(d)
-
-        # Create/update rows and descriptor associations
-        for row in csv_storage.csv_rows:
-            if csv_storage.action == 'update' and row.resource_id:
-                resource = Resource.query.filter_by(id=row.resource_id).first()
-                address = row.data['Address']
-                if resource.address != address:
-                    resource.address = address
-                    cached = GeocoderCache.query.filter_by(
-                        address=address).first()
-                    if cached is None:
-                        db.session.rollback()
-                        abort(404)
-                    resource.latitude = cached.latitude
-                    resource.longitude = cached.longitude
-                    db.session.add(resource)
-            else:
-                name = row.data['Name']
-                address = row.data['Address']
-                cached = GeocoderCache.query.filter_by(address=address).first()
-                if cached is None:
-                    db.session.rollback()
-                    abort(404)
-                resource = Resource(
-                    name=name,
-                    address=address,
-                    latitude=cached.latitude,
-                    longitude=cached.longitude)
-                db.session.add(resource)
-
-            # Loop through descriptors on the resource rows
-            for key in row.data:
-                if key and key != 'Name' and key != 'Address':
-                    descriptor = Descriptor.query.filter_by(name=key).first()
-                    values = list(descriptor.values)
-                    assocValues = []
-                    if len(descriptor.values) == 0:  # text descriptor
-                        association_class = TextAssociation
-                        keyword = 'text'
-                        # see if same descriptor already exists
-                        if csv_storage.action == 'update':
-                            text_association = TextAssociation.query.filter_by(
-                                resource_id=resource.id,
-                                descriptor_id=descriptor.id, ).first()
-                            if text_association is None:
-                                assocValues.append(row.data[key])
-                            # Just update text value if only text changed
-                            elif text_association.text != row.data[key]:
-                                text_association.text = row.data[key]
-                                db.session.add(text_association)
-                        else:
-                            assocValues.append(row.data[key])
-                    else:  # option descriptor
-                        association_class = OptionAssociation
-                        keyword = 'option'
-                        curr_opts = []
-                        for s in row.data[key].split(';'):
-                            s = s.strip()
-                            if s in values:
-                                curr_opts.append(values.index(s))
-                        # see if same descriptor already exists
-                        if csv_storage.action == 'update':
-                            option_associations = OptionAssociation.query.\
-                                filter_by(resource_id=resource.id,
-                                          descriptor_id=descriptor.id)
-                            if option_associations is None:
-                                assocValues.extend(curr_opts)
-                            else:
-                                # Check if existing options same as new ones
-                                # in CSV
-                                old_opts = [
-                                    opt.option for opt in option_associations
-                                ]
-                                if set(curr_opts) != set(old_opts):
-                                    # If options different, delete existing and
-                                    # add new ones after
-                                    for o in option_associations:
-                                        db.session.delete(o)
-                                    assocValues.extend(curr_opts)
-                        else:
-                            assocValues.extend(curr_opts)
-
-                    # Create new descriptor associations
-                    for value in assocValues:
-                        arguments = {
-                            'resource_id': resource.id,
-                            'descriptor_id': descriptor.id,
-                            keyword: value,
-                            'resource': resource,
-                            'descriptor': descriptor
-                        }
-                        new_association = association_class(**arguments)
-                        db.session.add(new_association)
-
-        # Set required option descriptor
-        req_opt_desc_const = RequiredOptionDescriptorConstructor.query.all()
-        if req_opt_desc_const:
-            req_opt_desc_const = req_opt_desc_const[0]
-            required_option_descriptor = Descriptor.query.filter_by(
-                name=req_opt_desc_const.name).first()
-            if required_option_descriptor is None:
-                required_option_descriptor = Descriptor(
-                    name=req_opt_desc_const.name,
-                    values=req_opt_desc_const.values,
-                    is_searchable=True)
-                db.session.add(required_option_descriptor)
-            req_opt_desc = RequiredOptionDescriptor(
-                descriptor_id=required_option_descriptor.id)
-
-            # Add associations for the resources missing values for the
-            # required option descriptor
-            if req_opt_desc_const.missing_dict:
-                for name in req_opt_desc_const.missing_dict.keys():
-                    resource = Resource.query.filter_by(name=name).first()
-                    if resource is not None:
-                        for val in req_opt_desc_const.missing_dict[name]:
-                            new_association = OptionAssociation(
-                                resource_id=resource.id,
-                                descriptor_id=required_option_descriptor.id,
-                                option=required_option_descriptor.values.index(
-                                    val),
-                                resource=resource,
-                                descriptor=required_option_descriptor)
-                            db.session.add(new_association)
-            db.session.delete(req_opt_desc_const)
-            db.session.add(req_opt_desc)
-        else:
-            # No required option descriptor set, initialize to dummy
-            req_opt_desc = RequiredOptionDescriptor(descriptor_id=-1)
-            db.session.add(req_opt_desc)
 
-        db.session.delete(csv_storage)
-        try:
-            db.session.commit()
-        except:
-            db.session.rollback()
-            abort(404)
-        return redirect(url_for('single_resource.index'))
-    return render_template('bulk_resource/save.html', form=form)
+@bulk_resource.route('/save-csv/<job_id>')
+@login_required
+def save_csv_progress(job_id):
+    """Show the progress of saving a CSV until it is done."""
+    if save_csv_job_status(job_id, current_user.id) is None:
+        abort(404)
+    return render_template('bulk_resource/save_progress.html', job_id=job_id)
+
+
+@bulk_resource.route('/save-csv/<job_id>/status')
+@login_required
+def save_csv_status(job_id):
+    """Return the status of a job saving a CSV as JSON."""
+    status = save_csv_job_status(job_id, current_user.id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+@bulk_resource.route('/save-csv/<job_id>/done')
+@login_required
+def save_csv_done(job_id):
+    """Go to the resources once a CSV is saved, telling the user what
+    changed the first time."""
+    status = save_csv_job_status(job_id, current_user.id)
+    if status is None:
+        abort(404)
+    if status['status'] != 'finished':
+        return redirect(url_for('bulk_resource.save_csv_progress',
+                                job_id=job_id))
+    if report_save_csv_job(job_id, current_user.id):
+        flash('CSV saved: {added} resources added, {modified} modified, '
+              '{unchanged} unchanged and {removed} removed.'.format(
+                  **status['counts']), 'success')
+    return redirect(url_for('single_resource.index'))
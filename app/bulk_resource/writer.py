@@ -0,0 +1,718 @@
+from collections import defaultdict
+
+from .. import db
+from ..geocoding import get_geocoding_service
+from ..models import (CatalogGeneration, CsvRowBlock, CsvStorage, Descriptor,
+                      DescriptorRegistry, GeocoderCache, OptionAssociation,
+                      RegisteredDescriptor, RequiredOptionDescriptor,
+                      RequiredOptionDescriptorConstructor, Resource,
+                      TextAssociation, content_hash, create_next_generation,
+                      drop_next_generation, generation_max_id,
+                      mark_resources_imported, next_generation_ids,
+                      next_generation_tables, normalize_address,
+                      publish_next_generation)
+from ..utils import chunks
+
+# Rows written by one executemany
+WRITE_CHUNK_SIZE = 1000
+# Rows between reports of progress
+PROGRESS_INTERVAL = 500
+# Rows geocoded or saved between checkpoints of a resumable save
+CHECKPOINT_INTERVAL = 5000
+# Addresses that cannot be geocoded listed in the error of a failed save
+MAX_REPORTED_ADDRESSES = 10
+
+
+class CsvSaveError(Exception):
+    """The staged CSV cannot be saved, e.g. because an address could not be
+    geocoded."""
+
+
+def _insert(model, mappings):
+    for chunk in chunks(mappings, WRITE_CHUNK_SIZE):
+        db.session.bulk_insert_mappings(model, chunk)
+
+
+def _update(model, mappings):
+    for chunk in chunks(mappings, WRITE_CHUNK_SIZE):
+        db.session.bulk_update_mappings(model, chunk)
+
+
+def _delete(model, ids):
+    table = model.__table__
+    for chunk in chunks(ids):
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+
+
+def _write_descriptors(csv_storage):
+    """Create the descriptors of the CSV, add new option values to the
+    existing ones and remove the descriptors not in the CSV."""
+    for desc in csv_storage.csv_descriptors:
+        if csv_storage.action == 'update' and desc.descriptor_id:
+            if desc.descriptor_type == 'option':
+                existing_descriptor = Descriptor.query.get(desc.descriptor_id)
+                # Append new values so that the indices stored by existing
+                # option associations stay valid
+                values = list(existing_descriptor.values or [])
+                new_values = sorted(set(desc.values or []) - set(values))
+                # Descriptor writes rebuild the association cache, so leave
+                # unchanged descriptors alone
+                if new_values:
+                    existing_descriptor.values = values + new_values
+        else:
+            db.session.add(Descriptor(
+                name=desc.name,
+                values=list(desc.values or []),
+                is_searchable=True))
+
+    remove_ids = [desc.descriptor_id
+                  for desc in csv_storage.csv_descriptors_remove]
+    if remove_ids:
+        if Descriptor.query.filter(Descriptor.id.in_(remove_ids)).count() != \
+                len(set(remove_ids)):
+            raise CsvSaveError('A descriptor to remove no longer exists.')
+        # The associations are deleted without the ORM, and the resources
+        # they belonged to recorded, so that the indexes update those
+        # resources only
+        resource_ids = set()
+        for model in (OptionAssociation, TextAssociation):
+            resource_ids.update(
+                resource_id for resource_id, in db.session.query(
+                    model.resource_id).filter(
+                        model.descriptor_id.in_(remove_ids)).distinct())
+            table = model.__table__
+            db.session.execute(table.delete().where(
+                table.c.descriptor_id.in_(remove_ids)))
+        mark_resources_imported(db.session, {}, resource_ids)
+        for descriptor in Descriptor.query.filter(
+                Descriptor.id.in_(remove_ids)):
+            db.session.delete(descriptor)
+    db.session.flush()
+
+
+def _existing_associations(resource_ids):
+    """Load the associations of the given resources, as a dict from
+    (resource id, descriptor id) to the first text association's
+    (id, text), and one to the list of (id, option) of option
+    associations."""
+    texts = {}
+    options = defaultdict(list)
+    for chunk in chunks(resource_ids):
+        for id, resource_id, descriptor_id, text in db.session.query(
+                TextAssociation.id, TextAssociation.resource_id,
+                TextAssociation.descriptor_id, TextAssociation.text).filter(
+                    TextAssociation.resource_id.in_(chunk)).order_by(
+                        TextAssociation.id):
+            texts.setdefault((resource_id, descriptor_id), (id, text))
+        for id, resource_id, descriptor_id, option in db.session.query(
+                OptionAssociation.id, OptionAssociation.resource_id,
+                OptionAssociation.descriptor_id,
+                OptionAssociation.option).filter(
+                    OptionAssociation.resource_id.in_(chunk)):
+            options[(resource_id, descriptor_id)].append((id, option))
+    return texts, options
+
+
+def _write_required_option_descriptor(registry):
+    """Set the required option descriptor chosen in the CSV workflow and
+    add the values given for the resources missing one."""
+    constructor = RequiredOptionDescriptorConstructor.query.first()
+    if constructor is None:
+        # No required option descriptor set, initialize to dummy
+        db.session.add(RequiredOptionDescriptor(descriptor_id=-1))
+        return
+
+    descriptor = registry.get_by_name(constructor.name)
+    if descriptor is None:
+        descriptor = Descriptor(
+            name=constructor.name,
+            values=constructor.values,
+            is_searchable=True)
+        db.session.add(descriptor)
+        db.session.flush()
+        descriptor = RegisteredDescriptor(descriptor)
+
+    missing = constructor.missing_dict or {}
+    resource_ids = Resource.name_ids()
+    option_inserts = [{
+        'resource_id': resource_ids[name],
+        'descriptor_id': descriptor.id,
+        'option': descriptor.value_indices[value]
+    } for name, values in missing.iteritems() if name in resource_ids
+                      for value in values]
+    _insert(OptionAssociation, option_inserts)
+    mark_resources_imported(db.session, {},
+                            [o['resource_id'] for o in option_inserts])
+
+    db.session.delete(constructor)
+    db.session.add(RequiredOptionDescriptor(descriptor_id=descriptor.id))
+
+
+def _parse_row(data, registry):
+    """Return the descriptor values of a staged row as a list of
+    (descriptor, text) for text descriptors and (descriptor, list of option
+    indices) for option descriptors."""
+    cells = []
+    for key, value in data.iteritems():
+        if not key or key == 'Name' or key == 'Address':
+            continue
+        descriptor = registry.get_by_name(key)
+        if descriptor is None:
+            raise CsvSaveError('Unknown descriptor: ' + key)
+        if descriptor.is_text_descriptor:
+            cells.append((descriptor, value))
+        else:
+            opts = []
+            for s in value.split(';'):
+                index = descriptor.index_of(s.strip())
+                if index is not None and index not in opts:
+                    opts.append(index)
+            cells.append((descriptor, opts))
+    return cells
+
+
+def _row_hash(data, cells):
+    return content_hash(data['Name'], data['Address'], dict(
+        (descriptor.id, value if descriptor.is_text_descriptor else
+         sorted(value)) for descriptor, value in cells))
+
+
+def _no_progress(phase, rows_processed=0, rows_total=0):
+    pass
+
+
+def _insert_rows(table, rows):
+    for chunk in chunks(rows, WRITE_CHUNK_SIZE):
+        db.session.execute(table.insert(), chunk)
+
+
+def _compare_update(rows, registry, progress=_no_progress, offset=0,
+                    total=None):
+    """Compare rows of an update import with the resources they update.
+    Returns the mappings updating changed resources by id, without their
+    coordinates, the (data, cells, content hash) of new rows, the
+    (resource id, cells) of changed resources and the number of unchanged
+    rows."""
+    total = total or len(rows)
+    existing = {}
+    for chunk in chunks(set(r for _, r in rows if r)):
+        for resource_id, address, resource_hash in db.session.query(
+                Resource.id, Resource.address,
+                Resource.content_hash).filter(Resource.id.in_(chunk)):
+            existing[resource_id] = (address, resource_hash)
+    resource_updates = {}
+    new_rows = []
+    changed_rows = []
+    unchanged = 0
+    for i, (data, resource_id) in enumerate(rows):
+        if i % PROGRESS_INTERVAL == 0:
+            progress('comparing', offset + i, total)
+        cells = _parse_row(data, registry)
+        row_hash = _row_hash(data, cells)
+        if resource_id not in existing:
+            new_rows.append((data, cells, row_hash))
+            continue
+        address, resource_hash = existing[resource_id]
+        if resource_hash == row_hash:
+            unchanged += 1
+            continue
+        changed_rows.append((resource_id, cells))
+        resource_updates[resource_id] = {
+            'id': resource_id,
+            'content_hash': row_hash
+        }
+        if address != data['Address']:
+            resource_updates[resource_id]['address'] = data['Address']
+    return resource_updates, new_rows, changed_rows, unchanged
+
+
+def _association_changes(changed_rows, texts, options,
+                         progress=_no_progress, offset=0, total=None):
+    """Diff the cells of changed_rows, as (resource id, cells), with the
+    existing associations loaded by _existing_associations. Returns the
+    text associations to insert and to update and the option associations
+    to insert and the ids of those to delete."""
+    total = total or len(changed_rows)
+    text_inserts = []
+    text_updates = []
+    option_inserts = []
+    option_deletes = []
+    for i, (resource_id, cells) in enumerate(changed_rows):
+        if i % PROGRESS_INTERVAL == 0:
+            progress('writing', offset + i, total)
+        for descriptor, value in cells:
+            existing_key = (resource_id, descriptor.id)
+            if descriptor.is_text_descriptor:
+                existing_text = texts.get(existing_key)
+                if existing_text is None:
+                    text_inserts.append({
+                        'resource_id': resource_id,
+                        'descriptor_id': descriptor.id,
+                        'text': value
+                    })
+                # Just update text value if only text changed
+                elif existing_text[1] != value:
+                    text_updates.append({
+                        'id': existing_text[0],
+                        'text': value
+                    })
+            else:
+                existing_options = options.get(existing_key, [])
+                # If options differ, delete existing and add new ones
+                if set(value) != set(o for _, o in existing_options):
+                    option_deletes.extend(id for id, _ in existing_options)
+                    option_inserts.extend({
+                        'resource_id': resource_id,
+                        'descriptor_id': descriptor.id,
+                        'option': option
+                    } for option in value)
+    return text_inserts, text_updates, option_inserts, option_deletes
+
+
+def _save_update(rows, registry, geocodes, progress, offset=0, total=None):
+    """Write rows of an update import to the live catalog. offset is the
+    number of the first of rows and total the number of rows of the import,
+    for progress. Returns the counts of the rows."""
+    resource_updates, new_rows, changed_rows, unchanged = _compare_update(
+        rows, registry, progress, offset, total)
+    for update in resource_updates.itervalues():
+        if 'address' in update:
+            geocode = geocodes[update['address']]
+            update['latitude'] = geocode.latitude
+            update['longitude'] = geocode.longitude
+    _update(Resource, resource_updates.values())
+    new_resources = [{
+        'type': 'resource',
+        'name': data['Name'],
+        'address': data['Address'],
+        'latitude': geocodes[data['Address']].latitude,
+        'longitude': geocodes[data['Address']].longitude,
+        'content_hash': new_hash
+    } for data, _, new_hash in new_rows]
+    # Ids of new resources are needed for their associations
+    db.session.bulk_insert_mappings(Resource, new_resources,
+                                    return_defaults=True)
+    changed_rows.extend((resource['id'], cells) for resource, (_, cells, _)
+                        in zip(new_resources, new_rows))
+
+    texts, options = _existing_associations(resource_updates)
+    text_inserts, text_updates, option_inserts, option_deletes = \
+        _association_changes(changed_rows, texts, options, progress, offset,
+                             total)
+    _update(TextAssociation, text_updates)
+    _insert(TextAssociation, text_inserts)
+    _delete(OptionAssociation, option_deletes)
+    _insert(OptionAssociation, option_inserts)
+
+    # Bulk writes are not seen by the session's catalog tracking, so the
+    # written resources are recorded for the indexes to update
+    mark_resources_imported(db.session, dict(
+        (resource['id'], ('resource', resource['latitude'],
+                          resource['longitude']))
+        for resource in new_resources + resource_updates.values()
+        if 'latitude' in resource), resource_updates)
+    return {
+        'added': len(new_rows),
+        'modified': len(resource_updates),
+        'unchanged': unchanged,
+        'removed': 0
+    }
+
+
+def _reset_descriptors(csv_storage, constructor, offset):
+    """Descriptors of the catalog built by a reset import, with ids after
+    offset in the order of the CSV's columns so that they are the same if it
+    resumes."""
+    descriptors = [Descriptor(id=offset + i, name=desc.name,
+                              values=list(desc.values or []),
+                              is_searchable=True)
+                   for i, desc in enumerate(csv_storage.csv_descriptors, 1)]
+    if constructor is not None and \
+            constructor.name not in [d.name for d in descriptors]:
+        descriptors.append(Descriptor(
+            id=offset + len(descriptors) + 1,
+            name=constructor.name,
+            values=constructor.values,
+            is_searchable=True))
+    return descriptors
+
+
+def _descriptor_offset(tables):
+    """Return the number after which the descriptors of the next generation
+    are numbered: the one they were numbered from if they are written
+    already, e.g. when the import resumes, or the highest id of every
+    generation, so that descriptor ids are not reused."""
+    first_id = db.session.query(
+        db.func.min(tables['descriptors'].c.id)).scalar()
+    if first_id is not None:
+        return first_id - 1
+    return generation_max_id(db.session, 'descriptors')
+
+
+def _save_reset(rows, registry, tables, geocodes, progress, offset=0,
+                total=None):
+    """Write rows of a reset import to the next generation tables. Their
+    ids continue from the highest ids of every generation, including the
+    rows written before a checkpoint when the import resumes, so that no
+    id is reused from one catalog to the next."""
+    total = total or len(rows)
+    resources = []
+    text_inserts = []
+    option_inserts = []
+    # Other imports wait for these ids to be committed before numbering
+    # their own rows
+    CatalogGeneration.current(lock=True)
+    resource_id = generation_max_id(db.session, 'resources')
+    text_id = generation_max_id(db.session, 'text_associations')
+    option_id = generation_max_id(db.session, 'option_associations')
+    for i, (data, _) in enumerate(rows):
+        if i % PROGRESS_INTERVAL == 0:
+            progress('writing', offset + i, total)
+        cells = _parse_row(data, registry)
+        resource_id += 1
+        resources.append({
+            'id': resource_id,
+            'type': 'resource',
+            'name': data['Name'],
+            'address': data['Address'],
+            'latitude': geocodes[data['Address']].latitude,
+            'longitude': geocodes[data['Address']].longitude,
+            'rating_count': 0,
+            'rating_sum': 0,
+            'content_hash': _row_hash(data, cells)
+        })
+        for descriptor, value in cells:
+            if descriptor.is_text_descriptor:
+                text_id += 1
+                text_inserts.append({
+                    'id': text_id,
+                    'resource_id': resource_id,
+                    'descriptor_id': descriptor.id,
+                    'text': value
+                })
+            else:
+                for option in value:
+                    option_id += 1
+                    option_inserts.append({
+                        'id': option_id,
+                        'resource_id': resource_id,
+                        'descriptor_id': descriptor.id,
+                        'option': option
+                    })
+    _insert_rows(tables['resources'], resources)
+    _insert_rows(tables['text_associations'], text_inserts)
+    _insert_rows(tables['option_associations'], option_inserts)
+    return {'added': len(resources), 'modified': 0, 'unchanged': 0,
+            'removed': 0}
+
+
+def _finish_reset(registry, tables, constructor, counts):
+    """Add the values given for the resources missing the required option
+    descriptor to the next generation, and the number of live resources it
+    replaces to counts."""
+    required_id = -1
+    if constructor is not None:
+        descriptor = registry.get_by_name(constructor.name)
+        required_id = descriptor.id
+        resource = tables['resources']
+        resource_ids = dict(db.session.query(
+            resource.c.name, db.func.min(resource.c.id)).group_by(
+                resource.c.name))
+        option_id = generation_max_id(db.session, 'option_associations')
+        option_inserts = []
+        for name, values in (constructor.missing_dict or {}).iteritems():
+            for value in values if name in resource_ids else []:
+                option_id += 1
+                option_inserts.append({
+                    'id': option_id,
+                    'resource_id': resource_ids[name],
+                    'descriptor_id': descriptor.id,
+                    'option': descriptor.value_indices[value]
+                })
+        _insert_rows(tables['option_associations'], option_inserts)
+        db.session.delete(constructor)
+    _insert_rows(tables['required_option_descriptor'],
+                 [{'id': 1, 'descriptor_id': required_id}])
+
+    return dict(counts, removed=Resource.query.count())
+
+
+def _add_counts(counts, more):
+    return dict((key, counts.get(key, 0) + more[key]) for key in more)
+
+
+def _geocode(csv_storage, rows, geocode_many, progress, checkpoint):
+    """Resolve the addresses of rows, geocoding the ones not cached. With
+    checkpoint, they are geocoded in chunks stored one commit at a time,
+    from the row the last commit reached."""
+    addresses = [data['Address'] for data, _ in rows]
+    progress('geocoding', 0, len(rows))
+    if checkpoint is not None:
+        geocoded = csv_storage.get_checkpoint('geocoding')
+        start = geocoded.row_offset if geocoded else 0
+        for offset in range(start, len(addresses), CHECKPOINT_INTERVAL):
+            if offset:
+                progress('geocoding', offset, len(rows))
+            end = offset + CHECKPOINT_INTERVAL
+            GeocoderCache.resolve_many(addresses[offset:end], geocode_many)
+            checkpoint('geocoding', min(end, len(addresses)))
+    # Addresses geocoded before a checkpoint are read back from the cache
+    geocodes = GeocoderCache.resolve_many(addresses, geocode_many)
+    failed = sorted(set(address for address in addresses
+                        if geocodes[address].status != 'OK'))
+    if failed:
+        raise CsvSaveError('{} addresses cannot be geocoded: {}{}'.format(
+            len(failed), '; '.join(failed[:MAX_REPORTED_ADDRESSES]),
+            '...' if len(failed) > MAX_REPORTED_ADDRESSES else ''))
+    return geocodes
+
+
+def _save_update_storage(csv_storage, rows, geocode_many, progress,
+                         checkpoint):
+    """Save an update import. Only geocoding is checkpointed: the catalog is
+    written at the end, in the transaction of the caller, so that readers
+    never see an update partly applied. A save restarted after a failure
+    writes all rows again, but content hashes make that cheap."""
+    geocodes = _geocode(csv_storage, rows, geocode_many, progress, checkpoint)
+    progress('descriptors')
+    _write_descriptors(csv_storage)
+    registry = DescriptorRegistry(Descriptor.query.order_by(Descriptor.id))
+    counts = _save_update(rows, registry, geocodes, progress)
+    progress('finishing', len(rows), len(rows))
+    RequiredOptionDescriptor.query.delete()
+    _write_required_option_descriptor(registry)
+    return counts
+
+
+def _save_reset_storage(csv_storage, rows, geocode_many, progress,
+                        checkpoint):
+    """Save a reset import. The new catalog is built in next generation
+    tables of its own, which readers and other imports do not see, so
+    chunks of rows can be committed at checkpoints. It is published by the
+    caller."""
+    saved = csv_storage.get_checkpoint('saving')
+    start = saved.row_offset if saved else 0
+    counts = dict(saved.counts or {}) if saved else {}
+
+    progress('descriptors')
+    constructor = RequiredOptionDescriptorConstructor.query.first()
+    if saved is None:
+        tables = create_next_generation(db.session, csv_storage.id)
+    else:
+        tables = next_generation_tables(db.session, csv_storage.id)
+    descriptors = _reset_descriptors(csv_storage, constructor,
+                                     _descriptor_offset(tables))
+    registry = DescriptorRegistry(descriptors)
+    if saved is None:
+        _insert_rows(tables['descriptors'], [{
+            'id': d.id,
+            'name': d.name,
+            'values': d.values,
+            'is_searchable': d.is_searchable
+        } for d in descriptors])
+        if checkpoint is not None:
+            # Descriptors are written once, before the first chunk of rows
+            checkpoint('saving', 0, counts)
+
+    geocodes = _geocode(csv_storage, rows, geocode_many, progress, checkpoint)
+
+    interval = CHECKPOINT_INTERVAL if checkpoint is not None else len(rows)
+    for offset in range(start, len(rows), interval or 1):
+        chunk = rows[offset:offset + interval]
+        more = _save_reset(chunk, registry, tables, geocodes, progress,
+                           offset, len(rows))
+        counts = _add_counts(counts, more)
+        if checkpoint is not None:
+            checkpoint('saving', offset + len(chunk), counts)
+
+    progress('finishing', len(rows), len(rows))
+    return _finish_reset(registry, tables, constructor, counts)
+
+
+def save_csv_storage(csv_storage, geocode_many, progress=None,
+                     checkpoint=None):
+    """
+    Write the resources and descriptors staged in csv_storage to the
+    catalog in the current transaction, without committing, and delete
+    csv_storage. Addresses missing from the geocoder cache are geocoded
+    with geocode_many.
+
+    Descriptors are resolved once, the existing associations of updated
+    resources are loaded with a few chunked queries, and rows are written
+    with executemany in chunks rather than as ORM objects. Updates skip the
+    resources whose content hash matches their row, and record the
+    resources they write so that catalog indexes are updated for those
+    only. Resets build the new catalog in next generation tables of their
+    own and publish it by renaming them to the live tables as the last step
+    of the save. Readers and writers of the catalog wait for the
+    transaction to commit from then on.
+
+    If given, progress is called as progress(phase, rows_processed,
+    rows_total) as the save goes on.
+
+    If given, checkpoint is called as checkpoint(phase, row_offset, counts)
+    after every CHECKPOINT_INTERVAL rows geocoded ('geocoding') or, for
+    resets, saved to the next generation ('saving'), and must commit them
+    with the work done so far. The save then resumes from the checkpoints
+    of csv_storage when it is run again. Updates write the live catalog
+    only in the final transaction.
+
+    Returns a dict with the number of resources 'added', 'modified',
+    'unchanged' and 'removed'.
+    """
+    progress = progress or _no_progress
+    rows = [(data, resource_id)
+            for _, data, resource_id in csv_storage.iter_rows()]
+    update = csv_storage.action == 'update'
+    if update:
+        counts = _save_update_storage(csv_storage, rows, geocode_many,
+                                      progress, checkpoint)
+    else:
+        counts = _save_reset_storage(csv_storage, rows, geocode_many,
+                                     progress, checkpoint)
+    csv_storage_id = csv_storage.id
+    CsvRowBlock.query.filter_by(csv_storage_id=csv_storage_id).delete()
+    db.session.delete(csv_storage)
+    db.session.flush()
+    # Next generations of imports discarded before they were saved
+    abandoned = next_generation_ids(db.session) - set(
+        id for id, in db.session.query(CsvStorage.id))
+    for job_id in abandoned - set([csv_storage_id]):
+        drop_next_generation(db.session, job_id)
+    if not update:
+        # The live tables are locked from the switch until the commit, so
+        # nothing else is left to do by then
+        progress('publishing')
+        publish_next_generation(db.session, csv_storage_id)
+    return dict((key, counts.get(key, 0))
+                for key in ('added', 'modified', 'unchanged', 'removed'))
+
+
+def _planned_registry(csv_storage):
+    """Registry of the descriptors an update import would leave, without
+    writing them: existing descriptors with the CSV's new option values
+    appended, as _write_descriptors does, and new ones with negative
+    ids."""
+    remove_ids = set(desc.descriptor_id
+                     for desc in csv_storage.csv_descriptors_remove)
+    descriptors = dict((d.id, d) for d in Descriptor.query
+                       if d.id not in remove_ids)
+    new_id = 0
+    for desc in csv_storage.csv_descriptors:
+        existing_descriptor = descriptors.get(desc.descriptor_id)
+        if existing_descriptor is None:
+            new_id -= 1
+            descriptors[new_id] = Descriptor(
+                id=new_id, name=desc.name, values=list(desc.values or []))
+        elif desc.descriptor_type == 'option':
+            values = list(existing_descriptor.values or [])
+            values.extend(sorted(set(desc.values or []) - set(values)))
+            descriptors[desc.descriptor_id] = Descriptor(
+                id=existing_descriptor.id, name=existing_descriptor.name,
+                values=values)
+    return DescriptorRegistry(descriptors[id] for id in sorted(descriptors))
+
+
+def _count_associations(descriptor_ids=None):
+    count = 0
+    for model in (TextAssociation, OptionAssociation):
+        query = db.session.query(db.func.count(model.id))
+        if descriptor_ids is not None:
+            query = query.filter(model.descriptor_id.in_(descriptor_ids))
+        count += query.scalar()
+    return count
+
+
+def plan_csv_storage(csv_storage, geocoding_service=None):
+    """
+    Work out what save_csv_storage would do with csv_storage without
+    writing anything or geocoding. The staged rows are compared with the
+    catalog as they would be by the save, with chunked queries of the
+    resources and associations they change, and the associations removed
+    are counted by COUNT queries.
+
+    Returns a dict with:
+    - 'rows': the number of staged rows
+    - 'resources': the number of resources 'added', 'modified',
+      'unchanged' and 'removed', as save_csv_storage returns them
+    - 'associations': the number of associations 'inserted', 'updated'
+      and 'deleted'
+    - 'geocoding': the number of distinct 'addresses', of those 'cached',
+      of those 'to_geocode', each using one request of quota, of the cached
+      ones that 'failed' and would stop the save, and the 'seconds'
+      geocoding is estimated to take with geocoding_service, by default the
+      app's
+    """
+    geocoding_service = geocoding_service or get_geocoding_service()
+    constructor = RequiredOptionDescriptorConstructor.query.first()
+    rows = [(data, resource_id)
+            for _, data, resource_id in csv_storage.iter_rows()]
+
+    if csv_storage.action == 'update':
+        registry = _planned_registry(csv_storage)
+        resource_updates, new_rows, changed_rows, unchanged = \
+            _compare_update(rows, registry)
+        texts, options = _existing_associations(resource_updates)
+        # New resources have no associations yet
+        changed_rows.extend((None, cells) for _, cells, _ in new_rows)
+        text_inserts, text_updates, option_inserts, option_deletes = \
+            _association_changes(changed_rows, texts, options)
+        inserted = len(text_inserts) + len(option_inserts)
+        updated = len(text_updates)
+        remove_ids = [desc.descriptor_id
+                      for desc in csv_storage.csv_descriptors_remove]
+        deleted = len(option_deletes) + (
+            _count_associations(remove_ids) if remove_ids else 0)
+        resources = {
+            'added': len(new_rows),
+            'modified': len(resource_updates),
+            'unchanged': unchanged,
+            'removed': 0
+        }
+        names = set(Resource.name_ids()) | set(
+            data['Name'] for data, _, _ in new_rows)
+    else:
+        registry = DescriptorRegistry(
+            _reset_descriptors(csv_storage, constructor, 0))
+        inserted = 0
+        for data, _ in rows:
+            for descriptor, value in _parse_row(data, registry):
+                inserted += 1 if descriptor.is_text_descriptor else \
+                    len(value)
+        updated = 0
+        deleted = _count_associations()
+        resources = {
+            'added': len(rows),
+            'modified': 0,
+            'unchanged': 0,
+            'removed': Resource.query.count()
+        }
+        names = set(data['Name'] for data, _ in rows)
+
+    # Values given for the resources missing the required option
+    if constructor is not None:
+        inserted += sum(len(values) for name, values in
+                        (constructor.missing_dict or {}).iteritems()
+                        if name in names)
+
+    addresses = set(data['Address'] for data, _ in rows)
+    cached = GeocoderCache.lookup_many(addresses)
+    to_geocode = len(set(normalize_address(a) for a in addresses
+                         if a not in cached))
+    return {
+        'rows': len(rows),
+        'resources': resources,
+        'associations': {
+            'inserted': inserted,
+            'updated': updated,
+            'deleted': deleted
+        },
+        'geocoding': {
+            'addresses': len(addresses),
+            'cached': len(cached),
+            'to_geocode': to_geocode,
+            'failed': sum(1 for geocode in cached.itervalues()
+                          if geocode.status != 'OK'),
+            'seconds': geocoding_service.estimate_seconds(to_geocode)
+        }
+    }
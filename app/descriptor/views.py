@@ -12,7 +12,8 @@ from forms import (AddDescriptorOptionValueForm,
 
 from . import descriptor
 from .. import db
-from ..models import (Descriptor, OptionAssociation, RequiredOptionDescriptor,
+from ..models import (Descriptor, OptionAssociation, RegisteredDescriptor,
+                      RequiredOptionDescriptor,
                       RequiredOptionDescriptorConstructor, Resource)
 
 
@@ -392,36 +393,40 @@ def change_required_option_descriptor():
     '/review-required-option-descriptor', methods=['GET', 'POST'])
 @login_required
 def review_required_option_descriptor():
-    req_opt_desc_const = RequiredOptionDescriptorConstructor.query.all()[0]
+    req_opt_desc_const = RequiredOptionDescriptorConstructor.query.first()
+    descriptor = None
+    if req_opt_desc_const is not None:
+        descriptor = Descriptor.query.filter_by(
+            name=req_opt_desc_const.name).first()
+    if descriptor is None:
+        flash('There is no required option descriptor to review.', 'error')
+        return redirect(url_for('descriptor.index'))
     form = RequiredOptionDescriptorMissingForm()
-    missing_resources = []
-    resources = Resource.query.all()
-    descriptor = Descriptor.query.filter_by(
-        name=req_opt_desc_const.name).first()
-    for r in resources:
-        if descriptor is None:
-            missing_resources.append(r.name)
-        else:
-            option_association = OptionAssociation.query.filter_by(
-                resource_id=r.id, descriptor_id=descriptor.id).first()
-            if option_association is None:
-                missing_resources.append(r.name)
+    # Resources without an association with the descriptor, found once per
+    # choice of descriptor
+    if req_opt_desc_const.missing_names is None:
+        req_opt_desc_const.missing_names = [
+            name for _, name in Resource.missing_option(
+                descriptor.id).order_by(Resource.id)]
+        db.session.commit()
+    missing_resources = req_opt_desc_const.missing_names
     if request.method == 'POST':
         if len(form.resources.data) < len(missing_resources):
             flash('Error: You must choose an option for each resource.'
                   'Please try again.', 'form-error')
         else:
+            resource_ids = {}
+            for resource_id, name in Resource.missing_option(
+                    descriptor.id).order_by(Resource.id.desc()):
+                resource_ids[name] = resource_id
+            value_indices = RegisteredDescriptor(descriptor).value_indices
             for j, r_name in enumerate(missing_resources):
-                resource = Resource.query.filter_by(name=r_name).first()
-                if resource is not None:
+                if r_name in resource_ids:
                     for val in form.resources.data[j]:
-                        new_association = OptionAssociation(
-                            resource_id=resource.id,
+                        db.session.add(OptionAssociation(
+                            resource_id=resource_ids[r_name],
                             descriptor_id=descriptor.id,
-                            option=descriptor.values.index(val),
-                            resource=resource,
-                            descriptor=descriptor)
-                        db.session.add(new_association)
+                            option=value_indices[val]))
             RequiredOptionDescriptor.query.delete()
             req_opt_desc = RequiredOptionDescriptor(
                 descriptor_id=descriptor.id)
@@ -0,0 +1,203 @@
+import hashlib
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+import geocoder
+from flask import current_app
+
+# Result of geocoding an address. status is 'OK' if latlng is set, otherwise
+# the reason it could not be geocoded.
+GeocodeResult = namedtuple('GeocodeResult', ['status', 'latlng'])
+
+# Statuses meaning that the key used has run out of quota, or cannot be used
+QUOTA_STATUSES = ('OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT', 'REQUEST_DENIED')
+# Typical seconds taken by one request to a geocoding API, for estimates
+REQUEST_LATENCY = 0.2
+
+
+def is_transient(status):
+    """Whether a failure to geocode may not happen again, e.g. because of
+    quota or a network error, rather than being caused by the address."""
+    return status in QUOTA_STATUSES or status == 'UNKNOWN_ERROR' or \
+        status.startswith('ERROR')
+
+
+def google_backend(address, key):
+    """Geocode address with the Google geocoding API."""
+    g = geocoder.google(address, key=key)
+    return GeocodeResult(g.status, g.latlng if g.status == 'OK' else None)
+
+
+class StubBackend(object):
+    """
+    Local stand-in for a geocoding API, for tests, benchmarks and
+    development. Every address is placed at a fixed point derived from its
+    text after waiting latency seconds. Addresses containing 'invalid' give
+    ZERO_RESULTS.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def __call__(self, address, key):
+        if self.latency:
+            time.sleep(self.latency)
+        if 'invalid' in address.lower():
+            return GeocodeResult('ZERO_RESULTS', None)
+        digest = hashlib.md5(address.encode('utf-8')).digest()
+        lat = ord(digest[0]) / 255.0 * 180 - 90
+        lng = ord(digest[1]) / 255.0 * 360 - 180
+        return GeocodeResult('OK', [lat, lng])
+
+
+BACKENDS = {'google': google_backend, 'stub': StubBackend()}
+
+_service_lock = Lock()
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, in bursts of up to capacity
+    requests. Not thread-safe on its own; KeyPool holds a lock around it.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self):
+        """Take a token if one is available and return 0, otherwise return
+        the number of seconds until one is."""
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ApiKey(object):
+    def __init__(self, key, rate, clock=time.time):
+        self.key = key
+        self.bucket = TokenBucket(rate, clock=clock)
+        # Time until which the key is out of quota
+        self.exhausted_until = 0
+
+
+class KeyPool(object):
+    """
+    Rotates over a pool of API keys, each rate limited by its own token
+    bucket. Keys that run out of quota are left out for cooldown seconds.
+    """
+
+    def __init__(self, keys, rate, cooldown=3600, clock=time.time,
+                 sleep=time.sleep):
+        # A backend without keys is still rate limited
+        self.keys = [ApiKey(k, rate, clock) for k in keys or [None]]
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = Lock()
+        self.next_index = 0
+
+    def acquire(self):
+        """Wait until a key has quota left and return it, or return None if
+        every key is out of quota."""
+        while True:
+            with self.lock:
+                now = self.clock()
+                wait = None
+                for i in range(len(self.keys)):
+                    index = (self.next_index + i) % len(self.keys)
+                    key = self.keys[index]
+                    if key.exhausted_until > now:
+                        continue
+                    key_wait = key.bucket.take()
+                    if key_wait == 0:
+                        self.next_index = (index + 1) % len(self.keys)
+                        return key
+                    wait = key_wait if wait is None else min(wait, key_wait)
+                if wait is None:
+                    return None
+            self.sleep(wait)
+
+    def exhaust(self, key):
+        with self.lock:
+            key.exhausted_until = self.clock() + self.cooldown
+
+
+class GeocodingService(object):
+    """
+    Geocodes addresses with a backend, called as backend(address, key), on
+    a bounded pool of threads. Requests are spread over a pool of API keys
+    at up to rate requests per second per key. When a key runs out of
+    quota, the address is retried with the next key.
+    """
+
+    def __init__(self, backend, keys=None, rate=10, workers=8,
+                 cooldown=3600):
+        self.backend = backend
+        self.key_pool = KeyPool(keys, rate, cooldown)
+        self.workers = workers
+
+    def geocode(self, address):
+        """Return the GeocodeResult for address."""
+        for _ in range(len(self.key_pool.keys)):
+            key = self.key_pool.acquire()
+            if key is None:
+                break
+            try:
+                result = self.backend(address, key.key)
+            except Exception as e:
+                return GeocodeResult('ERROR: {}'.format(e), None)
+            if result.status not in QUOTA_STATUSES:
+                return result
+            self.key_pool.exhaust(key)
+        return GeocodeResult('OVER_QUERY_LIMIT', None)
+
+    def estimate_seconds(self, count, latency=REQUEST_LATENCY):
+        """Estimated seconds to geocode count addresses: the longer of the
+        time the keys' rate limits allow and the time the pool of threads
+        takes at latency seconds per request."""
+        if not count:
+            return 0.0
+        rate = sum(key.bucket.rate for key in self.key_pool.keys)
+        return max(count / rate, count * latency / self.workers)
+
+    def geocode_many(self, addresses):
+        """Geocode addresses in parallel and return a dict from each
+        address to its GeocodeResult."""
+        addresses = list(set(addresses))
+        if len(addresses) <= 1:
+            return dict((a, self.geocode(a)) for a in addresses)
+        pool = ThreadPool(min(self.workers, len(addresses)))
+        try:
+            results = pool.map(self.geocode, addresses)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(addresses, results))
+
+
+def get_geocoding_service():
+    """Return the geocoding service configured for the current app. It is
+    created once per app so that rate limits are shared by all requests."""
+    app = current_app._get_current_object()
+    with _service_lock:
+        service = app.extensions.get('geocoding_service')
+        if service is None:
+            backend = app.config['GEOCODER_BACKEND']
+            service = GeocodingService(
+                BACKENDS.get(backend, backend),
+                keys=app.config['GEOCODER_API_KEYS'],
+                rate=app.config['GEOCODER_RATE_PER_KEY'],
+                workers=app.config['GEOCODER_WORKERS'])
+            app.extensions['geocoding_service'] = service
+    return service
@@ -2,7 +2,8 @@ import json
 import os
 from datetime import datetime
 
-from flask import jsonify, redirect, render_template, request, url_for
+from flask import (Response, jsonify, redirect, render_template, request,
+                   stream_with_context, url_for)
 from flask.ext.login import login_required
 # from twilio import twiml
 from twilio.rest import TwilioRestClient
@@ -12,8 +13,9 @@ from app import csrf
 
 from . import main
 from .. import db
-from ..models import (Descriptor, EditableHTML, OptionAssociation, Rating,
-                      RequiredOptionDescriptor, Resource)
+from ..models import (CatalogVersion, DescriptorRegistry, EditableHTML,
+                      OptionIndex, Rating, Resource, ResourceAssociations,
+                      ResourceLocator, SearchIndex)
 
 
 @main.route('/')
@@ -74,42 +76,49 @@ def city_view(city_name):
         category_icons=category_icons)
 
 
+def generate_catalog_json():
+    """Yield the full catalog as a JSON array, a resource at a time."""
+    separator = ''
+    yield '['
+    for resource_as_dict in Resource.iter_resources_as_full_dicts():
+        yield separator + json.dumps(resource_as_dict)
+        separator = ', '
+    yield ']'
+
+
 @main.route('/get-resources')
 def get_resources():
-    resources = Resource.query.all()
-    resources_as_dicts = Resource.get_resources_as_full_dicts(resources)
-    return json.dumps(resources_as_dicts)
+    # The catalog is streamed rather than built in memory. Its ETag is the
+    # catalog version, read before streaming so that the payload is at least
+    # as recent, and clients that already have it get a 304 response.
+    response = Response(stream_with_context(generate_catalog_json()))
+    response.set_etag('catalog-%d' % CatalogVersion.current())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
-@main.route('/search-resources')
-def search_resources():
-    name = request.args.get('name')
-    if name is None:
-        name = ""
-    req_options = request.args.getlist('reqoption')
-    if req_options is None:
-        req_options = []
-    # case insensitive search
-    resource_pool = Resource.query.filter(
-        Resource.name.ilike('%{}%'.format(name))).all()
-    req_opt_desc = RequiredOptionDescriptor.query.all()
-    if req_opt_desc:
-        req_opt_desc = req_opt_desc[0]
-        req_opt_desc = Descriptor.query.filter_by(
-            id=req_opt_desc.descriptor_id).first()
-    resources = []
-    if req_opt_desc and len(req_options) > 0:
-        int_req_options = []
-        for o in req_options:
-            int_req_options.append(req_opt_desc.values.index(str(o)))
-        for resource in resource_pool:
-            associations = OptionAssociation.query.filter_by(
-                resource_id=resource.id, descriptor_id=req_opt_desc.id)
-            for a in associations:
-                if a.option in int_req_options:
-                    resources.append(resource)
-                    break
-    opt_options = request.args.getlist('optoption')
+def option_filter_matches(args):
+    """Return the set of ids of resources matching the required option
+    ('reqoption') and option ('optoption') filters in args, or None if no
+    filter was given."""
+    req_options = args.getlist('reqoption')
+    registry = DescriptorRegistry.get()
+    req_opt_desc = registry.required_option_descriptor
+    option_index = OptionIndex.get()
+    # Sets of ids of resources matching each filter
+    option_filters = []
+    if len(req_options) > 0:
+        if req_opt_desc:
+            int_req_options = [
+                req_opt_desc.index_of(str(o)) for o in req_options
+                if req_opt_desc.index_of(str(o)) is not None
+            ]
+            option_filters.append(
+                option_index.resources_with_any(req_opt_desc.id,
+                                                int_req_options))
+        else:
+            option_filters.append(set())
+    opt_options = args.getlist('optoption')
     option_map = {}
     # Create a dict, option_map, that maps from option names to a list
     # of user selected values
@@ -123,51 +132,104 @@ def search_resources():
                 else:
                     option_map[key_val[0]] = [key_val[1]]
 
-    # descriptors = Descriptor.query.all()
-    new_pool = resource_pool
-    if len(req_options) > 0:
-        new_pool = resources
-        resources = []
-    # Iterate through resources and check that there's a match for
-    # all of the options
-    # that the user selected. If there is, add that resource to the
-    # list of resources
-    for resource in new_pool:
-        number_of_options_found = 0
-        for opt in option_map.keys():
-            opt_descriptors = OptionAssociation.query.filter_by(
-                resource_id=resource.id)
-            for desc in opt_descriptors:
-                if desc.descriptor.name == opt:
-                    if desc.descriptor.values[desc.option] in option_map[opt]:
-                        number_of_options_found += 1
-                        break
-        if number_of_options_found == len(option_map.keys()):
-            resources.append(resource)
+    # A resource must have at least one of the user selected values for
+    # every option the user selected.
+    for opt, values in option_map.iteritems():
+        descriptor = registry.get_by_name(opt)
+        if descriptor is None or not descriptor.is_option_descriptor:
+            option_filters.append(set())
+            continue
+        int_options = [
+            descriptor.index_of(v) for v in values
+            if descriptor.index_of(v) is not None
+        ]
+        option_filters.append(
+            option_index.resources_with_any(descriptor.id, int_options))
+    return OptionIndex.resources_with_all(option_filters)
+
+
+@main.route('/search-resources')
+def search_resources():
+    # Ids of resources matching the name query, best match first
+    ranked_ids = SearchIndex.search(request.args.get('name'))
+    matches = option_filter_matches(request.args)
+    if ranked_ids is None:
+        resources = [
+            r for r in Resource.query.all()
+            if matches is None or r.id in matches
+        ]
+    else:
+        resources = SearchIndex.resources([
+            resource_id for resource_id in ranked_ids
+            if matches is None or resource_id in matches
+        ])
+    resources_as_dicts = Resource.get_resources_as_dicts(resources)
+    return json.dumps(resources_as_dicts)
+
+
+@main.route('/resources/near')
+def resources_near():
+    """Resources closest to a point, nearest first. Takes 'lat' and 'long',
+    and 'k' (at most 100) and/or 'radius' in km, plus the option filters of
+    /search-resources. Each resource has its 'distance' in km."""
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('long', type=float)
+    radius = request.args.get('radius', type=float)
+    k = request.args.get('k', type=int)
+    # Comparisons with nan are false, so it fails these checks like inf
+    if lat is None or lng is None or not -90 <= lat <= 90 or \
+            not -180 <= lng <= 180:
+        return jsonify(
+            status='error',
+            message='lat and long are required, with lat between -90 and 90 '
+            'and long between -180 and 180'), 400
+    if radius is not None and not 0 <= radius < float('inf'):
+        return jsonify(
+            status='error',
+            message='radius must be a finite number of km, at least 0'), 400
+    if k is None and radius is None:
+        k = 10
+    if k is not None:
+        k = max(1, min(k, 100))
+
+    matches = option_filter_matches(request.args)
+    accept = None if matches is None else matches.__contains__
+    if k is None:
+        nearest = ResourceLocator.within(lat, lng, radius, accept)
+    else:
+        nearest = ResourceLocator.nearest(lat, lng, k, radius, accept)
+
+    distances = dict((resource_id, d) for d, resource_id in nearest)
+    resources = []
+    if distances:
+        resources = Resource.query.filter(
+            Resource.id.in_(distances.keys())).all()
+    resources.sort(key=lambda r: distances[r.id])
     resources_as_dicts = Resource.get_resources_as_dicts(resources)
+    for res in resources_as_dicts:
+        res['distance'] = round(distances[res['id']], 3)
     return json.dumps(resources_as_dicts)
 
 
 @main.route('/get-associations/<int:resource_id>')
 def get_associations(resource_id):
-    resource = Resource.query.get(resource_id)
-    associations = {}
-    if resource is None:
-        return json.dumps(associations)
-    for td in resource.text_descriptors:
-        associations[td.descriptor.name] = td.text
-    for od in resource.option_descriptors:
-        val = od.descriptor.values[od.option]
-        values = set()
-        # multiple option association values
-        if associations.get(od.descriptor.name):
-            curr = associations.get(od.descriptor.name)
-            curr.append(val)
-            values = set(curr)
-        else:
-            values.add(val)
-        associations[od.descriptor.name] = list(values)
-    return json.dumps(associations)
+    associations = ResourceAssociations.get(resource_id)
+    return json.dumps(associations or {})
+
+
+@main.route('/get-associations')
+def get_associations_batch():
+    """Associations of many resources, by id. Takes 'ids', a comma separated
+    list of resource ids, and returns an object mapping each id to the same
+    object /get-associations/<id> returns for it."""
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        return jsonify(
+            status='error', message='ids must be a list of integers'), 400
+    associations = ResourceAssociations.get_many(ids)
+    return json.dumps(dict((resource_id, a or {})
+                           for resource_id, a in associations.iteritems()))
 
 
 @main.route('/overview')
@@ -227,19 +289,15 @@ def post_rating():
         star_rating = request.json['rating']
         comment = request.json['review']
         resourceID = request.json['id']
-        if comment and star_rating:
-            rating = Rating(
-                submission_time=time,
-                rating=star_rating,
-                review=comment,
-                resource_id=resourceID)
-            db.session.add(rating)
-            db.session.commit()
-        elif star_rating:
+        if star_rating:
             rating = Rating(
                 submission_time=time,
                 rating=star_rating,
                 resource_id=resourceID)
+            if comment:
+                rating.review = comment
+            # The resource's rating aggregates are updated in the same
+            # transaction when the rating is flushed
             db.session.add(rating)
             db.session.commit()
     return jsonify(status='success')
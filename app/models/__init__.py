@@ -10,5 +10,14 @@ from resource import *  # flake8: noqa
 from suggestion import *  # flake8: noqa
 from user import *  # flake8: noqa
 from contact_category import *  # flake8: noqa
+from column_stats import *  # flake8: noqa
 from csv import *  # flake8: noqa
 from geocoder_cache import *  # flake8: noqa
+from catalog import *  # flake8: noqa
+from option_index import *  # flake8: noqa
+from descriptor_registry import *  # flake8: noqa
+from spatial_index import *  # flake8: noqa
+from search_index import *  # flake8: noqa
+from association_cache import *  # flake8: noqa
+from resource_hash import *  # flake8: noqa
+from catalog_generation import *  # flake8: noqa
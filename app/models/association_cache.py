@@ -0,0 +1,92 @@
+from ..models.catalog import CatalogCache
+from ..models.descriptor_registry import DescriptorRegistry
+from ..models.resource import (Descriptor, OptionAssociation, Resource,
+                               ResourceBase, TextAssociation)
+from ..utils import chunks
+
+
+class ResourceAssociations(object):
+    """
+    Per-process cache of the associations of approved resources, as a dict
+    from descriptor name to text, or to the list of selected values for
+    option descriptors. Entries are loaded on demand, for any number of
+    resources with one query per association table, and are dropped when a
+    transaction committed by this process writes to their resource.
+    """
+
+    def __init__(self):
+        # Catalog version of the last transaction applied by update
+        self.version = None
+        self.entries = {}
+
+    @staticmethod
+    def build():
+        return ResourceAssociations()
+
+    @staticmethod
+    def update(cache, changes):
+        if changes.has_bulk_writes(ResourceBase, OptionAssociation,
+                                   TextAssociation, Descriptor) or \
+                Descriptor in changes.changed_models:
+            return False
+        for resource_id in set(changes.resources) | \
+                changes.deleted_resource_ids | changes.touched_resource_ids:
+            cache.entries.pop(resource_id, None)
+        cache.version = changes.version
+        return True
+
+    @staticmethod
+    def get_many(ids):
+        """Return a dict from each of ids to the associations of the
+        resource, or to None if there is no approved resource with that
+        id."""
+        cache = _resource_associations_cache.get()
+        with _resource_associations_cache.lock:
+            version = cache.version
+            found = dict((i, cache.entries[i]) for i in ids
+                         if i in cache.entries)
+        missing = [i for i in set(ids) if i not in found]
+        for chunk in chunks(missing):
+            loaded = ResourceAssociations.load(chunk)
+            with _resource_associations_cache.lock:
+                # Entries loaded before a write was applied may be stale
+                if cache.version == version:
+                    cache.entries.update(loaded)
+            found.update(loaded)
+        return dict((i, found.get(i)) for i in ids)
+
+    @staticmethod
+    def get(resource_id):
+        return ResourceAssociations.get_many([resource_id])[resource_id]
+
+    @staticmethod
+    def load(ids):
+        """Query the associations of the approved resources with the given
+        ids."""
+        registry = DescriptorRegistry.get()
+        entries = dict(
+            (resource_id, {})
+            for resource_id, in Resource.query.with_entities(
+                Resource.id).filter(Resource.id.in_(ids)))
+        if not entries:
+            return entries
+        ids = list(entries)
+        for td in TextAssociation.query.filter(
+                TextAssociation.resource_id.in_(ids)).order_by(
+                    TextAssociation.id):
+            descriptor = registry.get_by_id(td.descriptor_id)
+            entries[td.resource_id][descriptor.name] = td.text
+        for od in OptionAssociation.query.filter(
+                OptionAssociation.resource_id.in_(ids)).order_by(
+                    OptionAssociation.id):
+            descriptor = registry.get_by_id(od.descriptor_id)
+            values = entries[od.resource_id].setdefault(descriptor.name, [])
+            # multiple option association values
+            value = descriptor.values[od.option]
+            if value not in values:
+                values.append(value)
+        return entries
+
+
+_resource_associations_cache = CatalogCache(ResourceAssociations.build,
+                                            ResourceAssociations.update)
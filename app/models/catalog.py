@@ -0,0 +1,270 @@
+from itertools import chain
+from threading import RLock
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from .. import db
+from ..models.resource import (Descriptor, OptionAssociation,
+                               RequiredOptionDescriptor, ResourceBase,
+                               TextAssociation)
+
+# Models whose rows make up the public catalog. Any write to one of these
+# bumps the catalog version. Ratings are left out: their aggregates on
+# resources are written without the ORM and are not served with the
+# catalog, so posting a rating keeps the caches built from it.
+CATALOG_MODELS = (ResourceBase, OptionAssociation, TextAssociation, Descriptor,
+                  RequiredOptionDescriptor)
+
+
+class CatalogVersion(db.Model):
+    """
+    Single row counting the committed transactions that wrote to the catalog.
+    It is bumped just before the writing transaction commits, so every
+    process can tell whether a cache built from the catalog is still current
+    with one lookup, and the row is only locked for the end of the commit.
+    """
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+
+    @staticmethod
+    def current():
+        version = db.session.query(CatalogVersion.version).filter_by(
+            id=1).scalar()
+        return version or 0
+
+    @staticmethod
+    def bump(session):
+        """Increment the version in the transaction of session and return
+        the new version."""
+        table = CatalogVersion.__table__
+        increment = table.update().where(table.c.id == 1).values(
+            version=table.c.version + 1)
+        if session.execute(increment).rowcount == 0:
+            # Tables created before the row was seeded with them
+            statement = _SEED_STATEMENTS.get(session.bind.dialect.name)
+            if statement is None:
+                session.execute(table.insert().values(id=1, version=0))
+            else:
+                session.execute(statement)
+            session.execute(increment)
+        return session.execute(
+            select([table.c.version]).where(table.c.id == 1)).scalar()
+
+
+# Inserts of the version row that do nothing if another transaction
+# inserted it first
+_SEED_STATEMENTS = {
+    'postgresql': 'INSERT INTO catalog_version (id, version) VALUES (1, 0) '
+                  'ON CONFLICT DO NOTHING',
+    'sqlite': 'INSERT OR IGNORE INTO catalog_version (id, version) '
+              'VALUES (1, 0)'
+}
+
+
+@event.listens_for(CatalogVersion.__table__, 'after_create')
+def _seed_catalog_version(target, connection, **kw):
+    connection.execute(target.insert().values(id=1, version=0))
+
+
+class CatalogChanges(object):
+    """
+    Writes made to the catalog by one transaction. Once the transaction
+    commits it is passed to the listeners registered with on_catalog_commit,
+    so in-memory indexes can be updated instead of rebuilt.
+    """
+
+    def __init__(self):
+        # Catalog version after the transaction, set when it commits
+        self.version = None
+        self.changed_models = set()
+        # Models written without the ORM knowing which rows changed, e.g.
+        # with Query.delete(). None stands for unknown models.
+        self.bulk_models = set()
+        # id -> (type, latitude, longitude) of inserted or updated resources
+        self.resources = {}
+        self.deleted_resource_ids = set()
+        # Ids of resources whose associations were written
+        self.touched_resource_ids = set()
+        # Ids of resources written by a CSV import, which match their row
+        self.imported_resource_ids = set()
+        # Ids of descriptors made searchable or not, or deleted while
+        # searchable
+        self.searchable_descriptor_ids = set()
+
+    def record(self, obj, deleted=False):
+        self.changed_models.add(type(obj))
+        if isinstance(obj, ResourceBase):
+            if deleted:
+                self.resources.pop(obj.id, None)
+                self.deleted_resource_ids.add(obj.id)
+            else:
+                self.resources[obj.id] = (obj.type, obj.latitude,
+                                          obj.longitude)
+        elif isinstance(obj, (OptionAssociation, TextAssociation)):
+            self.touched_resource_ids.add(obj.resource_id)
+        elif isinstance(obj, Descriptor):
+            if deleted:
+                if obj.is_searchable:
+                    self.searchable_descriptor_ids.add(obj.id)
+            elif inspect(obj).attrs.is_searchable.history.has_changes():
+                # New descriptors have no associations written before this
+                # transaction, so only changes to existing ones are kept
+                self.searchable_descriptor_ids.add(obj.id)
+
+    def has_bulk_writes(self, *models):
+        """Whether rows of any of the given models may have been written
+        without being recorded individually."""
+        return any(m is None or issubclass(m, models)
+                   for m in self.bulk_models)
+
+
+_catalog_commit_listeners = []
+
+
+def on_catalog_commit(f):
+    """Register f to be called with the CatalogChanges of every committed
+    transaction that wrote to the catalog. Can be used as a decorator."""
+    _catalog_commit_listeners.append(f)
+    return f
+
+
+def catalog_changes(session):
+    """Return the CatalogChanges of the current transaction of session. The
+    catalog version is bumped when a transaction with changes commits."""
+    changes = session.info.get('catalog_changes')
+    if changes is None:
+        changes = CatalogChanges()
+        session.info['catalog_changes'] = changes
+    return changes
+
+
+def mark_catalog_changed(session, model=None):
+    """Record a write to the catalog that bypasses the ORM, e.g. raw SQL or
+    a bulk insert, in the current transaction of session."""
+    changes = catalog_changes(session)
+    changes.changed_models.add(model)
+    changes.bulk_models.add(model)
+
+
+def mark_resources_imported(session, resources, touched_ids=()):
+    """Record resources written by a CSV import with bulk statements in the
+    current transaction of session: resources maps the id of each inserted
+    or moved resource to its (type, latitude, longitude), and touched_ids
+    are the other resources whose associations were written. Unlike
+    mark_catalog_changed, indexes are then updated for these resources
+    only."""
+    changes = catalog_changes(session)
+    changes.changed_models.update([ResourceBase, OptionAssociation,
+                                   TextAssociation])
+    changes.resources.update(resources)
+    changes.touched_resource_ids.update(touched_ids)
+    changes.imported_resource_ids.update(resources)
+    changes.imported_resource_ids.update(touched_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_flushed_catalog_writes(session, flush_context):
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, CATALOG_MODELS):
+            catalog_changes(session).record(obj)
+    for obj in session.deleted:
+        if isinstance(obj, CATALOG_MODELS):
+            catalog_changes(session).record(obj, deleted=True)
+
+
+def _track_bulk_catalog_writes(session, query, query_context, result):
+    entity = query.column_descriptions[0]['type']
+    if isinstance(entity, type) and issubclass(entity, CATALOG_MODELS):
+        mark_catalog_changed(session, entity)
+
+
+event.listen(Session, 'after_bulk_delete', _track_bulk_catalog_writes)
+event.listen(Session, 'after_bulk_update', _track_bulk_catalog_writes)
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_catalog_version(session):
+    # Flush first so that writes still pending are recorded
+    session.flush()
+    changes = session.info.get('catalog_changes')
+    if changes is not None and changes.version is None:
+        changes.version = CatalogVersion.bump(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_catalog_commit(session):
+    changes = session.info.pop('catalog_changes', None)
+    if changes is not None:
+        for f in _catalog_commit_listeners:
+            f(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_catalog_changes(session):
+    session.info.pop('catalog_changes', None)
+
+
+class CatalogCache(object):
+    """
+    Holds one value built from the catalog, e.g. an index or a serialized
+    payload. The value is rebuilt by calling build() the first time it is
+    requested after the catalog version changes.
+
+    If update is given, it is called as update(value, changes) with the
+    CatalogChanges of each transaction committed by this process, and may
+    modify the value in place and return True to keep it current instead of
+    having it rebuilt. Readers of a value that is updated in place should
+    hold the cache's lock.
+    """
+    instances = []
+
+    def __init__(self, build, update=None):
+        self.build = build
+        self.update = update
+        self.lock = RLock()
+        self._entry = (None, None)
+        CatalogCache.instances.append(self)
+        if update is not None:
+            on_catalog_commit(self._apply_changes)
+
+    def get(self, version=None):
+        if version is None:
+            version = CatalogVersion.current()
+        cached_version, value = self._entry
+        if cached_version != version:
+            value = self.build()
+            if 'catalog_changes' in db.session.info:
+                # Built from writes that are not committed yet, which other
+                # transactions must not see
+                return value
+            # The version is read before building, so the value is at least
+            # as recent as the version it is stored under.
+            with self.lock:
+                self._entry = (version, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self._entry = (None, None)
+
+    def _apply_changes(self, changes):
+        with self.lock:
+            cached_version, value = self._entry
+            if cached_version is None:
+                return
+            # Only changes directly following the cached version can be
+            # applied; anything else means another process wrote in between.
+            if cached_version == changes.version - 1 and \
+                    self.update(value, changes):
+                self._entry = (changes.version, value)
+            else:
+                self._entry = (None, None)
+
+    @staticmethod
+    def clear_all():
+        """Clear every catalog cache, e.g. after the database is recreated
+        and the catalog version starts over."""
+        for cache in CatalogCache.instances:
+            cache.clear()
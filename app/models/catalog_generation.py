@@ -0,0 +1,256 @@
+import re
+import sqlite3
+import uuid
+from datetime import datetime
+
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+
+from .. import db
+from ..models.catalog import mark_catalog_changed
+from ..models.rating import Rating
+from ..models.resource import (Descriptor, OptionAssociation,
+                               RequiredOptionDescriptor, ResourceBase,
+                               TextAssociation)
+# Adds the columns of suggestions to the resources table before its
+# generation tables are made from it
+from ..models.suggestion import ResourceSuggestion  # noqa
+
+# Models whose tables are replaced as a whole by a reset import, parents
+# first
+GENERATION_MODELS = (Descriptor, ResourceBase, RequiredOptionDescriptor,
+                     OptionAssociation, TextAssociation, Rating)
+
+LIVE_TABLES = dict(
+    (model.__table__.name, model.__table__) for model in GENERATION_MODELS)
+
+# Suffixes of the tables of the catalog replaced by the last reset, and of
+# the live tables while restore_previous_generation swaps them
+PREVIOUS = 'previous'
+SWAPPED = 'swapped'
+
+
+def _next(job_id):
+    # Suffix of the tables a reset import builds its catalog in
+    return 'next_{}'.format(int(job_id))
+
+
+def _generation_table(table, suffix, metadata):
+    """Copy of the live table named with suffix, with the same columns and
+    indexes and foreign keys to the tables with the same suffix, so that it
+    can be renamed to the live table."""
+    columns = []
+    for column in table.columns:
+        foreign_keys = [
+            db.ForeignKey('{}_{}.{}'.format(fk.column.table.name, suffix,
+                                            fk.column.name),
+                          ondelete=fk.ondelete)
+            for fk in column.foreign_keys]
+        columns.append(db.Column(
+            column.name, column.type, *foreign_keys,
+            primary_key=column.primary_key, nullable=column.nullable,
+            server_default=column.server_default and
+            column.server_default.arg))
+    copy = db.Table('{}_{}'.format(table.name, suffix), metadata, *columns)
+    # Index names are unique per database rather than per table, and stay
+    # with the table when it is renamed, so every copy has names of its own
+    token = uuid.uuid4().hex[:8]
+    for index in table.indexes:
+        db.Index('{}_{}'.format(index.name, token),
+                 *[copy.c[c.name] for c in index.columns],
+                 unique=index.unique)
+    return copy
+
+
+def _generation_tables(suffix):
+    """Tables of a generation by the name of the live table. They are kept
+    out of db.metadata, so create_all does not create them."""
+    metadata = db.MetaData()
+    return dict((name, _generation_table(table, suffix, metadata))
+                for name, table in LIVE_TABLES.iteritems())
+
+
+class CatalogGeneration(db.Model):
+    """
+    Single row numbering the catalogs published by reset imports. A reset
+    import builds its catalog in tables of its own, out of the way of
+    readers of the live tables and of other imports, and publishes it with
+    publish_next_generation. The catalog it replaces is kept in the
+    'previous' tables until the next reset, so that
+    restore_previous_generation can switch back to it.
+
+    Switching generations renames tables in one transaction rather than
+    copying rows, so it takes the same time whatever the size of the
+    catalog, and readers see either catalog as a whole. Ids are not reused
+    from one generation to the next.
+    """
+    __tablename__ = 'catalog_generation'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, default=0)
+    previous_generation = db.Column(db.Integer)
+    date_published = db.Column(db.DateTime)
+
+    @staticmethod
+    def current(lock=False):
+        """Return the row, locking it until the end of the transaction if
+        lock is set, so that generations are switched one at a time."""
+        query = CatalogGeneration.query.filter_by(id=1)
+        if lock:
+            query = query.with_for_update().populate_existing()
+        generation = query.first()
+        if generation is None:
+            generation = CatalogGeneration(id=1, generation=0)
+            db.session.add(generation)
+        return generation
+
+
+def _table_names(session):
+    return inspect(session.connection()).get_table_names()
+
+
+def _drop(session, tables):
+    cascade = ' CASCADE' if session.bind.dialect.name == 'postgresql' else ''
+    existing = set(_table_names(session))
+    for model in reversed(GENERATION_MODELS):
+        name = tables[model.__table__.name].name
+        if name in existing:
+            session.execute('DROP TABLE {}{}'.format(name, cascade))
+
+
+def _rename(session, src, dst):
+    """Rename the tables src to the names of the tables dst, both dicts by
+    live table name."""
+    for name in LIVE_TABLES:
+        session.execute('ALTER TABLE {} RENAME TO {}'.format(
+            src[name].name, dst[name].name))
+
+
+def generation_max_id(session, name):
+    """Return the highest id of the rows of the live table name and of its
+    previous and next generations, or 0 if there are none."""
+    pattern = re.compile(r'^{}(_{}|_next_\d+)?$'.format(name, PREVIOUS))
+    return max([0] + [
+        session.execute('SELECT max(id) FROM {}'.format(table)).scalar() or 0
+        for table in _table_names(session) if pattern.match(table)])
+
+
+def _sync_sequences(session):
+    if session.bind.dialect.name == 'postgresql':
+        # Rows are inserted with their ids, which the sequences do not see.
+        # Ids continue after those of every generation.
+        for name in LIVE_TABLES:
+            session.execute(
+                "SELECT setval(pg_get_serial_sequence('{}', 'id'), {}, "
+                "false)".format(name, generation_max_id(session, name) + 1))
+
+
+def _published(session, generation, previous_generation):
+    for model in GENERATION_MODELS:
+        mark_catalog_changed(session, model)
+    current = CatalogGeneration.current()
+    current.generation = generation
+    current.previous_generation = previous_generation
+    current.date_published = datetime.utcnow()
+
+
+def create_next_generation(session, job_id):
+    """Create empty tables for the next generation built by the reset
+    import job_id, in the current transaction of session, and return them
+    as a dict by live table name. Rows must be inserted with their ids.
+    Each import has tables of its own, so imports can run at the same
+    time."""
+    tables = _generation_tables(_next(job_id))
+    _drop(session, tables)
+    connection = session.connection()
+    for model in GENERATION_MODELS:
+        tables[model.__table__.name].create(connection)
+    return tables
+
+
+def next_generation_tables(session, job_id):
+    """Return the tables of the next generation of the reset import job_id,
+    as a dict by live table name, with the rows already written to them,
+    e.g. by an import that is resuming."""
+    tables = _generation_tables(_next(job_id))
+    if tables['resources'].name not in _table_names(session):
+        return create_next_generation(session, job_id)
+    return tables
+
+
+def next_generation_ids(session):
+    """Return the set of ids of the reset imports with next generation
+    tables."""
+    pattern = re.compile(r'^resources_next_(\d+)$')
+    return set(int(match.group(1)) for match in map(
+        pattern.match, _table_names(session)) if match)
+
+
+def drop_next_generation(session, job_id):
+    """Drop the tables of the next generation of the reset import job_id,
+    e.g. once it is discarded."""
+    _drop(session, _generation_tables(_next(job_id)))
+
+
+def publish_next_generation(session, job_id):
+    """Make the next generation of the reset import job_id the live catalog
+    in the current transaction of session, keeping the live catalog as the
+    previous generation, by renaming tables. Returns the number of the
+    published generation."""
+    current = CatalogGeneration.current(lock=True)
+    generation = (current.generation or 0) + 1
+    previous = _generation_tables(PREVIOUS)
+    _drop(session, previous)
+    _rename(session, LIVE_TABLES, previous)
+    _rename(session, _generation_tables(_next(job_id)), LIVE_TABLES)
+    _sync_sequences(session)
+    _published(session, generation, current.generation or 0)
+    return generation
+
+
+def restore_previous_generation(session):
+    """Swap the live catalog and the previous generation in the current
+    transaction of session, so that calling it again undoes it, e.g. with
+    the ratings written since the switch. Returns the number of the
+    restored generation, or None if there is none."""
+    current = CatalogGeneration.current(lock=True)
+    if current.previous_generation is None:
+        return None
+    generation = current.previous_generation
+    previous = _generation_tables(PREVIOUS)
+    swapped = _generation_tables(SWAPPED)
+    _rename(session, LIVE_TABLES, swapped)
+    _rename(session, previous, LIVE_TABLES)
+    _rename(session, swapped, previous)
+    _sync_sequences(session)
+    _published(session, generation, current.generation)
+    return generation
+
+
+def _drop_generation_tables(target, connection, **kw):
+    pattern = re.compile(r'^({})_({}|next_\d+)$'.format(
+        '|'.join(LIVE_TABLES), PREVIOUS))
+    cascade = ' CASCADE' if connection.dialect.name == 'postgresql' else ''
+    for name in inspect(connection).get_table_names():
+        if pattern.match(name):
+            connection.execute('DROP TABLE IF EXISTS {}{}'.format(
+                name, cascade))
+
+
+event.listen(db.metadata, 'before_drop', _drop_generation_tables)
+
+
+# pysqlite commits the open transaction before any statement other than a
+# query or a DML statement, which would publish a generation with its
+# tables half renamed. Transactions are begun explicitly instead, so that
+# they hold DDL as on Postgres.
+@event.listens_for(Engine, 'connect')
+def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, 'begin')
+def _begin_sqlite_transaction(connection):
+    if connection.dialect.name == 'sqlite':
+        # On the DBAPI connection, as it is not a statement of the session
+        connection.connection.execute('BEGIN')
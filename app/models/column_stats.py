@@ -0,0 +1,134 @@
+import hashlib
+import math
+import struct
+
+# Registers of the distinct count sketches are indexed by this many bits of
+# a value's hash: 2**10 registers, for a standard error of about 3%
+HLL_PRECISION = 10
+# Option values counted per column. Columns with more distinct values are
+# suggested as text, and only the most frequent values are kept.
+MAX_OPTION_VALUES = 100
+# Most frequent values shown for a column
+TOP_K = 5
+# Columns are suggested as options when the values of their cells repeat,
+# i.e. the number of distinct option values is at most this fraction of the
+# number of option values
+OPTION_RATIO = 0.5
+
+
+class DistinctCounter(object):
+    """HyperLogLog sketch estimating the number of distinct values added to
+    it in a fixed 2**precision bytes."""
+
+    def __init__(self, registers=None, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(registers or 2 ** precision)
+
+    def add(self, value):
+        digest = hashlib.sha1(value.encode('utf-8')).digest()
+        x = struct.unpack('>Q', digest[:8])[0]
+        bits = 64 - self.precision
+        index = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(
+            2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if r == 0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small counts
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class ColumnStats(object):
+    """
+    Statistics of the values of a CSV column, built in one pass as rows are
+    uploaded: the number of rows and of empty cells, the approximate number
+    of distinct values, and the counts of the values found by splitting
+    cells on ';', as option descriptors are. Values are counted exactly up
+    to MAX_OPTION_VALUES of them, after which the least frequent ones are
+    replaced (Space-Saving), so the counts of the most frequent values stay
+    close.
+
+    The state is a dict of builtins, as returned by to_dict, so that it can
+    be stored in a PickleType column between upload requests.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.rows = state.get('rows', 0)
+        self.nulls = state.get('nulls', 0)
+        self.option_values = state.get('option_values', 0)
+        self.counts = dict(state.get('counts', {}))
+        self.complete = state.get('complete', True)
+        self.distinct = DistinctCounter(state.get('distinct'))
+        self.distinct_options = DistinctCounter(state.get('distinct_options'))
+
+    def add(self, value):
+        self.rows += 1
+        value = (value or '').strip()
+        if not value:
+            self.nulls += 1
+            return
+        self.distinct.add(value)
+        for v in value.split(';'):
+            v = v.strip()
+            if not v:
+                continue
+            self.option_values += 1
+            self.distinct_options.add(v)
+            if v in self.counts:
+                self.counts[v] += 1
+            elif len(self.counts) < MAX_OPTION_VALUES:
+                self.counts[v] = 1
+            else:
+                least = min(self.counts, key=self.counts.get)
+                self.counts[v] = self.counts.pop(least) + 1
+                self.complete = False
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'nulls': self.nulls,
+            'option_values': self.option_values,
+            'counts': self.counts,
+            'complete': self.complete,
+            'distinct': str(self.distinct.registers),
+            'distinct_options': str(self.distinct_options.registers)
+        }
+
+    def null_ratio(self):
+        return float(self.nulls) / self.rows if self.rows else 0.0
+
+    def distinct_count(self):
+        """Approximate number of distinct non-empty cells."""
+        return self.distinct.count()
+
+    def option_count(self):
+        """Number of distinct values found by splitting cells on ';', exact
+        if they are all counted."""
+        if self.complete:
+            return len(self.counts)
+        return max(self.distinct_options.count(), len(self.counts))
+
+    def values(self):
+        """Set of the option values of the column, or None if there are
+        too many to count them all."""
+        return set(self.counts) if self.complete else None
+
+    def top(self, k=TOP_K):
+        """List of the k most frequent option values and their counts."""
+        return sorted(self.counts.iteritems(),
+                      key=lambda item: (-item[1], item[0]))[:k]
+
+    def suggested_type(self):
+        """'option' if the column's option values are few and repeat,
+        otherwise 'text'."""
+        if self.complete and self.counts and \
+                len(self.counts) <= self.option_values * OPTION_RATIO:
+            return 'option'
+        return 'text'
@@ -1,6 +1,12 @@
-from sqlalchemy import desc
+import json
+import zlib
+
+from datetime import datetime
+
+from sqlalchemy import desc, func
 
 from .. import db
+from .column_stats import ColumnStats
 
 
 class CsvStorage(db.Model):
@@ -10,8 +16,21 @@ class CsvStorage(db.Model):
     date_uploaded = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     action = db.Column(db.String, default='reset')  # or 'update'
-    csv_rows = db.relationship(
-        'CsvRow',
+    # Column names of the CSV, in the order the columns of its row blocks
+    # are stored in
+    header = db.Column(db.PickleType)
+    # Identifies the uploaded file, so that an interrupted upload of the
+    # same file can be resumed
+    source_key = db.Column(db.String(500))
+    # Id of the RQ job saving the CSV, once it is enqueued
+    save_job_id = db.Column(db.String(64))
+    csv_import_checkpoints = db.relationship(
+        'CsvImportCheckpoint',
+        backref='csv_storage',
+        uselist=True,
+        cascade='delete, delete-orphan')
+    csv_row_blocks = db.relationship(
+        'CsvRowBlock',
         backref='csv_storage',
         uselist=True,
         cascade='delete, delete-orphan')
@@ -25,47 +44,227 @@ class CsvStorage(db.Model):
         backref='csv_storage',
         uselist=True,
         cascade='delete, delete-orphan')
-    """ Find option values of option descriptors in the CSV """
 
     def set_desc_values(self):
-        all_descs = self.csv_descriptors
+        """Set the values of the option descriptors in the CSV to the option
+        values found in its rows, with one write per descriptor. Values
+        counted by the column statistics are used as they are; rows are only
+        read for the columns with too many values to count them all."""
+        num_rows = self.count_rows()
         opt_descs = dict(
-            [(d.name, d) for d in all_descs if d.descriptor_type == 'option'])
-        for row in self.csv_rows:
-            for key in row.data:
-                if key and key != 'Name' and key != 'Address' and key in \
-                        opt_descs:
-                    val = row.data[key]
-                    if val:
-                        desc = opt_descs[key]
-                        values = set()
-                        if desc.values:
-                            values = desc.values
-                        val = val.split(';')
-                        for v in val:
-                            if v.strip():
-                                values.add(v.strip())
-                        desc.values = values
-                        db.session.add(desc)
+            [(d.name, d) for d in self.csv_descriptors
+             if d.descriptor_type == 'option'])
+        values = dict((name, set(d.values or []))
+                      for name, d in opt_descs.iteritems())
+        scan = []
+        for name, d in opt_descs.iteritems():
+            stats = ColumnStats(d.stats)
+            if stats.rows == num_rows and stats.values() is not None:
+                values[name] |= stats.values()
+            else:
+                scan.append(name)
+        if scan:
+            for _, data, _ in self.iter_rows():
+                for key in scan:
+                    for v in (data.get(key) or '').split(';'):
+                        if v.strip():
+                            values[key].add(v.strip())
+        for name, d in opt_descs.iteritems():
+            d.values = values[name]
+            db.session.add(d)
         db.session.commit()
 
+    def append_rows(self, rows, resource_ids=None, first_row=None):
+        """Stage rows, a list of dicts from column name to value, as one
+        block starting at row number first_row, by default after the rows
+        already staged, optionally linked to the resources with the given
+        ids. The block is added to the session but not committed. If a
+        block already starts at first_row, the rows were stored by an
+        earlier attempt and are skipped, so that a batch can be sent again.
+        Returns whether the rows were added.
+
+        The statistics of each CSV descriptor's column are updated with the
+        rows, and the type of new descriptors is set to the one they
+        suggest."""
+        if not rows:
+            return False
+        if self.header is None:
+            self.header = ['Name', 'Address'] + sorted(
+                set(k for row in rows for k in row) - set(['Name',
+                                                           'Address']))
+        # Flush so that the storage has an id and earlier blocks are seen
+        db.session.add(self)
+        db.session.flush()
+        if first_row is None:
+            first_row = db.session.query(
+                func.coalesce(func.max(CsvRowBlock.first_row +
+                                       CsvRowBlock.num_rows), 0)).filter(
+                    CsvRowBlock.csv_storage_id == self.id).scalar()
+        elif self.has_block(first_row):
+            return False
+        db.session.add(CsvRowBlock(
+            csv_storage=self,
+            first_row=first_row,
+            num_rows=len(rows),
+            data=CsvRowBlock.encode(self.header, rows, resource_ids)))
+        for d in self.csv_descriptors:
+            stats = ColumnStats(d.stats)
+            for row in rows:
+                stats.add(row.get(d.name))
+            d.stats = stats.to_dict()
+            if not d.descriptor_id:
+                d.descriptor_type = stats.suggested_type()
+        return True
+
+    def has_block(self, first_row):
+        """Whether a block of rows starting at row number first_row is
+        staged."""
+        return db.session.query(CsvRowBlock.query.filter_by(
+            csv_storage_id=self.id, first_row=first_row).exists()).scalar()
+
+    def staged_rows(self, first_row, num_rows):
+        """Set of the numbers of the rows staged from row number first_row
+        to first_row + num_rows."""
+        end = first_row + num_rows
+        staged = set()
+        for block_first, block_rows in db.session.query(
+                CsvRowBlock.first_row, CsvRowBlock.num_rows).filter(
+                    CsvRowBlock.csv_storage_id == self.id,
+                    CsvRowBlock.first_row < end,
+                    CsvRowBlock.first_row + CsvRowBlock.num_rows >
+                    first_row):
+            staged.update(range(max(block_first, first_row),
+                                min(block_first + block_rows, end)))
+        return staged
+
+    def staged_through(self, row_offset=0):
+        """Number of the first row not staged after row_offset, where all
+        the rows before row_offset are staged. Blocks may be staged out of
+        order, e.g. after a batch failed, so only the ones that follow on
+        from row_offset count."""
+        for first_row, num_rows in db.session.query(
+                CsvRowBlock.first_row, CsvRowBlock.num_rows).filter(
+                    CsvRowBlock.csv_storage_id == self.id,
+                    CsvRowBlock.first_row >= row_offset).order_by(
+                        CsvRowBlock.first_row):
+            if first_row != row_offset:
+                break
+            row_offset += num_rows
+        return row_offset
+
+    def link_resources(self):
+        """Link each staged row to the existing resource with the same name,
+        for updates. The ids of all resources are loaded once and the blocks
+        are rewritten with one executemany."""
+        from .resource import Resource
+
+        resource_ids = Resource.name_ids()
+        blocks = db.session.query(CsvRowBlock.id, CsvRowBlock.data).filter(
+            CsvRowBlock.csv_storage_id == self.id)
+        updates = []
+        for block_id, data in blocks:
+            rows = [row for row, _ in CsvRowBlock.decode(self.header, data)]
+            updates.append({
+                'id': block_id,
+                'data': CsvRowBlock.encode(
+                    self.header, rows,
+                    [resource_ids.get(row['Name']) for row in rows])
+            })
+        db.session.bulk_update_mappings(CsvRowBlock, updates)
+
+    def iter_rows(self):
+        """Yield (row number, dict from column name to value, resource id)
+        for each staged row, reading one block at a time."""
+        blocks = db.session.query(CsvRowBlock.first_row,
+                                  CsvRowBlock.data).filter(
+            CsvRowBlock.csv_storage_id == self.id).order_by(
+                CsvRowBlock.first_row)
+        for first_row, data in blocks:
+            for i, (row, resource_id) in enumerate(
+                    CsvRowBlock.decode(self.header, data)):
+                yield first_row + i, row, resource_id
+
+    def count_rows(self):
+        return db.session.query(func.coalesce(func.sum(
+            CsvRowBlock.num_rows), 0)).filter(
+                CsvRowBlock.csv_storage_id == self.id).scalar()
+
+    def get_checkpoint(self, phase):
+        """Return the CsvImportCheckpoint of phase, or None if the phase has
+        not started."""
+        return CsvImportCheckpoint.query.filter_by(
+            csv_storage_id=self.id, phase=phase).first()
+
+    def set_checkpoint(self, phase, row_offset, counts=None, done=False):
+        """Record that the rows of the CSV before row_offset went through
+        phase, in the current transaction."""
+        checkpoint = self.get_checkpoint(phase)
+        if checkpoint is None:
+            checkpoint = CsvImportCheckpoint(csv_storage=self, phase=phase)
+            db.session.add(checkpoint)
+        checkpoint.row_offset = row_offset
+        checkpoint.counts = counts
+        checkpoint.done = done
+        checkpoint.date_updated = datetime.utcnow()
+        return checkpoint
+
     @staticmethod
     def most_recent(user):
         return CsvStorage.query.filter_by(user=user).order_by(
             desc(CsvStorage.date_uploaded)).limit(1).first()
 
 
-class CsvRow(db.Model):
-    """ Representation of a row in a CSV
-    - data field is a dictionary of header name to row value
-    - can be linked to an existing resource in the app for updates
+class CsvRowBlock(db.Model):
+    """ Block of consecutive rows of a CSV, stored by column
+    - data is the zlib compressed JSON of a list with the values of each
+    column of the CSV storage's header, and the list of the ids of the
+    existing resources the rows are linked to for updates
+    - first_row is the number of the first row of the block in the CSV,
+    starting from 0
     """
-    __tablename__ = 'csv_rows'
+    __tablename__ = 'csv_row_blocks'
     id = db.Column(db.Integer, primary_key=True)
     csv_storage_id = db.Column(
         db.Integer, db.ForeignKey('csv_storages.id', ondelete='CASCADE'))
-    data = db.Column(db.PickleType)  # json
-    resource_id = db.Column(db.Integer)  # no foreign key because could be null
+    first_row = db.Column(db.Integer)
+    num_rows = db.Column(db.Integer)
+    data = db.Column(db.LargeBinary)
+    __table_args__ = (db.UniqueConstraint('csv_storage_id', 'first_row'), )
+
+    @staticmethod
+    def encode(header, rows, resource_ids=None):
+        columns = [[row.get(name, '') for row in rows] for name in header]
+        return zlib.compress(json.dumps(
+            [columns, resource_ids or [None] * len(rows)],
+            separators=(',', ':')))
+
+    @staticmethod
+    def decode(header, data):
+        """Return a list of (dict from column name to value, resource id)
+        for the rows of a block."""
+        columns, resource_ids = json.loads(zlib.decompress(data))
+        return [(dict(zip(header, values)), resource_id)
+                for values, resource_id in zip(zip(*columns), resource_ids)]
+
+
+class CsvImportCheckpoint(db.Model):
+    """ Progress of a phase of the import of a CSV storage
+    - phase is 'staging' for the upload of its rows, and 'geocoding' or
+    'saving' for the save job
+    - row_offset is the number of rows, from the start of the CSV, that
+    went through the phase in committed transactions
+    - counts holds the counts of the phase so far, if any
+    """
+    __tablename__ = 'csv_import_checkpoints'
+    id = db.Column(db.Integer, primary_key=True)
+    csv_storage_id = db.Column(
+        db.Integer, db.ForeignKey('csv_storages.id', ondelete='CASCADE'))
+    phase = db.Column(db.String(32))
+    row_offset = db.Column(db.Integer, default=0)
+    counts = db.Column(db.PickleType)
+    done = db.Column(db.Boolean, default=False)
+    date_updated = db.Column(db.DateTime)
+    __table_args__ = (db.UniqueConstraint('csv_storage_id', 'phase'), )
 
 
 class CsvDescriptor(db.Model):
@@ -82,6 +281,7 @@ class CsvDescriptor(db.Model):
     name = db.Column(db.String(500))
     descriptor_type = db.Column(db.String, default='text')  # or 'option'
     values = db.Column(db.PickleType)  # list of string options from CSV ONLY
+    stats = db.Column(db.PickleType)  # ColumnStats.to_dict() of the column
     descriptor_id = db.Column(
         db.Integer)  # no foreign key because could be null
 
@@ -103,8 +303,10 @@ class CsvDescriptorRemove(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     csv_storage_id = db.Column(
         db.Integer, db.ForeignKey('csv_storages.id', ondelete='CASCADE'))
-    descriptor_id = db.Column(
-        db.Integer, db.ForeignKey('descriptors.id', ondelete='CASCADE'))
+    # Not a foreign key: the descriptors table is replaced as a whole when a
+    # reset import is published, and a removed descriptor is reported when
+    # the import is saved
+    descriptor_id = db.Column(db.Integer)
     name = db.Column(db.String(500))
 
 
@@ -114,3 +316,6 @@ class RequiredOptionDescriptorConstructor(db.Model):
     name = db.Column(db.String(500), index=True)
     values = db.Column(db.PickleType)
     missing_dict = db.Column(db.PickleType)
+    # Sorted names of the resources that will lack a value for the
+    # descriptor, computed once per constructor
+    missing_names = db.Column(db.PickleType)
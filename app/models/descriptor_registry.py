@@ -0,0 +1,73 @@
+from ..models.catalog import CatalogCache
+from ..models.resource import Descriptor, RequiredOptionDescriptor
+
+
+class RegisteredDescriptor(object):
+    """
+    Read-only copy of a descriptor held by the DescriptorRegistry. Option
+    values are unpickled once and indexed so that looking up the index of a
+    value does not scan the list.
+    """
+
+    def __init__(self, descriptor):
+        self.id = descriptor.id
+        self.name = descriptor.name
+        self.values = list(descriptor.values or [])
+        self.is_searchable = descriptor.is_searchable
+        # Keep the first index of duplicated values, like list.index
+        self.value_indices = {}
+        for i, value in enumerate(self.values):
+            self.value_indices.setdefault(value, i)
+
+    def __repr__(self):
+        return '<RegisteredDescriptor \'%s\'>' % self.name
+
+    @property
+    def is_option_descriptor(self):
+        return len(self.values) > 0
+
+    @property
+    def is_text_descriptor(self):
+        return len(self.values) == 0
+
+    def index_of(self, value):
+        """Index of value in the descriptor's option values, or None."""
+        return self.value_indices.get(value)
+
+
+class DescriptorRegistry(object):
+    """
+    Per-process registry of all descriptors by id and by name, and of the
+    required option descriptor. It is built with two queries and rebuilt
+    when the catalog version changes.
+    """
+
+    def __init__(self, descriptors, required_option_descriptor_id=None):
+        self.descriptors = [RegisteredDescriptor(d) for d in descriptors]
+        self.by_id = dict((d.id, d) for d in self.descriptors)
+        self.by_name = {}
+        for d in self.descriptors:
+            self.by_name.setdefault(d.name, d)
+        self.required_option_descriptor = self.by_id.get(
+            required_option_descriptor_id)
+
+    @staticmethod
+    def build():
+        required = RequiredOptionDescriptor.query.first()
+        return DescriptorRegistry(
+            Descriptor.query.order_by(Descriptor.id),
+            required.descriptor_id if required is not None else None)
+
+    @staticmethod
+    def get():
+        """Return the registry for the current catalog version."""
+        return _descriptor_registry_cache.get()
+
+    def get_by_id(self, descriptor_id):
+        return self.by_id.get(descriptor_id)
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+
+_descriptor_registry_cache = CatalogCache(DescriptorRegistry.build)
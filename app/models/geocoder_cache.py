@@ -1,10 +1,293 @@
+import re
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
 from .. import db
+from ..geocoding import is_transient
+from ..utils import chunks
+
+# Number of addresses kept in memory in front of the geocoder_cache table
+LRU_SIZE = 10000
+
+# Cached result of geocoding an address. status is 'OK' if latitude and
+# longitude are set, otherwise the reason the address could not be geocoded.
+# updated is the time it was geocoded, in seconds since the epoch.
+CachedGeocode = namedtuple('CachedGeocode',
+                           ['status', 'latitude', 'longitude', 'updated'])
+
+
+def normalize_address(address):
+    """Key under which an address is cached: lowercased, with runs of
+    whitespace collapsed, a single space after each comma and no trailing
+    punctuation."""
+    address = re.sub(r'\s+', ' ', (address or '').lower(), flags=re.UNICODE)
+    address = re.sub(r'\s*,\s*', ', ', address)
+    return address.strip(' ,.')
+
+
+class AddressLRU(object):
+    """Thread-safe dict from address keys to CachedGeocode entries that
+    drops the least recently used entries beyond size."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_lru = AddressLRU(LRU_SIZE)
+_stats_lock = Lock()
+_stats = {'hits': 0, 'misses': 0}
 
 
 class GeocoderCache(db.Model):
-    """ Cache results from address geocoding to avoid going over limit """
+    """
+    Cache results from address geocoding to avoid going over limit. Rows are
+    unique by normalized address, so case and whitespace variants of an
+    address share a row. Failures are cached too, with their status, and
+    are retried once they are older than GEOCODER_NEGATIVE_TTL seconds.
+    Recently used rows are also kept in memory.
+    """
     __tablename__ = 'geocoder_cache'
     id = db.Column(db.Integer, primary_key=True)
     address = db.Column(db.String(500), index=True)
+    address_key = db.Column(db.String(500), unique=True, index=True)
+    status = db.Column(db.String(64), default='OK')
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
+    date_updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, **kwargs):
+        super(GeocoderCache, self).__init__(**kwargs)
+        if self.address_key is None:
+            self.address_key = normalize_address(self.address)
+
+    def entry(self):
+        updated = self.date_updated or datetime.utcnow()
+        return CachedGeocode(self.status or 'OK', self.latitude,
+                             self.longitude,
+                             (updated - datetime(1970, 1, 1)).total_seconds())
+
+    @staticmethod
+    def is_fresh(entry):
+        """Whether a cached entry can be used. Failures expire after
+        GEOCODER_NEGATIVE_TTL seconds."""
+        return entry.status == 'OK' or time.time() - entry.updated < \
+            current_app.config['GEOCODER_NEGATIVE_TTL']
+
+    @staticmethod
+    def lookup_many(addresses):
+        """Return a dict from each of addresses that is cached to its
+        CachedGeocode. Addresses not in memory are looked up with one
+        query per IN_CHUNK_SIZE addresses."""
+        keys = dict((a, normalize_address(a)) for a in set(addresses))
+        found = {}
+        for key in set(keys.values()):
+            entry = _lru.get(key)
+            if entry is not None:
+                found[key] = entry
+        missing = list(set(keys.values()) - set(found))
+        for chunk in chunks(missing):
+            for row in GeocoderCache.query.filter(
+                    GeocoderCache.address_key.in_(chunk)):
+                entry = row.entry()
+                found[row.address_key] = entry
+                _lru.put(row.address_key, entry)
+        cached = dict((a, found[k]) for a, k in keys.iteritems()
+                      if k in found and GeocoderCache.is_fresh(found[k]))
+        with _stats_lock:
+            _stats['hits'] += len(cached)
+            _stats['misses'] += len(keys) - len(cached)
+        return cached
+
+    @staticmethod
+    def store_many(results):
+        """Add a dict from addresses to their GeocodeResults to the cache in
+        the current transaction, replacing expired failures. Transient
+        failures, such as running out of quota, are not stored. Addresses
+        stored first by a concurrent transaction are left as it stored
+        them. The entries are kept in memory once the transaction
+        commits."""
+        rows = {}
+        for address, result in results.iteritems():
+            if not is_transient(result.status):
+                rows[normalize_address(address)] = (address, result)
+        existing = GeocoderCache._rows_by_key(rows)
+        now = datetime.utcnow()
+        pending = db.session.info.setdefault('geocoder_cache_pending', {})
+        inserts = []
+        for key, (address, result) in rows.iteritems():
+            latitude, longitude = result.latlng or (None, None)
+            row = existing.get(key)
+            if row is None:
+                inserts.append({
+                    'address': address,
+                    'address_key': key,
+                    'status': result.status,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'date_updated': now
+                })
+                continue
+            row.status = result.status
+            row.latitude, row.longitude = latitude, longitude
+            row.date_updated = now
+            pending[key] = row.entry()
+        if inserts:
+            _insert_ignoring_conflicts(db.session, inserts)
+            # Read back what was stored, which for conflicting keys is the
+            # other transaction's row
+            for key, row in GeocoderCache._rows_by_key(
+                    i['address_key'] for i in inserts).iteritems():
+                pending[key] = row.entry()
+
+    @staticmethod
+    def _rows_by_key(keys):
+        rows = {}
+        for chunk in chunks(keys):
+            rows.update(
+                (row.address_key, row) for row in GeocoderCache.query.filter(
+                    GeocoderCache.address_key.in_(chunk)))
+        return rows
+
+    @staticmethod
+    def backfill_address_keys():
+        """Set the address key of rows cached before there were keys,
+        adding the column and its unique index if the table predates them.
+        Rows whose addresses normalize to the same key are merged into the
+        most recently updated one. Returns the number of rows merged
+        away."""
+        table = GeocoderCache.__table__
+        connection = db.session.connection()
+        inspector = inspect(connection)
+        if 'address_key' not in [
+                c['name'] for c in inspector.get_columns(table.name)]:
+            connection.execute(
+                'ALTER TABLE geocoder_cache ADD COLUMN address_key '
+                'VARCHAR(500)')
+        keep = {}
+        duplicates = []
+        changed = []
+        rows = db.session.query(
+            GeocoderCache.id, GeocoderCache.address,
+            GeocoderCache.address_key, GeocoderCache.date_updated).all()
+        rows.sort(key=lambda row: (row[3] or datetime.min, row[0]),
+                  reverse=True)
+        for id, address, address_key, _ in rows:
+            key = normalize_address(address)
+            if key in keep:
+                duplicates.append(id)
+            else:
+                keep[key] = id
+                if address_key != key:
+                    changed.append({'id': id, 'address_key': key})
+        for chunk in chunks(duplicates):
+            connection.execute(table.delete().where(table.c.id.in_(chunk)))
+        # Cleared first so that keys can move between rows without
+        # conflicts
+        for chunk in chunks(changed):
+            connection.execute(table.update().where(table.c.id.in_(
+                [c['id'] for c in chunk])).values(address_key=None))
+        for chunk in chunks(changed):
+            db.session.bulk_update_mappings(GeocoderCache, chunk)
+        index_names = [i['name'] for i in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(connection)
+        _lru.clear()
+        return len(duplicates)
+
+    @staticmethod
+    def resolve_many(addresses, geocode_many):
+        """Return a dict from each of addresses to its CachedGeocode. The
+        addresses not cached are geocoded with geocode_many, once per
+        normalized address, and stored in the current transaction. The
+        number of cached and geocoded addresses is logged, with the hits
+        and misses of the process so far."""
+        addresses = set(addresses)
+        resolved = GeocoderCache.lookup_many(addresses)
+        to_geocode = dict((normalize_address(a), a)
+                          for a in addresses - set(resolved))
+        stats = GeocoderCache.stats()
+        current_app.logger.info(
+            'Geocoder cache: %d of %d addresses cached, %d to geocode '
+            '(%d hits and %d misses since start)', len(resolved),
+            len(addresses), len(to_geocode), stats['hits'], stats['misses'])
+        results = geocode_many(to_geocode.values())
+        GeocoderCache.store_many(results)
+        now = time.time()
+        for address in addresses - set(resolved):
+            result = results[to_geocode[normalize_address(address)]]
+            latitude, longitude = result.latlng or (None, None)
+            resolved[address] = CachedGeocode(result.status, latitude,
+                                              longitude, now)
+        return resolved
+
+    @staticmethod
+    def stats():
+        """Counts of cache hits and misses by address looked up, including
+        cached failures as hits, since the process started."""
+        with _stats_lock:
+            return dict(_stats)
+
+
+def _insert_ignoring_conflicts(session, rows):
+    """Insert rows into the cache, skipping those whose address key is
+    already stored, e.g. by a concurrent upload batch."""
+    table = GeocoderCache.__table__
+    dialect = session.bind.dialect.name
+    if dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    elif dialect == 'postgresql':
+        statement = text(
+            'INSERT INTO geocoder_cache (address, address_key, status, '
+            'latitude, longitude, date_updated) VALUES (:address, '
+            ':address_key, :status, :latitude, :longitude, :date_updated) '
+            'ON CONFLICT (address_key) DO NOTHING')
+    else:
+        statement = table.insert()
+    for chunk in chunks(rows):
+        session.execute(statement, chunk)
+
+
+@event.listens_for(Session, 'after_commit')
+def _remember_stored_geocodes(session):
+    for key, entry in session.info.pop('geocoder_cache_pending',
+                                       {}).iteritems():
+        _lru.put(key, entry)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_stored_geocodes(session):
+    session.info.pop('geocoder_cache_pending', None)
+
+
+def _clear_geocoder_lru(target, connection, **kw):
+    _lru.clear()
+
+
+event.listen(db.metadata, 'before_drop', _clear_geocoder_lru)
@@ -0,0 +1,58 @@
+from collections import defaultdict
+
+from .. import db
+from ..models.catalog import CatalogCache
+from ..models.resource import OptionAssociation
+
+
+class OptionIndex(object):
+    """
+    In-memory inverted index from (descriptor id, option index) to the set of
+    ids of resources that have that option association. It is built from the
+    option_associations table with one query and rebuilt lazily when the
+    catalog version changes, so option filters can be answered with set
+    intersections and unions instead of a query per resource.
+    """
+
+    def __init__(self, postings):
+        self.postings = postings
+
+    @staticmethod
+    def build():
+        postings = defaultdict(set)
+        rows = db.session.query(OptionAssociation.descriptor_id,
+                                OptionAssociation.option,
+                                OptionAssociation.resource_id)
+        for descriptor_id, option, resource_id in rows:
+            postings[(descriptor_id, option)].add(resource_id)
+        return OptionIndex(
+            dict((key, frozenset(ids)) for key, ids in postings.iteritems()))
+
+    @staticmethod
+    def get():
+        """Return the index for the current catalog version."""
+        return _option_index_cache.get()
+
+    def resources_with_option(self, descriptor_id, option):
+        return self.postings.get((descriptor_id, option), frozenset())
+
+    def resources_with_any(self, descriptor_id, options):
+        """Ids of resources with at least one of the given options for the
+        descriptor."""
+        matches = set()
+        for option in options:
+            matches |= self.resources_with_option(descriptor_id, option)
+        return matches
+
+    @staticmethod
+    def resources_with_all(option_filters):
+        """Intersect sets of resource ids, e.g. as returned by
+        resources_with_any. Returns None if there are no filters, meaning
+        that every resource matches."""
+        matches = None
+        for ids in option_filters:
+            matches = set(ids) if matches is None else matches & ids
+        return matches
+
+
+_option_index_cache = CatalogCache(OptionIndex.build)
@@ -1,4 +1,10 @@
+from collections import defaultdict
+
+from sqlalchemy import and_, event, exists, func, select
+from sqlalchemy.orm import subqueryload
+
 from .. import db
+from ..utils import chunks
 from ..models import Rating
 
 
@@ -122,7 +128,7 @@ class ResourceBase(db.Model):
     """
     __tablename__ = 'resources'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(500), index=True)
+    name = db.Column(db.String(500))
     address = db.Column(db.String(500))
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
@@ -135,11 +141,22 @@ class ResourceBase(db.Model):
         back_populates='resource',
         cascade='all, delete-orphan')
     type = db.Column(db.String(20))
+    # Aggregates over the resource's ratings, maintained by the Rating
+    # insert/delete hooks below
+    rating_count = db.Column(db.Integer, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, default=0, server_default='0')
+    # Hash of the name, address and descriptor values of the CSV row the
+    # resource was last imported from, or None if it has been edited since.
+    # Deferred so that it is not loaded or serialized with the resource.
+    content_hash = db.deferred(db.Column(db.String(40)))
 
     __mapper_args__ = {
         'polymorphic_on': type,
         'polymorphic_identity': 'resource_base'
     }
+    # Lookups by name are filtered by type; the index also covers loading
+    # the ids of all resources by name
+    __table_args__ = (db.Index('ix_resources_name_type', 'name', 'type'), )
 
     def __repr__(self):
         return '<ResourceBase \'%s\'>' % self.name
@@ -269,6 +286,10 @@ class Resource(ResourceBase):
                 name=option_descriptor_name,
                 values=option_descriptor_values[option_descriptor_name],
                 is_searchable=True)
+        # value -> index maps for the new option descriptors
+        option_indices = dict(
+            (name, dict((v, i) for i, v in enumerate(values)))
+            for name, values in option_descriptor_values.iteritems())
 
         script_dir = os.path.dirname("__file__")
 
@@ -298,8 +319,9 @@ class Resource(ResourceBase):
                             resource.option_descriptors.append(
                                 OptionAssociation(
                                     descriptor=this_descriptor,
-                                    option=this_descriptor.values.index(doc[
-                                        option_descriptor_name])))
+                                    option=option_indices[
+                                        option_descriptor_name][doc[
+                                            option_descriptor_name]]))
                         else:
                             this_descriptor = \
                                 option_descriptors[option_descriptor_name]
@@ -307,8 +329,8 @@ class Resource(ResourceBase):
                                 resource.option_descriptors.append(
                                     OptionAssociation(
                                         descriptor=this_descriptor,
-                                        option=this_descriptor.values.index(
-                                            item)))
+                                        option=option_indices[
+                                            option_descriptor_name][item]))
 
                 for text_descriptors_name in text_descriptors_names:
                     key_name = '_'.join(text_descriptors_name.split(' '))
@@ -335,25 +357,30 @@ class Resource(ResourceBase):
 
     @staticmethod
     def get_resources_as_dicts(resources):
-        # get required option descriptor
-        req_opt_desc = RequiredOptionDescriptor.query.all()
+        from ..models.descriptor_registry import DescriptorRegistry
+
+        # get required option descriptor and the values each resource has
+        # for it, with one query per chunk of resources
+        req_opt_desc = DescriptorRegistry.get().required_option_descriptor
+        req_opts = defaultdict(list)
         if req_opt_desc:
-            req_opt_desc = req_opt_desc[0]
-            req_opt_desc = Descriptor.query.filter_by(
-                id=req_opt_desc.descriptor_id).first()
+            ids = [resource.id for resource in resources]
+            for chunk in chunks(ids):
+                associations = db.session.query(
+                    OptionAssociation.resource_id,
+                    OptionAssociation.option).filter(
+                        OptionAssociation.descriptor_id == req_opt_desc.id,
+                        OptionAssociation.resource_id.in_(chunk)).order_by(
+                            OptionAssociation.id)
+                for resource_id, option in associations:
+                    req_opts[resource_id].append(req_opt_desc.values[option])
 
         resources_as_dicts = []
         for resource in resources:
-            res = resource.__dict__
+            res = dict(resource.__dict__)
 
             # set required option descriptor
-            req = []
-            if req_opt_desc:
-                associations = OptionAssociation.query.filter_by(
-                    resource_id=resource.id,
-                    descriptor_id=req_opt_desc.id).all()
-                req = [a.descriptor.values[a.option] for a in associations]
-            res['requiredOpts'] = req
+            res['requiredOpts'] = req_opts[resource.id]
 
             # set ratings
             res['avg_rating'] = resource.get_avg_ratings()
@@ -366,40 +393,90 @@ class Resource(ResourceBase):
             resources_as_dicts.append(res)
         return resources_as_dicts
 
+    @staticmethod
+    def with_associations(query):
+        """Eager load the text and option associations of every resource
+        matched by query. Each collection is fetched with a single extra
+        query, so serializing the results costs the same number of queries
+        whatever the number of resources."""
+        return query.options(
+            subqueryload(ResourceBase.text_descriptors),
+            subqueryload(ResourceBase.option_descriptors))
+
     @staticmethod
     def get_resources_as_full_dicts(resources):
         # maps array of resources to array of useful dictionaries containing
-        # all of the information/associations for that resources
-        resources_as_dicts = []
+        # all of the information/associations for that resources. Resources
+        # should be loaded with Resource.with_associations and descriptors
+        # are looked up in memory, so no queries are made per resource.
+        from ..models.descriptor_registry import DescriptorRegistry
+        descriptors = DescriptorRegistry.get().by_id
+        return [
+            Resource._full_dict(resource, descriptors,
+                                resource.text_descriptors,
+                                resource.option_descriptors)
+            for resource in resources
+        ]
 
+    @staticmethod
+    def iter_resources_as_full_dicts(chunk_size=500):
+        """Yield the dictionaries of get_resources_as_full_dicts for every
+        resource, by id. Resources and their text and option associations
+        are read with one query each, ordered by resource id, through
+        server-side cursors chunk_size rows at a time, and merged. Neither
+        the number of queries nor memory use grows with the size of the
+        catalog."""
+        from ..models.descriptor_registry import DescriptorRegistry
+        descriptors = DescriptorRegistry.get().by_id
+        resources = Resource.query.order_by(Resource.id).yield_per(chunk_size)
+        texts = _AssociationStream(db.session.query(
+            TextAssociation.resource_id, TextAssociation.descriptor_id,
+            TextAssociation.text).order_by(
+                TextAssociation.resource_id,
+                TextAssociation.id).yield_per(chunk_size))
+        options = _AssociationStream(db.session.query(
+            OptionAssociation.resource_id, OptionAssociation.descriptor_id,
+            OptionAssociation.option).order_by(
+                OptionAssociation.resource_id,
+                OptionAssociation.id).yield_per(chunk_size))
         for resource in resources:
-            resource_as_dict = resource.__dict__
-            resource_as_dict['long'] = resource_as_dict['longitude']
-            resource_as_dict['lat'] = resource_as_dict['latitude']
-
-            for td in resource.text_descriptors:
-                key = normalize_string(td.descriptor.name)
-                value = td.text
-                resource_as_dict[key] = value
-            for od in resource.option_descriptors:
-                key = normalize_string(od.descriptor.name)
-                if od.option == '':
-                    continue
-                value = od.descriptor.values[od.option]
-                if key not in resource_as_dict:
-                    resource_as_dict[key] = [value]
-                else:
-                    resource_as_dict[key].append(value)
-
-            if '_sa_instance_state' in resource_as_dict:
-                del resource_as_dict['_sa_instance_state']
-            if 'text_descriptors' in resource_as_dict:
-                del resource_as_dict['text_descriptors']
-            if 'option_descriptors' in resource_as_dict:
-                del resource_as_dict['option_descriptors']
-            resources_as_dicts.append(resource_as_dict)
+            yield Resource._full_dict(resource, descriptors,
+                                      texts.take(resource.id),
+                                      options.take(resource.id))
 
-        return resources_as_dicts
+    @staticmethod
+    def _full_dict(resource, descriptors, text_associations,
+                   option_associations):
+        resource_as_dict = dict(resource.__dict__)
+        resource_as_dict['long'] = resource_as_dict['longitude']
+        resource_as_dict['lat'] = resource_as_dict['latitude']
+
+        for td in text_associations:
+            key = normalize_string(descriptors[td.descriptor_id].name)
+            value = td.text
+            resource_as_dict[key] = value
+        for od in option_associations:
+            descriptor = descriptors[od.descriptor_id]
+            key = normalize_string(descriptor.name)
+            if od.option == '':
+                continue
+            value = descriptor.values[od.option]
+            if key not in resource_as_dict:
+                resource_as_dict[key] = [value]
+            else:
+                resource_as_dict[key].append(value)
+
+        if '_sa_instance_state' in resource_as_dict:
+            del resource_as_dict['_sa_instance_state']
+        if 'text_descriptors' in resource_as_dict:
+            del resource_as_dict['text_descriptors']
+        if 'option_descriptors' in resource_as_dict:
+            del resource_as_dict['option_descriptors']
+        # Rating aggregates change without the catalog version, which the
+        # full catalog is cached by
+        for key in ('rating_count', 'rating_sum'):
+            resource_as_dict.pop(key, None)
+        return resource_as_dict
 
     @staticmethod
     def print_resources():
@@ -413,37 +490,117 @@ class Resource(ResourceBase):
 
     @staticmethod
     def get_resources_in_city(city):
-        city_descriptor = Descriptor.query.filter_by(name='city').first()
+        from ..models.descriptor_registry import DescriptorRegistry
 
-        if city not in city_descriptor.values:
+        city_descriptor = DescriptorRegistry.get().get_by_name('city')
+        if city_descriptor is None:
             return []
 
-        list_of_cities = city_descriptor.values
-        lowercase_cities = [x.lower() for x in list_of_cities]
-        city_option = lowercase_cities.index(city.lower())
+        city_option = city_descriptor.index_of(city)
+        if city_option is None:
+            return []
 
-        opt_resources = OptionAssociation.query.filter_by(
-            descriptor=city_descriptor).filter_by(option=city_option)
-        resources = []
-        for opt_resource in opt_resources:
-            if opt_resource.resource.type == 'resource':
-                resources.append(opt_resource.resource)
+        # Resources joined to their city association, with all their
+        # associations loaded up front for serialization
+        query = Resource.query.join(
+            OptionAssociation,
+            OptionAssociation.resource_id == Resource.id).filter(
+                OptionAssociation.descriptor_id == city_descriptor.id,
+                OptionAssociation.option == city_option)
+        return Resource.with_associations(query).all()
 
-        return resources
+    @staticmethod
+    def name_ids():
+        """Return a dict from the name of each resource to its id, with one
+        query. Of resources with the same name, the first one is kept."""
+        return dict(db.session.query(Resource.name, Resource.id).order_by(
+            Resource.id.desc()))
+
+    @staticmethod
+    def missing_option(descriptor_id):
+        """Query of the (id, name) of the resources without an option
+        association with the descriptor with the given id, as one anti-join,
+        or of all resources if descriptor_id is None."""
+        query = db.session.query(Resource.id, Resource.name)
+        if descriptor_id is None:
+            return query
+        return query.filter(~exists().where(and_(
+            OptionAssociation.resource_id == Resource.id,
+            OptionAssociation.descriptor_id == descriptor_id)))
 
     @staticmethod
     def get_list_of_cities():
-        city_descriptor = Descriptor.query.filter_by(name='city').first()
+        from ..models.descriptor_registry import DescriptorRegistry
+
+        city_descriptor = DescriptorRegistry.get().get_by_name('city')
         return city_descriptor.values
 
     def get_avg_ratings(self):
-        ratings = Rating.query.filter_by(resource_id=self.id).all()
-        if not ratings:
+        if not self.rating_count:
             return 0.0
-        total_sum = float(sum(r.rating for r in ratings))
-        return '%.1f' % (total_sum / len(ratings))
+        return '%.1f' % (float(self.rating_sum) / self.rating_count)
 
     def get_all_ratings(self):
         ratings = Rating.query.filter_by(resource_id=self.id).all()
         ratings.sort(key=lambda r: r.submission_time, reverse=True)
         return ratings
+
+    @staticmethod
+    def rebuild_rating_aggregates():
+        """Recompute the rating aggregates of every resource from the
+        ratings table."""
+        ratings = Rating.__table__
+        resources = ResourceBase.__table__
+        rating_count = select([func.count(ratings.c.id)]).where(
+            ratings.c.resource_id == resources.c.id).as_scalar()
+        rating_sum = select([func.coalesce(func.sum(ratings.c.rating), 0)
+                             ]).where(ratings.c.resource_id ==
+                                      resources.c.id).as_scalar()
+        db.session.query(ResourceBase).update(
+            {
+                ResourceBase.rating_count: rating_count,
+                ResourceBase.rating_sum: rating_sum
+            },
+            synchronize_session=False)
+        db.session.commit()
+
+
+class _AssociationStream(object):
+    """Associations read in order of resource id, handed out a resource at a
+    time to callers going through resources in the same order."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.next_row = next(self.rows, None)
+
+    def take(self, resource_id):
+        """Return the associations of the resource with resource_id,
+        skipping those of resources with lower ids, e.g. suggestions."""
+        taken = []
+        while self.next_row is not None and \
+                self.next_row.resource_id <= resource_id:
+            if self.next_row.resource_id == resource_id:
+                taken.append(self.next_row)
+            self.next_row = next(self.rows, None)
+        return taken
+
+
+def _update_rating_aggregates(connection, rating, sign):
+    resources = ResourceBase.__table__
+    value = int(rating.rating or 0)
+    connection.execute(resources.update().where(
+        resources.c.id == rating.resource_id).values(
+            rating_count=resources.c.rating_count + sign,
+            rating_sum=resources.c.rating_sum + sign * value))
+
+
+@event.listens_for(Rating, 'after_insert')
+def _add_rating_to_aggregates(mapper, connection, rating):
+    # Runs inside the flush, so the aggregates are updated in the same
+    # transaction as the rating itself
+    _update_rating_aggregates(connection, rating, 1)
+
+
+@event.listens_for(Rating, 'after_delete')
+def _remove_rating_from_aggregates(mapper, connection, rating):
+    _update_rating_aggregates(connection, rating, -1)
@@ -0,0 +1,34 @@
+import hashlib
+import json
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from ..models.resource import OptionAssociation, ResourceBase, TextAssociation
+from ..utils import chunks
+
+
+def content_hash(name, address, values):
+    """Hash of the content of a resource as imported from a CSV: its name,
+    address and a dict from descriptor id to the text of the descriptor or
+    to the sorted list of its option indices."""
+    content = json.dumps([name, address, sorted(values.iteritems())])
+    return hashlib.sha1(content).hexdigest()
+
+
+@event.listens_for(Session, 'before_commit')
+def _clear_edited_content_hashes(session):
+    # Resources edited other than by a CSV import no longer match the row
+    # they were imported from, so the next import must write them again.
+    session.flush()
+    changes = session.info.get('catalog_changes')
+    if changes is None:
+        return
+    ids = set(changes.resources)
+    if changes.changed_models & set([OptionAssociation, TextAssociation]):
+        ids |= changes.touched_resource_ids
+    ids -= changes.imported_resource_ids
+    table = ResourceBase.__table__
+    for chunk in chunks(ids):
+        session.execute(table.update().where(table.c.id.in_(chunk)).where(
+                table.c.content_hash.isnot(None)).values(content_hash=None))
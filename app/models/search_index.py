@@ -0,0 +1,278 @@
+import re
+from collections import defaultdict
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from .. import db
+from ..models.resource import (Descriptor, Resource, ResourceBase,
+                               TextAssociation)
+from ..utils import IN_CHUNK_SIZE, chunks
+
+
+class SqliteSearchBackend(object):
+    """FTS5 table keyed by resource id, with a column for the resource name
+    and one for the text of its searchable descriptors."""
+
+    create_statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS resource_search USING "
+        "fts5(name, body, tokenize='porter unicode61')"
+    ]
+
+    @staticmethod
+    def has_table(bind):
+        return bind.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                 "AND name = 'resource_search'")).scalar() is not None
+
+    @staticmethod
+    def delete(session, ids):
+        session.execute(
+            text('DELETE FROM resource_search WHERE rowid IN (%s)' % ', '.join(
+                str(int(resource_id)) for resource_id in ids)))
+
+    @staticmethod
+    def insert(session, documents):
+        session.execute(
+            text('INSERT INTO resource_search (rowid, name, body) '
+                 'VALUES (:id, :name, :body)'), documents)
+
+    @staticmethod
+    def match(session, terms):
+        # Every term must match, as a prefix so partially typed words match.
+        # Matches in the name count ten times as much as in the text.
+        query = ' '.join('"%s"*' % term for term in terms)
+        return [
+            row[0] for row in session.execute(
+                text('SELECT rowid FROM resource_search '
+                     'WHERE resource_search MATCH :query '
+                     'ORDER BY bm25(resource_search, 10.0, 1.0)'),
+                {'query': query})
+        ]
+
+
+class PostgresSearchBackend(object):
+    """Table of tsvector documents keyed by resource id with a GIN index. The
+    name is weighted above the text of the searchable descriptors. Resource
+    ids are not a foreign key, as the resources table is replaced as a
+    whole when a reset import is published, and the index is rebuilt."""
+
+    create_statements = [
+        'CREATE TABLE IF NOT EXISTS resource_search ('
+        'resource_id INTEGER PRIMARY KEY, '
+        'document TSVECTOR NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_resource_search_document '
+        'ON resource_search USING GIN (document)'
+    ]
+
+    @staticmethod
+    def has_table(bind):
+        return bind.execute(
+            text("SELECT to_regclass('resource_search')")).scalar() is not None
+
+    @staticmethod
+    def delete(session, ids):
+        session.execute(
+            text('DELETE FROM resource_search WHERE resource_id IN (%s)' %
+                 ', '.join(str(int(resource_id)) for resource_id in ids)))
+
+    @staticmethod
+    def insert(session, documents):
+        session.execute(
+            text("INSERT INTO resource_search (resource_id, document) VALUES "
+                 "(:id, setweight(to_tsvector('english', :name), 'A') || "
+                 "setweight(to_tsvector('english', :body), 'B'))"),
+            documents)
+
+    @staticmethod
+    def match(session, terms):
+        query = ' & '.join('%s:*' % term for term in terms)
+        return [
+            row[0] for row in session.execute(
+                text("SELECT resource_id FROM resource_search, "
+                     "to_tsquery('english', :query) query "
+                     "WHERE document @@ query "
+                     "ORDER BY ts_rank(document, query) DESC"),
+                {'query': query})
+        ]
+
+
+_backends = {
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend
+}
+
+# Whether the search table exists, by database URL
+_has_table = {}
+
+
+class SearchIndex(object):
+    """
+    Full-text index over the names of approved resources and the text of
+    their searchable descriptors. It is stored in the database, as an FTS5
+    table on SQLite and a tsvector column with a GIN index on Postgres, and
+    is updated in the transaction of every write to the catalog. Without a
+    supported database or search table, searches fall back to matching
+    names with LIKE.
+    """
+
+    @staticmethod
+    def backend(bind):
+        return _backends.get(bind.dialect.name)
+
+    @staticmethod
+    def is_available(session):
+        bind = session.get_bind(mapper=Resource.__mapper__)
+        backend = SearchIndex.backend(bind)
+        if backend is None:
+            return False
+        url = str(bind.url)
+        if url not in _has_table:
+            _has_table[url] = backend.has_table(bind)
+        return _has_table[url]
+
+    @staticmethod
+    def terms(query):
+        """Words in a search query, lowercased."""
+        return re.findall(r'\w+', (query or '').lower(), re.UNICODE)
+
+    @staticmethod
+    def documents(session, ids=None):
+        """Yield a dict with the id, name and searchable text of each
+        approved resource, restricted to ids if given."""
+        resources = session.query(Resource.id, Resource.name).order_by(
+            Resource.id)
+        texts = session.query(
+            TextAssociation.resource_id, TextAssociation.text).join(
+                Descriptor,
+                Descriptor.id == TextAssociation.descriptor_id).filter(
+                    Descriptor.is_searchable.is_(True)).order_by(
+                        TextAssociation.id)
+        id_chunks = [None] if ids is None else chunks(ids)
+        for chunk in id_chunks:
+            chunk_resources = resources
+            chunk_texts = texts
+            if chunk is not None:
+                chunk_resources = resources.filter(Resource.id.in_(chunk))
+                chunk_texts = texts.filter(
+                    TextAssociation.resource_id.in_(chunk))
+            bodies = defaultdict(list)
+            for resource_id, body in chunk_texts:
+                if body:
+                    bodies[resource_id].append(body)
+            for resource_id, name in chunk_resources:
+                yield {
+                    'id': resource_id,
+                    'name': name or '',
+                    'body': '\n'.join(bodies[resource_id])
+                }
+
+    @staticmethod
+    def described_resource_ids(session, descriptor_ids):
+        """Return the set of ids of resources with text for any of the
+        descriptors with the given ids."""
+        ids = set()
+        for chunk in chunks(descriptor_ids):
+            ids.update(resource_id for resource_id, in session.query(
+                TextAssociation.resource_id).filter(
+                    TextAssociation.descriptor_id.in_(chunk)).distinct())
+        return ids
+
+    @staticmethod
+    def refresh(session, ids):
+        """Reindex the resources with the given ids, removing those that
+        are no longer approved resources."""
+        backend = SearchIndex.backend(session.get_bind(
+            mapper=Resource.__mapper__))
+        for chunk in chunks(ids):
+            backend.delete(session, chunk)
+            documents = list(SearchIndex.documents(session, chunk))
+            if documents:
+                backend.insert(session, documents)
+
+    @staticmethod
+    def rebuild(session=None):
+        """Create the search table if needed and reindex every resource in
+        the current transaction of session."""
+        session = session or db.session
+        bind = session.get_bind(mapper=Resource.__mapper__)
+        backend = SearchIndex.backend(bind)
+        if backend is None:
+            return
+        for statement in backend.create_statements:
+            session.execute(text(statement))
+        _has_table[str(bind.url)] = True
+        session.execute(text('DELETE FROM resource_search'))
+        documents = []
+        for document in SearchIndex.documents(session):
+            documents.append(document)
+            if len(documents) == IN_CHUNK_SIZE:
+                backend.insert(session, documents)
+                documents = []
+        if documents:
+            backend.insert(session, documents)
+
+    @staticmethod
+    def resources(ids):
+        """Load the resources with the given ids, in the same order."""
+        by_id = {}
+        for chunk in chunks(ids):
+            resources = Resource.query.filter(Resource.id.in_(chunk))
+            by_id.update((r.id, r) for r in resources)
+        return [by_id[i] for i in ids if i in by_id]
+
+    @staticmethod
+    def search(query, session=None):
+        """Return the ids of approved resources matching every word of
+        query, best match first, or None if query has no words."""
+        terms = SearchIndex.terms(query)
+        if not terms:
+            return None
+        session = session or db.session
+        if not SearchIndex.is_available(session):
+            resources = session.query(Resource.id).filter(
+                Resource.name.ilike('%{}%'.format(query))).order_by(
+                    Resource.id)
+            return [resource_id for resource_id, in resources]
+        backend = SearchIndex.backend(session.get_bind(
+            mapper=Resource.__mapper__))
+        return backend.match(session, terms)
+
+
+@event.listens_for(Session, 'before_commit')
+def _update_search_index(session):
+    # Flush first so that writes still pending are recorded
+    session.flush()
+    changes = session.info.get('catalog_changes')
+    if changes is None or not SearchIndex.is_available(session):
+        return
+    if changes.has_bulk_writes(ResourceBase, TextAssociation, Descriptor):
+        # Which rows changed is unknown
+        SearchIndex.rebuild(session)
+        return
+    ids = set(changes.resources) | changes.deleted_resource_ids
+    if TextAssociation in changes.changed_models:
+        ids |= changes.touched_resource_ids
+    if changes.searchable_descriptor_ids:
+        ids |= SearchIndex.described_resource_ids(
+            session, changes.searchable_descriptor_ids)
+    if ids:
+        SearchIndex.refresh(session, ids)
+
+
+def _create_search_table(target, connection, **kw):
+    backend = SearchIndex.backend(connection)
+    if backend is not None:
+        for statement in backend.create_statements:
+            connection.execute(text(statement))
+        _has_table[str(connection.engine.url)] = True
+
+
+def _drop_search_table(target, connection, **kw):
+    if SearchIndex.backend(connection) is not None:
+        connection.execute(text('DROP TABLE IF EXISTS resource_search'))
+        _has_table[str(connection.engine.url)] = False
+
+
+event.listen(db.metadata, 'after_create', _create_search_table)
+event.listen(db.metadata, 'before_drop', _drop_search_table)
@@ -0,0 +1,194 @@
+import heapq
+import math
+from collections import defaultdict
+
+from .. import db
+from ..models.catalog import CatalogCache
+from ..models.resource import Resource, ResourceBase
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance in kilometers between two points."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2)**2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2)**2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex(object):
+    """
+    Uniform grid over latitude/longitude. Each cell of cell_size degrees maps
+    resource ids to their coordinates, so nearest neighbour and radius
+    queries only look at the cells around the query point. Longitudes are
+    not wrapped around the antimeridian.
+    """
+
+    def __init__(self, cell_size=0.02):
+        self.cell_size = cell_size
+        self.cells = defaultdict(dict)
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def insert(self, resource_id, lat, lng):
+        self.remove(resource_id)
+        cell = self.cell(lat, lng)
+        self.cells[cell][resource_id] = (lat, lng)
+        self.points[resource_id] = cell
+
+    def remove(self, resource_id):
+        cell = self.points.pop(resource_id, None)
+        if cell is not None:
+            del self.cells[cell][resource_id]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def _ring(self, row, col, r):
+        """Cells at Chebyshev distance r from (row, col)."""
+        if r == 0:
+            yield (row, col)
+            return
+        for c in range(col - r, col + r + 1):
+            yield (row - r, c)
+            yield (row + r, c)
+        for i in range(row - r + 1, row + r):
+            yield (i, col - r)
+            yield (i, col + r)
+
+    def _searched_km(self, lat, lng, row, col, r):
+        """Lower bound on the distance from (lat, lng) to any point outside
+        the square of cells within r rings of (row, col)."""
+        size = self.cell_size
+        dlat = min(lat - (row - r) * size, (row + r + 1) * size - lat)
+        dlng = min(lng - (col - r) * size, (col + r + 1) * size - lng)
+        max_lat = min(abs(lat) + (r + 1) * size, 89.9)
+        return min(dlat * KM_PER_DEGREE,
+                   dlng * KM_PER_DEGREE * math.cos(math.radians(max_lat)))
+
+    def _max_ring(self, row, col):
+        """Ring beyond which there are no occupied cells."""
+        if not self.cells:
+            return -1
+        return max(
+            max(abs(i - row), abs(j - col)) for (i, j) in self.cells)
+
+    def nearest(self, lat, lng, k, max_km=None, accept=None):
+        """Return up to k (distance in km, resource id) pairs closest to
+        (lat, lng), optionally within max_km and restricted to ids for which
+        accept(id) is true, ordered by distance."""
+        if k < 1:
+            return []
+        row, col = self.cell(lat, lng)
+        best = []  # max-heap of the k closest as (-distance, id)
+        max_ring = None
+        r = 0
+        while True:
+            for cell in self._ring(row, col, r):
+                for resource_id, (plat, plng) in self.cells.get(
+                        cell, {}).iteritems():
+                    if accept is not None and not accept(resource_id):
+                        continue
+                    d = haversine_km(lat, lng, plat, plng)
+                    if max_km is not None and d > max_km:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, resource_id))
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, (-d, resource_id))
+            searched = self._searched_km(lat, lng, row, col, r)
+            if len(best) == k and -best[0][0] <= searched:
+                break
+            if max_km is not None and searched >= max_km:
+                break
+            if max_ring is None:
+                max_ring = self._max_ring(row, col)
+            if r >= max_ring:
+                break
+            r += 1
+        return sorted((-d, resource_id) for d, resource_id in best)
+
+    def within(self, lat, lng, km, accept=None):
+        """Return (distance in km, resource id) pairs within km of
+        (lat, lng), ordered by distance."""
+        dlat = km / KM_PER_DEGREE
+        max_lat = min(abs(lat) + dlat, 89.9)
+        dlng = km / (KM_PER_DEGREE * math.cos(math.radians(max_lat)))
+        min_row, min_col = self.cell(lat - dlat, lng - dlng)
+        max_row, max_col = self.cell(lat + dlat, lng + dlng)
+        num_cells = (max_row - min_row + 1) * (max_col - min_col + 1)
+        if num_cells <= len(self.cells):
+            cells = ((i, j) for i in range(min_row, max_row + 1)
+                     for j in range(min_col, max_col + 1))
+        else:
+            cells = (c for c in self.cells.keys()
+                     if min_row <= c[0] <= max_row and
+                     min_col <= c[1] <= max_col)
+        matches = []
+        for cell in cells:
+            for resource_id, (plat, plng) in self.cells.get(cell,
+                                                            {}).iteritems():
+                if accept is not None and not accept(resource_id):
+                    continue
+                d = haversine_km(lat, lng, plat, plng)
+                if d <= km:
+                    matches.append((d, resource_id))
+        matches.sort()
+        return matches
+
+
+class ResourceLocator(object):
+    """
+    Spatial index over the coordinates of approved resources, kept for the
+    current catalog version. Writes committed by this process are applied to
+    it incrementally; writes from other processes and bulk writes to
+    resources cause a rebuild on the next lookup.
+    """
+
+    @staticmethod
+    def build():
+        index = SpatialIndex()
+        rows = db.session.query(Resource.id, Resource.latitude,
+                                Resource.longitude).filter(
+                                    Resource.latitude.isnot(None),
+                                    Resource.longitude.isnot(None))
+        for resource_id, lat, lng in rows:
+            index.insert(resource_id, lat, lng)
+        return index
+
+    @staticmethod
+    def update(index, changes):
+        if changes.has_bulk_writes(ResourceBase):
+            return False
+        for resource_id in changes.deleted_resource_ids:
+            index.remove(resource_id)
+        for resource_id, (resource_type, lat, lng) in \
+                changes.resources.iteritems():
+            index.remove(resource_id)
+            if resource_type == 'resource' and lat is not None and \
+                    lng is not None:
+                index.insert(resource_id, float(lat), float(lng))
+        return True
+
+    @staticmethod
+    def nearest(lat, lng, k, max_km=None, accept=None):
+        index = _resource_locator_cache.get()
+        with _resource_locator_cache.lock:
+            return index.nearest(lat, lng, k, max_km, accept)
+
+    @staticmethod
+    def within(lat, lng, km, accept=None):
+        index = _resource_locator_cache.get()
+        with _resource_locator_cache.lock:
+            return index.within(lat, lng, km, accept)
+
+
+_resource_locator_cache = CatalogCache(ResourceLocator.build,
+                                       ResourceLocator.update)
@@ -5,8 +5,9 @@ from wtforms.fields import SelectField, SelectMultipleField, TextAreaField
 
 from . import single_resource
 from .. import db
-from ..models import (Descriptor, OptionAssociation, RequiredOptionDescriptor,
-                      Resource, ResourceSuggestion, TextAssociation)
+from ..models import (Descriptor, DescriptorRegistry, OptionAssociation,
+                      OptionIndex, Resource, ResourceSuggestion,
+                      TextAssociation)
 from ..suggestion.views import save_associations
 from .forms import SingleResourceForm
 
@@ -16,11 +17,7 @@ from .forms import SingleResourceForm
 def index():
     """View resources in a list."""
     resources = Resource.query.all()
-    req_opt_desc = RequiredOptionDescriptor.query.all()
-    if req_opt_desc:
-        req_opt_desc = req_opt_desc[0]
-        req_opt_desc = Descriptor.query.filter_by(
-            id=req_opt_desc.descriptor_id).first()
+    req_opt_desc = DescriptorRegistry.get().required_option_descriptor
     req_options = {}
     if req_opt_desc:
         for val in req_opt_desc.values:
@@ -42,24 +39,16 @@ def search_resources():
         req_options = []
     resource_pool = Resource.query.filter(
         Resource.name.ilike('%{}%'.format(name))).all()
-    req_opt_desc = RequiredOptionDescriptor.query.all()
-    if req_opt_desc:
-        req_opt_desc = req_opt_desc[0]
-        req_opt_desc = Descriptor.query.filter_by(
-            id=req_opt_desc.descriptor_id).first()
+    req_opt_desc = DescriptorRegistry.get().required_option_descriptor
     resources = list(resource_pool)
     if req_opt_desc and len(req_options) > 0:
-        resources = []
-        int_req_options = []
-        for o in req_options:
-            int_req_options.append(req_opt_desc.values.index(str(o)))
-        for resource in resource_pool:
-            associations = OptionAssociation.query.filter_by(
-                resource_id=resource.id, descriptor_id=req_opt_desc.id)
-            for a in associations:
-                if a.option in int_req_options:
-                    resources.append(resource)
-                    break
+        int_req_options = [
+            req_opt_desc.index_of(str(o)) for o in req_options
+            if req_opt_desc.index_of(str(o)) is not None
+        ]
+        matches = OptionIndex.get().resources_with_any(req_opt_desc.id,
+                                                       int_req_options)
+        resources = [r for r in resource_pool if r.id in matches]
     query_req_options = {}
     if req_opt_desc is not None:
         for val in req_opt_desc.values:
@@ -96,17 +85,13 @@ def create():
             setattr(SingleResourceForm, descriptor.name, TextAreaField())
     form = SingleResourceForm()
     if form.validate_on_submit():
-        req_opt_desc = RequiredOptionDescriptor.query.all()
-        if req_opt_desc:
-            req_opt_desc = req_opt_desc[0]
-            descriptor = Descriptor.query.filter_by(
-                id=req_opt_desc.descriptor_id).first()
-            if descriptor is not None:
-                if not form[descriptor.name].data:
-                    flash('Error: Must set required descriptor: {}'.format(
-                        descriptor.name), 'form-error')
-                    return render_template(
-                        'single_resource/create.html', form=form)
+        descriptor = DescriptorRegistry.get().required_option_descriptor
+        if descriptor is not None:
+            if not form[descriptor.name].data:
+                flash('Error: Must set required descriptor: {}'.format(
+                    descriptor.name), 'form-error')
+                return render_template(
+                    'single_resource/create.html', form=form)
         new_resource = Resource(name=form.name.data)
         optional_fields = ['address', 'latitude', 'longitude']
         for field in optional_fields:
@@ -244,19 +229,15 @@ def edit(resource_id):
                 TextAreaField(default=default))
     form = SingleResourceForm()
     if form.validate_on_submit():
-        req_opt_desc = RequiredOptionDescriptor.query.all()
-        if req_opt_desc:
-            req_opt_desc = req_opt_desc[0]
-            descriptor = Descriptor.query.filter_by(
-                id=req_opt_desc.descriptor_id).first()
-            if descriptor is not None:
-                if not form[descriptor.name].data:
-                    flash('Error: Must set required descriptor: {}'.format(
-                        descriptor.name), 'form-error')
-                    return render_template(
-                        'single_resource/edit.html',
-                        form=form,
-                        resource_id=resource_id)
+        descriptor = DescriptorRegistry.get().required_option_descriptor
+        if descriptor is not None:
+            if not form[descriptor.name].data:
+                flash('Error: Must set required descriptor: {}'.format(
+                    descriptor.name), 'form-error')
+                return render_template(
+                    'single_resource/edit.html',
+                    form=form,
+                    resource_id=resource_id)
         # Field id is not needed for the form, hence omitted with [1:].
         for field_name in resource_field_names[1:]:
             # Avoid KeyError from polymorphic, contact variables.
@@ -1,5 +1,17 @@
 from flask import url_for
 
+# Values passed to one IN clause, to stay under SQLite's limit on the number
+# of bound parameters
+IN_CHUNK_SIZE = 500
+
+
+def chunks(items, size=IN_CHUNK_SIZE):
+    """Split items into lists of at most size items, e.g. to pass them to
+    IN clauses."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 def register_template_utils(app):
     """Register Jinja 2 helpers (called from __init__.py)."""
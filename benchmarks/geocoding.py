@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Compares geocoding new addresses one at a time, as imports used to, with
+the geocoding service's thread pool, against a local stand-in geocoder that
+takes 20 ms per request.
+
+    $ python benchmarks/geocoding.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.geocoding import GeocodingService, StubBackend  # noqa
+
+NUM_ADDRESSES = 200
+LATENCY = 0.02
+
+
+def main():
+    backend = StubBackend(latency=LATENCY)
+    addresses = ['%d Main St' % i for i in range(NUM_ADDRESSES)]
+
+    start = time.time()
+    for address in addresses:
+        backend(address, None)
+    sequential = time.time() - start
+    print 'sequential:           %6.2fs' % sequential
+
+    for workers, keys, rate in [(8, ['a'], 50), (16, ['a', 'b'], 50),
+                                (16, ['a'], 1000)]:
+        service = GeocodingService(backend, keys=keys, rate=rate,
+                                   workers=workers)
+        start = time.time()
+        results = service.geocode_many(addresses)
+        elapsed = time.time() - start
+        assert all(r.status == 'OK' for r in results.itervalues())
+        print '%2d workers, %d key(s) at %4d/s: %6.2fs (%.1fx)' % (
+            workers, len(keys), rate, elapsed, sequential / elapsed)
+
+
+if __name__ == '__main__':
+    main()
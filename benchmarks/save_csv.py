@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Compares the set-based CSV writer with saving a CSV row by row, as the
+save step used to, for a CSV of 10k rows and 20 columns on a scratch
+SQLite database. The row-by-row save is timed on a tenth of the rows and
+scaled up. Also compares the size of the staged rows with pickling each
+row.
+
+    $ python benchmarks/save_csv.py
+"""
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+_, DB_PATH = tempfile.mkstemp(suffix='.sqlite')
+os.environ['TEST_DATABASE_URL'] = 'sqlite:///' + DB_PATH
+
+from app import create_app, db  # noqa
+from app.bulk_resource.writer import save_csv_storage  # noqa
+from app.models import (CatalogCache, CsvDescriptor, CsvRowBlock,  # noqa
+                        CsvStorage, Descriptor, GeocoderCache,
+                        OptionAssociation, Rating, RequiredOptionDescriptor,
+                        Resource, ResourceSuggestion, TextAssociation)
+
+NUM_ROWS = 10000
+BASELINE_ROWS = 1000
+# Besides Name and Address
+NUM_TEXT_COLUMNS = 9
+NUM_OPTION_COLUMNS = 9
+OPTIONS = ['option %d' % i for i in range(10)]
+# Rows per upload request of the CSV wizard
+STAGE_BATCH_SIZE = 100
+
+
+def make_rows(num_rows, rand):
+    rows = []
+    for i in range(num_rows):
+        row = {'Name': 'Resource %d' % i, 'Address': '%d Main St' % i}
+        for c in range(NUM_TEXT_COLUMNS):
+            row['Text %d' % c] = 'text %d' % rand.randint(0, 3)
+        for c in range(NUM_OPTION_COLUMNS):
+            row['Option %d' % c] = ';'.join(
+                rand.sample(OPTIONS, rand.randint(1, 3)))
+        rows.append(row)
+    return rows
+
+
+def stage(rows, action):
+    csv_storage = CsvStorage(action=action)
+    db.session.add(csv_storage)
+    db.session.flush()
+    descriptors = dict((d.name, d.id) for d in Descriptor.query)
+    for c in range(NUM_TEXT_COLUMNS):
+        name = 'Text %d' % c
+        db.session.add(CsvDescriptor(
+            csv_storage=csv_storage, name=name,
+            descriptor_id=descriptors.get(name)))
+    for c in range(NUM_OPTION_COLUMNS):
+        name = 'Option %d' % c
+        db.session.add(CsvDescriptor(
+            csv_storage=csv_storage, name=name, descriptor_type='option',
+            values=set(OPTIONS), descriptor_id=descriptors.get(name)))
+    resource_ids = dict(db.session.query(Resource.name, Resource.id))
+    # As uploaded, in batches
+    for i in range(0, len(rows), STAGE_BATCH_SIZE):
+        batch = rows[i:i + STAGE_BATCH_SIZE]
+        csv_storage.append_rows(
+            batch, [resource_ids.get(row['Name']) for row in batch])
+    db.session.commit()
+    return csv_storage
+
+
+def save_row_by_row(csv_storage):
+    """The save step before the set-based writer: one query per descriptor
+    cell and existing association, and one ORM object per new row."""
+    update = csv_storage.action == 'update'
+    RequiredOptionDescriptor.query.delete()
+    if not update:
+        OptionAssociation.query.delete()
+        TextAssociation.query.delete()
+        ResourceSuggestion.query.delete()
+        Rating.query.delete()
+        Descriptor.query.delete()
+        Resource.query.delete()
+    for desc in csv_storage.csv_descriptors:
+        if not (update and desc.descriptor_id):
+            db.session.add(Descriptor(name=desc.name,
+                                      values=sorted(desc.values or []),
+                                      is_searchable=True))
+    for _, data, resource_id in csv_storage.iter_rows():
+        if update and resource_id:
+            resource = Resource.query.filter_by(id=resource_id).first()
+        else:
+            cached = GeocoderCache.query.filter_by(
+                address=data['Address']).first()
+            resource = Resource(name=data['Name'],
+                                address=data['Address'],
+                                latitude=cached.latitude,
+                                longitude=cached.longitude)
+            db.session.add(resource)
+        for key in data:
+            if key == 'Name' or key == 'Address':
+                continue
+            descriptor = Descriptor.query.filter_by(name=key).first()
+            if descriptor.values:
+                opts = [descriptor.values.index(s.strip())
+                        for s in data[key].split(';')]
+                if update:
+                    existing = OptionAssociation.query.filter_by(
+                        resource_id=resource.id, descriptor_id=descriptor.id)
+                    if set(o.option for o in existing) == set(opts):
+                        continue
+                    for o in existing:
+                        db.session.delete(o)
+                for option in opts:
+                    db.session.add(OptionAssociation(
+                        resource=resource, descriptor=descriptor,
+                        option=option))
+            else:
+                if update:
+                    existing = TextAssociation.query.filter_by(
+                        resource_id=resource.id,
+                        descriptor_id=descriptor.id).first()
+                    if existing is not None:
+                        existing.text = data[key]
+                        continue
+                db.session.add(TextAssociation(
+                    resource=resource, descriptor=descriptor,
+                    text=data[key]))
+    db.session.add(RequiredOptionDescriptor(descriptor_id=-1))
+    db.session.delete(csv_storage)
+    db.session.commit()
+
+
+def save_set_based(csv_storage):
+    save_csv_storage(csv_storage, lambda addresses: {})
+    db.session.commit()
+
+
+def run(save, num_rows):
+    """Time saving a reset and then an update of num_rows rows, in which a
+    tenth of the cells change."""
+    db.drop_all()
+    db.create_all()
+    CatalogCache.clear_all()
+    rand = random.Random(0)
+    db.session.bulk_insert_mappings(GeocoderCache, [{
+        'address': '%d Main St' % i,
+        'address_key': '%d main st' % i,
+        'status': 'OK',
+        'latitude': 47.6,
+        'longitude': -122.3
+    } for i in range(num_rows)])
+    db.session.commit()
+    rows = make_rows(num_rows, rand)
+    times = []
+    for action in ['reset', 'update']:
+        csv_storage = stage(rows, action)
+        start = time.time()
+        save(csv_storage)
+        times.append(time.time() - start)
+        db.session.remove()
+        changed = make_rows(num_rows, rand)
+        for row, new in zip(rows, changed):
+            for key in row:
+                if rand.random() < 0.1:
+                    row[key] = new[key]
+    return times
+
+
+def staged_size(num_rows):
+    """Bytes taken by num_rows staged rows as compressed blocks, and as one
+    pickled dict per row as they used to be."""
+    rows = make_rows(num_rows, random.Random(0))
+    header = ['Name', 'Address'] + sorted(set(rows[0]) - set(['Name',
+                                                              'Address']))
+    blocks = sum(len(CsvRowBlock.encode(header, rows[i:i + STAGE_BATCH_SIZE]))
+                 for i in range(0, num_rows, STAGE_BATCH_SIZE))
+    pickled = sum(len(pickle.dumps(row)) for row in rows)
+    return blocks, pickled
+
+
+def main():
+    app = create_app('testing')
+    with app.app_context():
+        try:
+            columns = 2 + NUM_TEXT_COLUMNS + NUM_OPTION_COLUMNS
+            scale = float(NUM_ROWS) / BASELINE_ROWS
+            baseline = [t * scale for t in
+                        run(save_row_by_row, BASELINE_ROWS)]
+            set_based = run(save_set_based, NUM_ROWS)
+            for action, before, after in zip(['reset', 'update'], baseline,
+                                             set_based):
+                print '%s of %d rows x %d columns: row by row ~%.0fs, ' \
+                    'set-based %.1fs (%.0fx)' % (action, NUM_ROWS, columns,
+                                                 before, after, before / after)
+            blocks, pickled = staged_size(NUM_ROWS)
+            print 'staged rows: %.1f MB pickled, %.1f MB in blocks ' \
+                '(%.0fx)' % (pickled / 1e6, blocks / 1e6,
+                             float(pickled) / blocks)
+        finally:
+            db.session.remove()
+            os.remove(DB_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Compares SpatialIndex nearest neighbour and radius queries against a linear
+scan over 100k points spread around Seattle.
+
+    $ python benchmarks/spatial_index.py
+"""
+import heapq
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.models.spatial_index import SpatialIndex, haversine_km  # noqa
+
+NUM_POINTS = 100000
+NUM_QUERIES = 200
+K = 10
+RADIUS_KM = 2.0
+
+
+def timed(f, queries):
+    start = time.time()
+    for lat, lng in queries:
+        f(lat, lng)
+    return (time.time() - start) / len(queries) * 1000
+
+
+def main():
+    rand = random.Random(0)
+    points = [(i, 47.6 + rand.uniform(-1, 1), -122.3 + rand.uniform(-1, 1))
+              for i in range(NUM_POINTS)]
+    queries = [(47.6 + rand.uniform(-1, 1), -122.3 + rand.uniform(-1, 1))
+               for _ in range(NUM_QUERIES)]
+
+    start = time.time()
+    index = SpatialIndex()
+    for resource_id, lat, lng in points:
+        index.insert(resource_id, lat, lng)
+    print 'Built index over %d points in %.2fs' % (
+        NUM_POINTS, time.time() - start)
+
+    def scan_nearest(lat, lng):
+        return heapq.nsmallest(K, ((haversine_km(lat, lng, plat, plng), i)
+                                   for i, plat, plng in points))
+
+    def scan_within(lat, lng):
+        return sorted((d, i) for d, i in (
+            (haversine_km(lat, lng, plat, plng), i)
+            for i, plat, plng in points) if d <= RADIUS_KM)
+
+    results = [
+        ('%d nearest' % K, lambda lat, lng: index.nearest(lat, lng, K),
+         scan_nearest),
+        ('within %.0f km' % RADIUS_KM,
+         lambda lat, lng: index.within(lat, lng, RADIUS_KM), scan_within),
+    ]
+    for name, indexed, scan in results:
+        for lat, lng in queries[:20]:
+            assert [i for _, i in indexed(lat, lng)] == \
+                [i for _, i in scan(lat, lng)]
+        index_ms = timed(indexed, queries)
+        scan_ms = timed(scan, queries[:20])
+        print '%-14s grid: %8.3f ms/query  linear scan: %8.3f ms/query  ' \
+            '(%.0fx)' % (name, index_ms, scan_ms, scan_ms / index_ms)
+
+
+if __name__ == '__main__':
+    main()
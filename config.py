@@ -38,6 +38,26 @@ class Config:
 
     RAYGUN_APIKEY = os.environ.get('RAYGUN_APIKEY')
 
+    # Geocoding of imported addresses: 'google' or 'stub' (a local stand-in)
+    GEOCODER_BACKEND = os.environ.get('GEOCODER_BACKEND') or 'google'
+    # Pool of Google API keys, comma separated
+    GEOCODER_API_KEYS = [
+        k.strip()
+        for k in (os.environ.get('GOOGLE_API_KEYS') or ','.join(
+            os.environ.get(v) or ''
+            for v in ('GOOGLE_API_KEY', 'GOOGLE_API_1', 'GOOGLE_API_2')))
+        .split(',') if k.strip()
+    ]
+    # Requests per second allowed for each key
+    GEOCODER_RATE_PER_KEY = float(os.environ.get('GEOCODER_RATE_PER_KEY', 50))
+    GEOCODER_WORKERS = int(os.environ.get('GEOCODER_WORKERS', 8))
+    # Seconds before an address that could not be geocoded is tried again
+    GEOCODER_NEGATIVE_TTL = int(
+        os.environ.get('GEOCODER_NEGATIVE_TTL', 24 * 60 * 60))
+
+    # Seconds a background job saving a CSV may run
+    CSV_SAVE_JOB_TIMEOUT = int(os.environ.get('CSV_SAVE_JOB_TIMEOUT', 60 * 60))
+
     # Parse the REDIS_URL to set RQ config variables
     urlparse.uses_netloc.append('redis')
     url = urlparse.urlparse(REDIS_URL)
@@ -76,6 +96,7 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
     WTF_CSRF_ENABLED = False
+    GEOCODER_BACKEND = 'stub'
 
 
 class ProductionConfig(Config):
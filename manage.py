@@ -10,9 +10,11 @@ from rq import Connection, Queue, Worker
 
 from app import create_app, db
 from app.models import (CsvBodyCell, CsvBodyRow, CsvContainer, CsvHeaderCell,
-                        CsvHeaderRow, Descriptor, OptionAssociation,
+                        CsvHeaderRow, Descriptor, GeocoderCache,
+                        OptionAssociation,
                         RequiredOptionDescriptor, Resource, ResourceBase,
-                        ResourceSuggestion, Role, TextAssociation, User)
+                        ResourceSuggestion, Role, SearchIndex,
+                        TextAssociation, User, restore_previous_generation)
 
 # Import settings from .env file. Must define FLASK_CONFIG
 if os.path.exists('.env'):
@@ -90,6 +92,41 @@ def add_seattle_data():
     Resource.add_seattle_data()
 
 
+@manager.command
+def rebuild_rating_aggregates():
+    """Recomputes the rating count and sum stored on each resource."""
+    Resource.rebuild_rating_aggregates()
+
+
+@manager.command
+def rebuild_search_index():
+    """Creates the full-text search table if needed and reindexes every
+    resource."""
+    SearchIndex.rebuild()
+    db.session.commit()
+
+
+@manager.command
+def backfill_geocoder_cache():
+    """Sets the normalized address key of geocoder cache rows stored before
+    there were keys, merging the rows of variants of the same address."""
+    merged = GeocoderCache.backfill_address_keys()
+    db.session.commit()
+    print('Backfilled address keys, merging {} duplicate rows.'.format(merged))
+
+
+@manager.command
+def restore_previous_catalog():
+    """Switches back to the catalog replaced by the last reset import.
+    Running it again switches forward again."""
+    generation = restore_previous_generation(db.session)
+    if generation is None:
+        print('There is no previous catalog to restore.')
+        return
+    db.session.commit()
+    print('Restored catalog generation {}.'.format(generation))
+
+
 @manager.command
 def setup_dev():
     """Runs the set-up needed for local development."""
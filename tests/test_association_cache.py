@@ -0,0 +1,97 @@
+import json
+import unittest
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import (CatalogCache, Descriptor, OptionAssociation,
+                        Resource, ResourceAssociations, TextAssociation)
+
+
+class ResourceAssociationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_resources(self, count):
+        description = Descriptor(name='description', values=[])
+        open_days = Descriptor(name='open', values=['Mon', 'Tue'])
+        resources = []
+        for i in range(count):
+            r = Resource(name='resource %d' % i)
+            r.text_descriptors.append(
+                TextAssociation(descriptor=description, text='text %d' % i))
+            for option in [0, 1, 1]:
+                r.option_descriptors.append(
+                    OptionAssociation(descriptor=open_days, option=option))
+            resources.append(r)
+        db.session.add_all(resources)
+        db.session.commit()
+        return resources
+
+    def count_queries(self, f):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            result = f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return len(statements), result
+
+    def test_get_many(self):
+        """Test batch lookups and that repeats are served from memory"""
+        r1, r2 = self.add_resources(2)
+        ids = [r1.id, r2.id, 1000]
+        count, associations = self.count_queries(
+            lambda: ResourceAssociations.get_many(ids))
+        self.assertEquals(associations[r1.id], {
+            'description': 'text 0',
+            'open': ['Mon', 'Tue']
+        })
+        self.assertEquals(associations[r2.id]['description'], 'text 1')
+        self.assertEquals(associations[1000], None)
+        # The catalog version for each cache, the descriptors and required
+        # option descriptor, then the ids of the resources and each
+        # association table once
+        self.assertEquals(count, 7)
+
+        count, _ = self.count_queries(
+            lambda: ResourceAssociations.get_many([r1.id, r2.id]))
+        # Only the catalog version is read
+        self.assertEquals(count, 1)
+
+    def test_invalidated_on_write(self):
+        """Test that entries are dropped when their resource changes"""
+        r1, r2 = self.add_resources(2)
+        ResourceAssociations.get_many([r1.id, r2.id])
+        r1.text_descriptors[0].text = 'changed'
+        db.session.commit()
+        count, associations = self.count_queries(
+            lambda: ResourceAssociations.get_many([r1.id, r2.id]))
+        self.assertEquals(associations[r1.id]['description'], 'changed')
+        self.assertEquals(associations[r2.id]['description'], 'text 1')
+
+    def test_batch_endpoint(self):
+        """Test the batch associations endpoint"""
+        r1, r2 = self.add_resources(2)
+        client = self.app.test_client()
+        response = client.get('/get-associations?ids=%d,%d' % (r1.id, r2.id))
+        associations = json.loads(response.data)
+        self.assertEquals(sorted(associations), [str(r1.id), str(r2.id)])
+        self.assertEquals(associations[str(r2.id)]['description'], 'text 1')
+        response = client.get('/get-associations/%d' % r1.id)
+        self.assertEquals(json.loads(response.data)['open'], ['Mon', 'Tue'])
+        response = client.get('/get-associations?ids=1,x')
+        self.assertEquals(response.status_code, 400)
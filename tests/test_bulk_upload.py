@@ -0,0 +1,586 @@
+import json
+import unittest
+from StringIO import StringIO
+
+from flask import url_for
+from flask.ext.login import login_user
+from rq.exceptions import NoSuchJobError
+
+from app import create_app, db
+from app.bulk_resource import jobs, views
+from app.bulk_resource.views import (ingest_csv, missing_required_names,
+                                     resumable_storage, save_rows,
+                                     store_fields)
+from app.geocoding import GeocodeResult, GeocodingService
+from app.models import (CatalogCache, CsvDescriptor, CsvRowBlock, CsvStorage,
+                        Descriptor, GeocoderCache, OptionAssociation,
+                        Resource, Role, User)
+
+
+class FakeJob(object):
+    """Stands in for an RQ job, as there is no Redis to run tests with.
+    The job runs in the test's process when perform is called, and every
+    state of its meta data that is saved is kept."""
+    jobs = {}
+    current = None
+
+    def __init__(self, func, args, kwargs):
+        self.id = 'job-%d' % (len(FakeJob.jobs) + 1)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.meta = {}
+        self.saved_meta = []
+        self.result = None
+        self.status = 'queued'
+        FakeJob.jobs[self.id] = self
+
+    @staticmethod
+    def fetch(job_id, connection=None):
+        if job_id not in FakeJob.jobs:
+            raise NoSuchJobError(job_id)
+        return FakeJob.jobs[job_id]
+
+    def save(self):
+        self.saved_meta.append(dict(self.meta))
+
+    def get_status(self):
+        return self.status
+
+    @property
+    def is_finished(self):
+        return self.status == 'finished'
+
+    @property
+    def is_failed(self):
+        return self.status == 'failed'
+
+    def perform(self):
+        FakeJob.current = self
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.status = 'finished'
+        except Exception:
+            self.status = 'failed'
+        finally:
+            FakeJob.current = None
+
+
+class FakeQueue(object):
+    def enqueue_call(self, func, args, kwargs=None, timeout=None):
+        return FakeJob(func, args, kwargs or {})
+
+
+class BulkUploadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_save_rows(self):
+        """Test storing a batch of CSV rows and linking them to resources"""
+        user = User(email='user@example.com', password='password')
+        existing = Resource(name='Shelter')
+        db.session.add_all([
+            user, existing,
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0),
+            GeocoderCache(address='2 Main St', latitude=3.0, longitude=4.0)
+        ])
+        db.session.commit()
+        rows = [{'Name': ' Shelter', 'Address': '1 Main St '},
+                {'Name': 'Library', 'Address': '2 Main St'}]
+        with self.app.test_request_context():
+            login_user(user)
+            db.session.add(CsvStorage(user=user, action='update'))
+            db.session.commit()
+            self.assertEquals(save_rows(rows), [])
+            csv_storage = CsvStorage.most_recent(user=user)
+        self.assertEquals([r for _, _, r in csv_storage.iter_rows()],
+                          [None, None])
+        csv_storage.link_resources()
+        db.session.commit()
+        csv_rows = list(csv_storage.iter_rows())
+        self.assertEquals([data for _, data, _ in csv_rows], [
+            {'Name': 'Shelter', 'Address': '1 Main St'},
+            {'Name': 'Library', 'Address': '2 Main St'}
+        ])
+        self.assertEquals([r for _, _, r in csv_rows], [existing.id, None])
+
+    def test_save_rows_geocodes(self):
+        """Test that uncached addresses are geocoded and cached"""
+        user = User(email='user@example.com', password='password')
+        db.session.add(user)
+        db.session.commit()
+        rows = [{'Name': 'Shelter', 'Address': '1 Main St'},
+                {'Name': 'Library', 'Address': 'invalid'}]
+        with self.app.test_request_context():
+            login_user(user)
+            db.session.add(CsvStorage(user=user, action='reset'))
+            db.session.commit()
+            errors = save_rows(rows)
+        self.assertEquals(errors, [{
+            'row': 1,
+            'message':
+            'Address cannot be geocoded due to ZERO_RESULTS: invalid'
+        }])
+        self.assertEquals(
+            sorted((c.address, c.status) for c in GeocoderCache.query),
+            [('1 Main St', 'OK'), ('invalid', 'ZERO_RESULTS')])
+
+    def ingest(self, data, action='reset'):
+        user = User(email='user@example.com', password='password')
+        db.session.add_all([
+            user,
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0),
+            GeocoderCache(address='2 Main St', latitude=3.0, longitude=4.0)
+        ])
+        db.session.commit()
+        with self.app.test_request_context():
+            login_user(user)
+            errors = ingest_csv(StringIO(data), action)
+            return errors, CsvStorage.most_recent(user=user)
+
+    def test_ingest_csv(self):
+        """Test parsing and storing a CSV file on the server"""
+        errors, csv_storage = self.ingest(
+            '\xef\xbb\xbfName, Address ,Hours\n'
+            'Shelter,1 Main St,9-5\n'
+            ',,\n'
+            'Library, 2 Main St,"10-6, weekdays"\n'
+            'Clinic,3 Main St,\n')
+        self.assertEquals(errors, [])
+        # Addresses are geocoded by the save job, not during the request
+        self.assertEquals(GeocoderCache.query.count(), 2)
+        self.assertEquals(csv_storage.action, 'reset')
+        self.assertEquals([d.name for d in csv_storage.csv_descriptors],
+                          ['Hours'])
+        self.assertEquals(csv_storage.header, ['Name', 'Address', 'Hours'])
+        self.assertEquals([data for _, data, _ in csv_storage.iter_rows()], [
+            {'Name': 'Shelter', 'Address': '1 Main St', 'Hours': '9-5'},
+            {'Name': 'Library', 'Address': '2 Main St',
+             'Hours': '10-6, weekdays'},
+            {'Name': 'Clinic', 'Address': '3 Main St', 'Hours': ''}
+        ])
+
+    def test_ingest_csv_update(self):
+        """Test linking the rows of an update to existing resources"""
+        existing = Resource(name='Library')
+        db.session.add(existing)
+        db.session.commit()
+        errors, csv_storage = self.ingest(
+            'Name,Address\nShelter,1 Main St\nLibrary,2 Main St\n', 'update')
+        self.assertEquals(errors, [])
+        self.assertEquals([r for _, _, r in csv_storage.iter_rows()],
+                          [None, existing.id])
+
+    def test_ingest_csv_errors(self):
+        """Test that nothing is kept from a CSV file with errors"""
+        errors, csv_storage = self.ingest(
+            'Name,Address\nShelter,1 Main St\nLibrary,\nClinic\n')
+        self.assertEquals(errors, [
+            "Row 3 is missing a required 'Address' value.",
+            'Row 4 has the incorrect number of columns: 1. Expected: 2'
+        ])
+        self.assertEquals(csv_storage, None)
+
+    def test_ingest_csv_missing_column(self):
+        """Test that CSV files without the required columns are rejected"""
+        errors, csv_storage = self.ingest('Name\nShelter\n')
+        self.assertEquals(errors, ["'Address' is a required column name."])
+        self.assertEquals(csv_storage, None)
+
+    def test_row_blocks(self):
+        """Test staging rows in compressed blocks numbered across appends"""
+        csv_storage = CsvStorage(action='update', header=['Name', 'Address',
+                                                          'Hours'])
+        csv_storage.append_rows([
+            {'Name': 'Shelter', 'Address': '1 Main St', 'Hours': '9-5'},
+            {'Name': 'Library', 'Address': '2 Main St',
+             'Hours': u'10\u20136'}
+        ], [None, 4])
+        csv_storage.append_rows([{'Name': 'Clinic', 'Address': '3 Main St'}])
+        db.session.commit()
+        self.assertEquals(CsvRowBlock.query.count(), 2)
+        self.assertEquals(csv_storage.count_rows(), 3)
+        self.assertEquals(list(csv_storage.iter_rows()), [
+            (0, {'Name': 'Shelter', 'Address': '1 Main St', 'Hours': '9-5'},
+             None),
+            (1, {'Name': 'Library', 'Address': '2 Main St',
+                 'Hours': u'10\u20136'}, 4),
+            (2, {'Name': 'Clinic', 'Address': '3 Main St', 'Hours': ''}, None)
+        ])
+        db.session.delete(csv_storage)
+        db.session.commit()
+        self.assertEquals(CsvRowBlock.query.count(), 0)
+
+    def test_resume_upload(self):
+        """Test that batches sent again when an upload resumes are stored
+        once"""
+        user = User(email='user@example.com', password='password')
+        db.session.add_all([
+            user,
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0),
+            GeocoderCache(address='2 Main St', latitude=3.0, longitude=4.0)
+        ])
+        db.session.commit()
+        fields = ['Name', 'Address']
+        rows = [{'Name': 'Shelter', 'Address': '1 Main St'},
+                {'Name': 'Library', 'Address': '2 Main St'}]
+        with self.app.test_request_context():
+            login_user(user)
+            self.assertEquals(resumable_storage(fields, 'reset', 'a.csv:10'),
+                              None)
+            store_fields(fields, 'reset', 'a.csv:10')
+            db.session.commit()
+            self.assertEquals(save_rows(rows[:1], first_row=0), [])
+            csv_storage = resumable_storage(fields, 'reset', 'a.csv:10')
+            self.assertEquals(
+                csv_storage.get_checkpoint('staging').row_offset, 1)
+            self.assertEquals(resumable_storage(fields, 'update', 'a.csv:10'),
+                              None)
+            self.assertEquals(resumable_storage(fields, 'reset', 'b.csv:10'),
+                              None)
+            self.assertEquals(save_rows(rows[:1], first_row=0), [])
+            self.assertEquals(save_rows(rows[1:], first_row=1), [])
+        self.assertEquals([data['Name'] for _, data, _ in
+                           csv_storage.iter_rows()], ['Shelter', 'Library'])
+        self.assertEquals(csv_storage.get_checkpoint('staging').row_offset, 2)
+
+    def test_resume_upload_failed_rows(self):
+        """Test that the rows of a batch that geocode are stored, and the
+        others once the batch is sent again and they geocode"""
+        geocoded = []
+
+        def backend(address, key):
+            geocoded.append(address)
+            if address == '3 Main St' and geocoded.count(address) == 1:
+                return GeocodeResult('UNKNOWN_ERROR', None)
+            return GeocodeResult('OK', [1.0, 2.0])
+
+        self.app.extensions['geocoding_service'] = GeocodingService(backend)
+        user = User(email='user@example.com', password='password')
+        db.session.add(user)
+        db.session.commit()
+        fields = ['Name', 'Address']
+        rows = [{'Name': 'Resource %d' % i, 'Address': '%d Main St' % i}
+                for i in range(4)]
+        with self.app.test_request_context():
+            login_user(user)
+            store_fields(fields, 'reset', 'a.csv:10')
+            db.session.commit()
+            self.assertEquals(save_rows(rows[:2], first_row=0), [])
+            self.assertEquals(save_rows(rows[2:], first_row=2), [{
+                'row': 1,
+                'message': 'Address cannot be geocoded due to '
+                'UNKNOWN_ERROR: 3 Main St'}])
+            csv_storage = resumable_storage(fields, 'reset', 'a.csv:10')
+            self.assertEquals(csv_storage.count_rows(), 3)
+            self.assertEquals(
+                csv_storage.get_checkpoint('staging').row_offset, 3)
+
+            # The upload resumes with the batch that failed, of which only
+            # the row that failed is geocoded and stored
+            attempts = len(geocoded)
+            self.assertEquals(save_rows(rows[2:], first_row=2), [])
+            self.assertEquals(geocoded[attempts:], ['3 Main St'])
+            self.assertEquals(
+                csv_storage.get_checkpoint('staging').row_offset, 4)
+            # A stored batch sent again is neither geocoded nor stored
+            del geocoded[:]
+            self.assertEquals(save_rows(rows[:2], first_row=0), [])
+            self.assertEquals(geocoded, [])
+        self.assertEquals([data['Name'] for _, data, _ in
+                           csv_storage.iter_rows()],
+                          ['Resource %d' % i for i in range(4)])
+
+    def test_staged_through(self):
+        """Test finding the rows staged and counting those without gaps"""
+        csv_storage = CsvStorage(action='reset', header=['Name', 'Address'])
+        for first_row in (0, 4, 6):
+            csv_storage.append_rows([{'Name': 'Shelter', 'Address': 'x'}] * 2,
+                                    first_row=first_row)
+        self.assertEquals(csv_storage.staged_through(), 2)
+        self.assertEquals(csv_storage.staged_rows(1, 5), set([1, 4, 5]))
+        csv_storage.append_rows([{'Name': 'Shelter', 'Address': 'x'}] * 2,
+                                first_row=2)
+        self.assertEquals(csv_storage.staged_through(2), 8)
+
+    def test_missing_required_names(self):
+        """Test finding the resources that will lack the required option"""
+        types = Descriptor(name='Type', values=['Food', 'Housing'])
+        resources = dict((name, Resource(name=name)) for name in
+                         ['Shelter', 'Clinic', 'Library', 'Park'])
+        db.session.add_all(resources.values() + [
+            OptionAssociation(resource=resources['Shelter'], descriptor=types,
+                              option=0),
+            OptionAssociation(resource=resources['Library'], descriptor=types,
+                              option=1)
+        ])
+        db.session.commit()
+        rows = [{'Name': 'Shelter', 'Address': '1 Main St', 'Type': ''},
+                {'Name': 'Clinic', 'Address': '2 Main St', 'Type': ''},
+                {'Name': 'Bakery', 'Address': '3 Main St', 'Type': 'Food'},
+                {'Name': 'Market', 'Address': '4 Main St', 'Type': ''}]
+        resource_ids = [resources['Shelter'].id, resources['Clinic'].id, None,
+                        None]
+
+        # Existing values are kept if the CSV has no Type column
+        csv_storage = CsvStorage(action='update', header=['Name', 'Address'])
+        csv_storage.append_rows(rows, resource_ids)
+        self.assertEquals(missing_required_names(csv_storage, 'Type'),
+                          set(['Clinic', 'Bakery', 'Market', 'Park']))
+
+        csv_storage = CsvStorage(action='update',
+                                 header=['Name', 'Address', 'Type'])
+        csv_storage.append_rows(rows, resource_ids)
+        self.assertEquals(missing_required_names(csv_storage, 'Type'),
+                          set(['Shelter', 'Clinic', 'Market', 'Park']))
+
+        csv_storage = CsvStorage(action='reset',
+                                 header=['Name', 'Address', 'Type'])
+        csv_storage.append_rows(rows)
+        self.assertEquals(missing_required_names(csv_storage, 'Type'),
+                          set(['Shelter', 'Clinic', 'Market']))
+
+        csv_storage = CsvStorage(action='update',
+                                 header=['Name', 'Address', 'Open'])
+        csv_storage.append_rows(rows, resource_ids)
+        self.assertEquals(missing_required_names(csv_storage, 'Open'),
+                          set(['Shelter', 'Clinic', 'Bakery', 'Market',
+                               'Library', 'Park']))
+
+    def upload_client(self):
+        # Pages show the dashboard of the user's role
+        Role.insert_roles()
+        user = User(email='user@example.com', password='password',
+                    confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+        self.user = user
+        return client
+
+    def upload(self, client, **data):
+        response = client.post('/bulk-resource/_upload',
+                               data={'json': json.dumps(data)})
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_upload_batches(self):
+        """Test uploading the fields and rows of a CSV in batches"""
+        client = self.upload_client()
+        rows = [{'Name': 'Resource %d' % i, 'Address': '%d Main St' % i}
+                for i in range(3)]
+        response = self.upload(client, action='fields-reset',
+                               fields=['Name', 'Address'], fileKey='a.csv:1')
+        self.assertEquals(response['status'], 'Success')
+        self.assertFalse('resumeFrom' in response)
+        for first_row in (0, 2):
+            response = self.upload(client, action='reset-update',
+                                   rows=rows[first_row:first_row + 2],
+                                   firstRow=first_row)
+            self.assertEquals(response['status'], 'Success')
+        response = self.upload(client, action='finished')
+        self.assertEquals(response['redirect'],
+                          '/bulk-resource/set-descriptor-types')
+        csv_storage = CsvStorage.most_recent(user=self.user)
+        self.assertEquals([data for _, data, _ in csv_storage.iter_rows()],
+                          rows)
+        checkpoint = csv_storage.get_checkpoint('staging')
+        self.assertEquals((checkpoint.row_offset, checkpoint.done), (3, True))
+
+    def test_upload_resent_batch(self):
+        """Test resuming an upload and sending a stored batch again"""
+        client = self.upload_client()
+        rows = [{'Name': 'Resource %d' % i, 'Address': '%d Main St' % i}
+                for i in range(2)]
+        self.upload(client, action='fields-update',
+                    fields=['Name', 'Address'], fileKey='a.csv:1')
+        self.upload(client, action='update', rows=rows, firstRow=0)
+
+        # The tab is closed and the same file uploaded again
+        response = self.upload(client, action='fields-update',
+                               fields=['Name', 'Address'], fileKey='a.csv:1')
+        self.assertEquals(response['resumeFrom'], 2)
+        response = self.upload(client, action='update', rows=rows,
+                               firstRow=0)
+        self.assertEquals(response['status'], 'Success')
+        self.assertEquals(CsvStorage.query.count(), 1)
+        self.assertEquals(CsvStorage.most_recent(user=self.user).count_rows(),
+                          2)
+
+        # Another file starts a new upload
+        response = self.upload(client, action='fields-update',
+                               fields=['Name', 'Address'], fileKey='b.csv:1')
+        self.assertFalse('resumeFrom' in response)
+        self.assertEquals(CsvStorage.query.count(), 2)
+
+    def test_upload_failed_rows(self):
+        """Test that the rows of a batch that cannot be geocoded are
+        reported and left out"""
+        client = self.upload_client()
+        self.upload(client, action='fields-reset',
+                    fields=['Name', 'Address'], fileKey='a.csv:1')
+        response = self.upload(client, action='reset-update', rows=[
+            {'Name': 'Shelter', 'Address': '1 Main St'},
+            {'Name': 'Library', 'Address': 'invalid'}
+        ], firstRow=0)
+        self.assertEquals(response['status'], 'Error')
+        self.assertEquals(response['errors'], [{
+            'row': 1,
+            'message':
+            'Address cannot be geocoded due to ZERO_RESULTS: invalid'
+        }])
+        csv_storage = CsvStorage.most_recent(user=self.user)
+        self.assertEquals([data['Name'] for _, data, _ in
+                           csv_storage.iter_rows()], ['Shelter'])
+        self.assertEquals(csv_storage.get_checkpoint('staging').row_offset, 1)
+        response = self.upload(client, action='finished', numRows=2)
+        self.assertEquals(response, {
+            'status': 'Error',
+            'message': '1 rows of the CSV are not stored yet'})
+
+    def fake_queue(self):
+        """Enqueue save jobs as FakeJob, run with the test's app."""
+        FakeJob.jobs = {}
+        patches = [(views, 'get_queue', FakeQueue),
+                   (jobs, 'Job', FakeJob),
+                   (jobs, 'get_connection', lambda: None),
+                   (jobs, 'get_current_job', lambda: FakeJob.current),
+                   (jobs, 'create_app', lambda config: self.app)]
+        for module, name, value in patches:
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, value)
+
+    def stage_csv(self, rows):
+        csv_storage = CsvStorage(user=self.user, action='reset')
+        csv_storage.append_rows([{
+            'Name': name, 'Address': address, 'Hours': hours
+        } for name, address, hours in rows])
+        db.session.add(CsvDescriptor(csv_storage=csv_storage, name='Hours'))
+        db.session.commit()
+        return csv_storage.id
+
+    def save_status(self, client, job_id):
+        response = client.get('/bulk-resource/save-csv/%s/status' % job_id)
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_save_csv_job(self):
+        """Test saving a CSV on the task queue and following its progress"""
+        client = self.upload_client()
+        self.fake_queue()
+        db.session.add_all([
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0),
+            GeocoderCache(address='2 Main St', latitude=3.0, longitude=4.0)
+        ])
+        csv_storage_id = self.stage_csv([('Shelter', '1 Main St', '9-5'),
+                                         ('Library', '2 Main St', '')])
+        response = client.post('/bulk-resource/save-csv',
+                               data={'submit': 'Save'})
+        self.assertEquals(response.status_code, 302)
+        job_id = CsvStorage.query.get(csv_storage_id).save_job_id
+        self.assertEquals(FakeJob.jobs.keys(), [job_id])
+        self.assertTrue(response.location.endswith(
+            '/bulk-resource/save-csv/' + job_id))
+        self.assertEquals(self.save_status(client, job_id), {
+            'status': 'queued', 'phase': None, 'rows_processed': 0,
+            'rows_total': 0})
+
+        # A save that is queued is followed rather than enqueued again
+        response = client.post('/bulk-resource/save-csv',
+                               data={'submit': 'Save'})
+        self.assertTrue(response.location.endswith(
+            '/bulk-resource/save-csv/' + job_id))
+        self.assertEquals(len(FakeJob.jobs), 1)
+
+        job = FakeJob.jobs[job_id]
+        job.perform()
+        self.assertEquals(
+            [(m['phase'], m['rows_processed'], m['rows_total'])
+             for m in job.saved_meta],
+            [('descriptors', 0, 0), ('geocoding', 0, 2), ('writing', 0, 2),
+             ('finishing', 2, 2), ('publishing', 0, 0), ('committing', 0, 0)])
+
+        # The progress page polls the status and, once the save is done,
+        # goes to the resources through a page telling what changed once
+        response = client.get('/bulk-resource/save-csv/' + job_id)
+        self.assertEquals(response.status_code, 200)
+        with self.app.test_request_context():
+            for url in (url_for('bulk_resource.save_csv_status',
+                                job_id=job_id),
+                        url_for('bulk_resource.save_csv_done',
+                                job_id=job_id)):
+                self.assertTrue(url in response.data)
+            index = url_for('single_resource.index')
+        counts = {'added': 2, 'modified': 0, 'unchanged': 0, 'removed': 0}
+        for _ in range(2):
+            self.assertEquals(self.save_status(client, job_id), {
+                'status': 'finished', 'phase': 'committing',
+                'rows_processed': 0, 'rows_total': 0, 'counts': counts})
+        for _ in range(2):
+            response = client.get('/bulk-resource/save-csv/%s/done' % job_id)
+            self.assertTrue(response.location.endswith(index))
+        with client.session_transaction() as session:
+            self.assertEquals(session['_flashes'], [(
+                'success', 'CSV saved: 2 resources added, 0 modified, '
+                '0 unchanged and 0 removed.')])
+        self.assertEquals(sorted(r.name for r in Resource.query),
+                          ['Library', 'Shelter'])
+        self.assertEquals(CsvStorage.query.count(), 0)
+
+        for url in ('/bulk-resource/save-csv/unknown',
+                    '/bulk-resource/save-csv/unknown/status',
+                    '/bulk-resource/save-csv/unknown/done'):
+            self.assertEquals(client.get(url).status_code, 404)
+
+    def test_save_csv_job_owner(self):
+        """Test that only the user saving a CSV can follow the save"""
+        client = self.upload_client()
+        self.fake_queue()
+        self.stage_csv([('Shelter', '1 Main St', '9-5')])
+        client.post('/bulk-resource/save-csv', data={'submit': 'Save'})
+        job_id = FakeJob.jobs.keys()[0]
+        self.assertEquals(self.save_status(client, job_id)['status'],
+                          'queued')
+
+        other = User(email='other@example.com', password='password',
+                     confirmed=True)
+        db.session.add(other)
+        db.session.commit()
+        with client.session_transaction() as session:
+            session['user_id'] = str(other.id)
+        for url in ('/bulk-resource/save-csv/' + job_id,
+                    '/bulk-resource/save-csv/%s/status' % job_id,
+                    '/bulk-resource/save-csv/%s/done' % job_id):
+            self.assertEquals(client.get(url).status_code, 404)
+
+    def test_save_csv_job_failed(self):
+        """Test that a failed save reports its error and is started again"""
+        client = self.upload_client()
+        self.fake_queue()
+        self.stage_csv([('Shelter', 'invalid', '9-5')])
+        client.post('/bulk-resource/save-csv', data={'submit': 'Save'})
+        job = FakeJob.jobs.values()[0]
+        job.perform()
+        status = self.save_status(client, job.id)
+        self.assertEquals(status['status'], 'failed')
+        self.assertEquals(status['error'],
+                          '1 addresses cannot be geocoded: invalid')
+        self.assertEquals(Resource.query.count(), 0)
+
+        response = client.post('/bulk-resource/save-csv',
+                               data={'submit': 'Save'})
+        self.assertEquals(len(FakeJob.jobs), 2)
+        self.assertTrue(response.location.endswith(
+            '/bulk-resource/save-csv/job-2'))
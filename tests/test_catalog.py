@@ -0,0 +1,109 @@
+import json
+import unittest
+
+from app import create_app, db
+from app.models import (CatalogCache, CatalogVersion, DescriptorRegistry,
+                        OptionIndex, Rating, Resource, TextAssociation)
+
+
+class CatalogVersionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_version_bumped_once_per_transaction(self):
+        """Test that catalog writes bump the version once per commit"""
+        self.assertEquals(CatalogVersion.current(), 0)
+        db.session.add(Resource(name='r1'))
+        db.session.flush()
+        db.session.add(Resource(name='r2'))
+        db.session.commit()
+        self.assertEquals(CatalogVersion.current(), 1)
+        r = Resource.query.filter_by(name='r1').first()
+        r.address = '1 Main St'
+        db.session.commit()
+        self.assertEquals(CatalogVersion.current(), 2)
+
+    def test_rating_keeps_version(self):
+        """Test that posting a rating keeps the catalog version and the
+        caches built from it"""
+        db.session.add(Resource(name='r1'))
+        db.session.commit()
+        registry = DescriptorRegistry.get()
+        option_index = OptionIndex.get()
+        r = Resource.query.one()
+        db.session.add(Rating(resource_id=r.id, rating=5))
+        db.session.commit()
+        self.assertEquals(CatalogVersion.current(), 1)
+        self.assertEquals(Resource.query.one().rating_count, 1)
+        self.assertTrue(DescriptorRegistry.get() is registry)
+        self.assertTrue(OptionIndex.get() is option_index)
+        resource_as_dict = list(Resource.iter_resources_as_full_dicts())[0]
+        self.assertFalse('rating_count' in resource_as_dict)
+
+    def test_version_bumped_at_commit(self):
+        """Test that the version row is only written when the transaction
+        commits"""
+        self.assertEquals(
+            db.session.query(CatalogVersion.version).filter_by(id=1).scalar(),
+            0)
+        db.session.add(Resource(name='r1'))
+        db.session.flush()
+        self.assertEquals(CatalogVersion.current(), 0)
+        db.session.commit()
+        self.assertEquals(CatalogVersion.current(), 1)
+
+    def test_version_row_seeded(self):
+        """Test bumping the version when the row is missing"""
+        CatalogVersion.query.delete()
+        db.session.commit()
+        db.session.add(Resource(name='r1'))
+        db.session.commit()
+        self.assertEquals(CatalogVersion.current(), 1)
+
+    def test_bulk_delete_bumps_version(self):
+        """Test that bulk deletes of catalog rows bump the version"""
+        db.session.add(Resource(name='r1'))
+        db.session.commit()
+        TextAssociation.query.delete()
+        db.session.commit()
+        self.assertEquals(CatalogVersion.current(), 2)
+
+    def test_rollback_keeps_version(self):
+        """Test that rolled back writes don't bump the version"""
+        db.session.add(Resource(name='r1'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEquals(CatalogVersion.current(), 0)
+
+    def test_get_resources_etag(self):
+        """Test conditional requests for the full catalog"""
+        db.session.add(Resource(name='r1'))
+        db.session.commit()
+        client = self.app.test_client()
+        response = client.get('/get-resources')
+        etag = response.headers['ETag']
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([r['name'] for r in json.loads(response.data)],
+                          ['r1'])
+
+        response = client.get(
+            '/get-resources', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.data, '')
+
+        db.session.add(Resource(name='r2'))
+        db.session.commit()
+        response = client.get(
+            '/get-resources', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('r2' in response.data)
+        self.assertNotEquals(response.headers['ETag'], etag)
@@ -0,0 +1,78 @@
+import unittest
+
+from app import create_app, db
+from app.models import CatalogCache, ColumnStats, CsvDescriptor, CsvStorage
+from app.models.column_stats import MAX_OPTION_VALUES, DistinctCounter
+
+
+class ColumnStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_distinct_counter(self):
+        """Test estimating the number of distinct values"""
+        counter = DistinctCounter()
+        for i in range(20000):
+            counter.add(u'value %d' % (i % 10000))
+        self.assertTrue(abs(counter.count() - 10000) < 1000)
+        small = DistinctCounter()
+        for value in ['a', 'b', 'c', 'a']:
+            small.add(value)
+        self.assertEquals(small.count(), 3)
+
+    def test_option_column(self):
+        """Test the statistics of a column of repeated options"""
+        stats = ColumnStats()
+        for value in ['English; Spanish', 'Spanish', '', 'English', 'Spanish',
+                      None]:
+            stats.add(value)
+        stats = ColumnStats(stats.to_dict())
+        self.assertEquals(stats.rows, 6)
+        self.assertEquals(stats.null_ratio(), 2 / 6.0)
+        self.assertEquals(stats.distinct_count(), 3)
+        self.assertEquals(stats.option_count(), 2)
+        self.assertEquals(stats.values(), set(['English', 'Spanish']))
+        self.assertEquals(stats.top(1), [('Spanish', 3)])
+        self.assertEquals(stats.suggested_type(), 'option')
+
+    def test_text_column(self):
+        """Test that columns with too many values are suggested as text"""
+        stats = ColumnStats()
+        for i in range(MAX_OPTION_VALUES * 3):
+            stats.add('Open %d days' % (i % (MAX_OPTION_VALUES * 2)))
+        self.assertEquals(stats.values(), None)
+        self.assertTrue(stats.option_count() > MAX_OPTION_VALUES)
+        self.assertEquals(len(stats.top()), 5)
+        self.assertEquals(stats.suggested_type(), 'text')
+
+    def test_append_rows(self):
+        """Test presetting descriptor types and values from staged rows"""
+        csv_storage = CsvStorage(action='reset',
+                                 header=['Name', 'Address', 'Hours', 'Type'])
+        hours = CsvDescriptor(csv_storage=csv_storage, name='Hours')
+        types = CsvDescriptor(csv_storage=csv_storage, name='Type')
+        db.session.add_all([csv_storage, hours, types])
+        for i in range(3):
+            csv_storage.append_rows([{
+                'Name': 'Resource %d' % (i * 2 + j),
+                'Address': '%d Main St' % (i * 2 + j),
+                'Hours': '%d-5' % (i * 2 + j),
+                'Type': ['Food;Housing', 'Food'][j]
+            } for j in range(2)])
+        db.session.commit()
+        self.assertEquals(hours.descriptor_type, 'text')
+        self.assertEquals(types.descriptor_type, 'option')
+        self.assertEquals(ColumnStats(types.stats).rows, 6)
+
+        csv_storage.set_desc_values()
+        self.assertEquals(types.values, set(['Food', 'Housing']))
+        self.assertEquals(hours.values, None)
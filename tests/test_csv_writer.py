@@ -0,0 +1,541 @@
+import unittest
+
+from app import create_app, db
+from app.bulk_resource import writer
+from app.bulk_resource.jobs import run_save_csv
+from app.bulk_resource.writer import (CsvSaveError, plan_csv_storage,
+                                      save_csv_storage)
+from app.geocoding import GeocodeResult, GeocodingService
+from app.models import (CatalogCache, CatalogGeneration, CsvDescriptor,
+                        CsvDescriptorRemove, CsvRowBlock, CsvStorage,
+                        Descriptor, GeocoderCache, OptionAssociation, Rating,
+                        RequiredOptionDescriptor,
+                        RequiredOptionDescriptorConstructor, Resource,
+                        ResourceAssociations, ResourceLocator, SearchIndex,
+                        TextAssociation, next_generation_ids,
+                        restore_previous_generation)
+
+
+def geocode_many(addresses):
+    return dict((a, GeocodeResult('OK', [5.0, 6.0])) for a in addresses)
+
+
+class CsvWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+        db.session.add_all([
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0),
+            GeocoderCache(address='2 Main St', latitude=3.0, longitude=4.0)
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def associations(self):
+        resources = Resource.query.order_by(Resource.id).all()
+        entries = ResourceAssociations.load([r.id for r in resources])
+        return [(r.name, r.address, r.latitude, entries[r.id])
+                for r in resources]
+
+    def test_reset(self):
+        """Test replacing the catalog with a CSV"""
+        db.session.add(Resource(name='Old'))
+        csv_storage = CsvStorage(action='reset')
+        csv_storage.append_rows([{
+            'Name': 'Shelter', 'Address': '1 Main St', 'Hours': '9-5',
+            'Languages': 'Spanish; English'
+        }, {
+            'Name': 'Library', 'Address': '3 Main St', 'Hours': '',
+            'Languages': 'Spanish;Klingon'
+        }])
+        db.session.add_all([
+            CsvDescriptor(csv_storage=csv_storage, name='Hours'),
+            CsvDescriptor(csv_storage=csv_storage, name='Languages',
+                          descriptor_type='option',
+                          values=set(['English', 'Spanish'])),
+            RequiredOptionDescriptorConstructor(
+                name='Type', values=['Food', 'Housing'],
+                missing_dict={'Library': ['Food', 'Housing']})
+        ])
+        db.session.commit()
+        plan = plan_csv_storage(csv_storage,
+                                GeocodingService(None, rate=1, workers=8))
+        self.assertEquals(plan['resources'], {
+            'added': 2, 'modified': 0, 'unchanged': 0, 'removed': 1})
+        self.assertEquals(plan['associations'], {
+            'inserted': 7, 'updated': 0, 'deleted': 0})
+        self.assertEquals(plan['geocoding'], {
+            'addresses': 2, 'cached': 1, 'to_geocode': 1, 'failed': 0,
+            'seconds': 1.0})
+        counts = save_csv_storage(csv_storage, geocode_many)
+        db.session.commit()
+
+        self.assertEquals(counts, {'added': 2, 'modified': 0, 'unchanged': 0,
+                                   'removed': 1})
+        self.assertEquals(self.associations(), [
+            ('Shelter', '1 Main St', 1.0, {
+                'Hours': '9-5', 'Languages': ['Spanish', 'English']}),
+            ('Library', '3 Main St', 5.0, {
+                'Hours': '', 'Languages': ['Spanish'],
+                'Type': ['Food', 'Housing']})
+        ])
+        required = RequiredOptionDescriptor.query.one()
+        self.assertEquals(Descriptor.query.get(required.descriptor_id).name,
+                          'Type')
+        self.assertEquals(CsvStorage.query.count(), 0)
+        self.assertEquals(CsvRowBlock.query.count(), 0)
+
+    def test_restore_previous_generation(self):
+        """Test switching back to the catalog replaced by a reset"""
+        hours = Descriptor(name='Hours')
+        old = Resource(name='Old', address='9 Main St')
+        old.text_descriptors.append(
+            TextAssociation(descriptor=hours, text='9-5'))
+        db.session.add(old)
+        db.session.commit()
+        csv_storage = CsvStorage(action='reset')
+        csv_storage.append_rows(
+            [{'Name': 'Shelter', 'Address': '1 Main St', 'Open': 'Mon'}])
+        db.session.add(CsvDescriptor(csv_storage=csv_storage, name='Open'))
+        db.session.commit()
+        save_csv_storage(csv_storage, geocode_many)
+        db.session.commit()
+        self.assertEquals(CatalogGeneration.current().generation, 1)
+        new_catalog = self.associations()
+        self.assertEquals(new_catalog, [
+            ('Shelter', '1 Main St', 1.0, {'Open': 'Mon'})])
+
+        # Ratings of the new catalog go back and forth with it
+        shelter = Resource.query.one()
+        db.session.add(Rating(resource_id=shelter.id, rating=4))
+        db.session.commit()
+        self.assertEquals(restore_previous_generation(db.session), 0)
+        db.session.commit()
+        self.assertEquals(self.associations(), [
+            ('Old', '9 Main St', None, {'Hours': '9-5'})])
+        self.assertEquals(Rating.query.count(), 0)
+        self.assertEquals(Resource.query.one().rating_count, 0)
+        self.assertEquals(restore_previous_generation(db.session), 1)
+        db.session.commit()
+        self.assertEquals(self.associations(), new_catalog)
+        self.assertEquals([(r.resource_id, r.rating) for r in Rating.query],
+                          [(shelter.id, 4)])
+        shelter = Resource.query.one()
+        self.assertEquals((shelter.rating_count, shelter.rating_sum), (1, 4))
+
+        # Ids of the restored rows are not reused
+        db.session.add(Resource(name='Clinic'))
+        db.session.commit()
+        self.assertEquals([r.name for r in Resource.query.order_by(
+            Resource.id)], ['Shelter', 'Clinic'])
+
+    def stage_reset(self, names):
+        csv_storage = CsvStorage(action='reset')
+        csv_storage.append_rows([{'Name': name, 'Address': '1 Main St',
+                                  'Hours': name + ' hours'}
+                                 for name in names])
+        db.session.add(CsvDescriptor(csv_storage=csv_storage, name='Hours'))
+        db.session.commit()
+        return csv_storage
+
+    def test_concurrent_resets(self):
+        """Test that resets saved at the same time build their catalogs
+        apart and publish them one after the other"""
+        interval = writer.CHECKPOINT_INTERVAL
+        writer.CHECKPOINT_INTERVAL = 1
+        try:
+            first = self.stage_reset(['Shelter', 'Clinic', 'Library'])
+            second = self.stage_reset(['Pantry'])
+
+            def checkpoint(phase, row_offset, counts=None):
+                first.set_checkpoint(phase, row_offset, counts)
+                db.session.commit()
+                if (phase, row_offset) == ('saving', 1):
+                    raise RuntimeError('Worker lost')
+
+            self.assertRaises(RuntimeError, save_csv_storage, first,
+                              geocode_many, None, checkpoint)
+            db.session.rollback()
+            self.assertEquals(next_generation_ids(db.session),
+                              set([first.id]))
+
+            # The second reset is saved while the first is half written
+            save_csv_storage(second, geocode_many)
+            db.session.commit()
+            self.assertEquals(self.associations(), [
+                ('Pantry', '1 Main St', 1.0, {'Hours': 'Pantry hours'})])
+
+            pantry_id = Resource.query.one().id
+            save_csv_storage(first, geocode_many, None, checkpoint)
+            db.session.commit()
+        finally:
+            writer.CHECKPOINT_INTERVAL = interval
+        self.assertEquals(
+            [(name, entries) for name, _, _, entries in self.associations()],
+            [(name, {'Hours': name + ' hours'})
+             for name in ('Shelter', 'Clinic', 'Library')])
+        self.assertEquals(CatalogGeneration.current().generation, 2)
+        self.assertEquals(next_generation_ids(db.session), set())
+        self.assertFalse(pantry_id in [r.id for r in Resource.query])
+        self.assertEquals(restore_previous_generation(db.session), 1)
+        db.session.commit()
+        self.assertEquals([(r.id, r.name) for r in Resource.query],
+                          [(pantry_id, 'Pantry')])
+
+    def test_reset_ids(self):
+        """Test that a reset numbers its rows after the ids of the catalogs
+        it replaces"""
+        db.session.add_all([Resource(name='Old'), Resource(name='Older')])
+        db.session.commit()
+        old_ids = [r.id for r in Resource.query.order_by(Resource.id)]
+        save_csv_storage(self.stage_reset(['Shelter', 'Clinic']),
+                         geocode_many)
+        db.session.commit()
+        new_ids = [r.id for r in Resource.query.order_by(Resource.id)]
+        self.assertEquals(new_ids, [old_ids[-1] + 1, old_ids[-1] + 2])
+        self.assertEquals([d.id for d in Descriptor.query], [1])
+
+        save_csv_storage(self.stage_reset(['Pantry']), geocode_many)
+        db.session.commit()
+        self.assertEquals([r.id for r in Resource.query],
+                          [new_ids[-1] + 1])
+        self.assertEquals([d.id for d in Descriptor.query], [2])
+        self.assertEquals([t.id for t in TextAssociation.query], [3])
+        self.assertEquals(restore_previous_generation(db.session), 1)
+        db.session.commit()
+        self.assertEquals([r.id for r in Resource.query.order_by(
+            Resource.id)], new_ids)
+
+    def test_publish_rolled_back(self):
+        """Test that a reset rolled back after it is published leaves the
+        live catalog as it was"""
+        db.session.add(Resource(name='Old'))
+        db.session.commit()
+        csv_storage = self.stage_reset(['Shelter'])
+        save_csv_storage(csv_storage, geocode_many)
+        self.assertEquals([r.name for r in Resource.query], ['Shelter'])
+        db.session.rollback()
+        self.assertEquals([r.name for r in Resource.query], ['Old'])
+        self.assertEquals(CatalogGeneration.current().generation, 0)
+        self.assertEquals(CsvStorage.query.count(), 1)
+        save_csv_storage(csv_storage, geocode_many)
+        db.session.commit()
+        self.assertEquals([r.name for r in Resource.query], ['Shelter'])
+
+    def test_update(self):
+        """Test updating existing resources from a CSV"""
+        hours = Descriptor(name='Hours', values=[])
+        languages = Descriptor(name='Languages', values=['English', 'Spanish'])
+        shelter = Resource(name='Shelter', address='1 Main St',
+                           latitude=1.0, longitude=2.0)
+        clinic = Resource(name='Clinic', address='2 Main St',
+                          latitude=3.0, longitude=4.0)
+        shelter.text_descriptors.append(
+            TextAssociation(descriptor=hours, text='9-5'))
+        shelter.option_descriptors.append(
+            OptionAssociation(descriptor=languages, option=0))
+        clinic.text_descriptors.append(
+            TextAssociation(descriptor=hours, text='10-6'))
+        clinic.option_descriptors.append(
+            OptionAssociation(descriptor=languages, option=1))
+        db.session.add_all([shelter, clinic])
+        db.session.commit()
+        hours_id = shelter.text_descriptors[0].id
+
+        csv_storage = CsvStorage(action='update')
+        csv_storage.append_rows([{
+            'Name': 'Shelter', 'Address': '2 Main St', 'Hours': '9-6',
+            'Languages': 'French'
+        }, {
+            'Name': 'Clinic', 'Address': '2 Main St', 'Hours': '10-6',
+            'Languages': 'Spanish'
+        }, {
+            'Name': 'Library', 'Address': '1 Main St', 'Hours': '',
+            'Languages': 'English'
+        }], [shelter.id, clinic.id, None])
+        db.session.add_all([
+            CsvDescriptor(csv_storage=csv_storage, name='Hours',
+                          descriptor_id=hours.id),
+            CsvDescriptor(csv_storage=csv_storage, name='Languages',
+                          descriptor_type='option', descriptor_id=languages.id,
+                          values=set(['English', 'French']))
+        ])
+        db.session.commit()
+        plan = plan_csv_storage(csv_storage)
+        self.assertEquals(plan['rows'], 3)
+        self.assertEquals(plan['associations'], {
+            'inserted': 3, 'updated': 1, 'deleted': 1})
+        self.assertEquals(plan['geocoding']['to_geocode'], 0)
+        # Nothing is written by the plan
+        self.assertEquals(Resource.query.count(), 2)
+        self.assertEquals(Descriptor.query.get(languages.id).values,
+                          ['English', 'Spanish'])
+        counts = save_csv_storage(csv_storage, geocode_many)
+        db.session.commit()
+        self.assertEquals(plan['resources'], counts)
+
+        # Resources without a content hash are always written
+        self.assertEquals(counts, {'added': 1, 'modified': 2, 'unchanged': 0,
+                                   'removed': 0})
+        self.assertEquals(Descriptor.query.get(languages.id).values,
+                          ['English', 'Spanish', 'French'])
+        self.assertEquals(self.associations(), [
+            ('Shelter', '2 Main St', 3.0, {
+                'Hours': '9-6', 'Languages': ['French']}),
+            ('Clinic', '2 Main St', 3.0, {
+                'Hours': '10-6', 'Languages': ['Spanish']}),
+            ('Library', '1 Main St', 1.0, {
+                'Hours': '', 'Languages': ['English']})
+        ])
+        # Changed text is updated in place
+        self.assertEquals(TextAssociation.query.get(hours_id).text, '9-6')
+        self.assertEquals(RequiredOptionDescriptor.query.one().descriptor_id,
+                          -1)
+
+    def stage(self, action, rows):
+        descriptors = dict((d.name, d.id) for d in Descriptor.query)
+        csv_storage = CsvStorage(action=action)
+        db.session.add_all([
+            csv_storage,
+            CsvDescriptor(csv_storage=csv_storage, name='Hours',
+                          descriptor_id=descriptors.get('Hours')),
+            CsvDescriptor(csv_storage=csv_storage, name='Languages',
+                          descriptor_type='option',
+                          descriptor_id=descriptors.get('Languages'),
+                          values=set(['English', 'Spanish']))
+        ])
+        resource_ids = dict(db.session.query(Resource.name, Resource.id))
+        csv_storage.append_rows(
+            [{'Name': name, 'Address': address, 'Hours': hours,
+              'Languages': languages}
+             for name, address, hours, languages in rows],
+            [resource_ids.get(row[0]) for row in rows])
+        db.session.commit()
+        counts = save_csv_storage(csv_storage, geocode_many)
+        db.session.commit()
+        return counts
+
+    def test_update_unchanged(self):
+        """Test that updates only write resources whose content changed"""
+        rows = [('Shelter', '1 Main St', '9-5', 'English'),
+                ('Clinic', '2 Main St', '10-6', 'English;Spanish')]
+        self.stage('reset', rows)
+        text_ids = [t.id for t in TextAssociation.query]
+
+        counts = self.stage('update', [
+            ('Shelter', '1 Main St', '9-5', 'English'),
+            ('Clinic', '2 Main St', '10-6', 'Spanish; English'),
+            ('Library', '3 Main St', '', 'Spanish')
+        ])
+        self.assertEquals(counts, {'added': 1, 'modified': 0, 'unchanged': 2,
+                                   'removed': 0})
+        self.assertEquals([t.id for t in TextAssociation.query][:2], text_ids)
+
+        # Editing a resource clears its hash, so the next import restores it
+        shelter = Resource.query.filter_by(name='Shelter').one()
+        shelter.text_descriptors[0].text = 'Closed'
+        db.session.commit()
+        self.assertEquals(
+            db.session.query(Resource.content_hash).filter_by(
+                id=shelter.id).scalar(), None)
+        counts = self.stage('update', rows)
+        self.assertEquals(counts, {'added': 0, 'modified': 1, 'unchanged': 1,
+                                   'removed': 0})
+        self.assertEquals(self.associations()[:2], [
+            ('Shelter', '1 Main St', 1.0, {
+                'Hours': '9-5', 'Languages': ['English']}),
+            ('Clinic', '2 Main St', 3.0, {
+                'Hours': '10-6', 'Languages': ['English', 'Spanish']})
+        ])
+
+    def test_update_indexes(self):
+        """Test that updates refresh catalog indexes for written resources
+        only"""
+        self.stage('reset', [('Shelter', '1 Main St', '9-5', 'English'),
+                             ('Clinic', '2 Main St', '10-6', 'Spanish')])
+        self.assertEquals(SearchIndex.search('closed'), [])
+        self.assertEquals(len(ResourceLocator.within(5.0, 6.0, 1)), 0)
+        rebuild = SearchIndex.__dict__['rebuild']
+        rebuilds = []
+        SearchIndex.rebuild = staticmethod(
+            lambda session=None: rebuilds.append(session))
+        try:
+            self.stage('update', [
+                ('Shelter', '1 Main St', 'Closed', 'English'),
+                ('Clinic', '2 Main St', '10-6', 'Spanish'),
+                ('Library', '9 Main St', 'Closed', 'Spanish')])
+        finally:
+            SearchIndex.rebuild = rebuild
+        self.assertEquals(rebuilds, [])
+        ids = dict(db.session.query(Resource.name, Resource.id))
+        self.assertEquals(SearchIndex.search('closed'),
+                          [ids['Shelter'], ids['Library']])
+        self.assertEquals([i for _, i in ResourceLocator.within(5.0, 6.0, 1)],
+                          [ids['Library']])
+        # Content hashes written by the import are kept
+        self.assertEquals(Resource.query.filter(
+            Resource.content_hash.is_(None)).count(), 0)
+
+    def test_update_removes_descriptor(self):
+        """Test that removing a descriptor in an update reindexes the
+        resources that had it only"""
+        self.stage('reset', [('Shelter', '1 Main St', 'Closed', 'English'),
+                             ('Clinic', '2 Main St', '10-6', 'Spanish')])
+        self.assertEquals(len(SearchIndex.search('closed')), 1)
+        descriptors = dict((d.name, d.id) for d in Descriptor.query)
+        csv_storage = CsvStorage(action='update')
+        db.session.add_all([
+            csv_storage,
+            CsvDescriptor(csv_storage=csv_storage, name='Languages',
+                          descriptor_type='option',
+                          descriptor_id=descriptors['Languages'],
+                          values=set(['English', 'Spanish'])),
+            CsvDescriptorRemove(csv_storage=csv_storage,
+                                descriptor_id=descriptors['Hours'])
+        ])
+        resource_ids = dict(db.session.query(Resource.name, Resource.id))
+        csv_storage.append_rows(
+            [{'Name': 'Shelter', 'Address': '1 Main St',
+              'Languages': 'English'}], [resource_ids['Shelter']])
+        db.session.commit()
+        rebuild = SearchIndex.__dict__['rebuild']
+        rebuilds = []
+        SearchIndex.rebuild = staticmethod(
+            lambda session=None: rebuilds.append(session))
+        try:
+            save_csv_storage(csv_storage, geocode_many)
+            db.session.commit()
+        finally:
+            SearchIndex.rebuild = rebuild
+        self.assertEquals(rebuilds, [])
+        self.assertEquals(SearchIndex.search('closed'), [])
+        self.assertEquals(Descriptor.query.get(descriptors['Hours']), None)
+        self.assertEquals(TextAssociation.query.count(), 0)
+
+    def test_addresses_not_geocoded(self):
+        """Test that a save fails listing the addresses it cannot geocode"""
+        csv_storage = CsvStorage(action='reset')
+        csv_storage.append_rows([
+            {'Name': 'Shelter', 'Address': '1 Main St'},
+            {'Name': 'Library', 'Address': 'Nowhere'},
+            {'Name': 'Clinic', 'Address': 'Atlantis'}
+        ])
+        db.session.add(csv_storage)
+        db.session.commit()
+        with self.assertRaises(CsvSaveError) as context:
+            save_csv_storage(csv_storage, lambda addresses: dict(
+                (a, GeocodeResult('ZERO_RESULTS', None)) for a in addresses))
+        self.assertEquals(str(context.exception),
+                          '2 addresses cannot be geocoded: Atlantis; Nowhere')
+
+    def test_run_save_csv(self):
+        """Test the save job reporting its progress and committing"""
+        csv_storage = CsvStorage(action='reset')
+        csv_storage.append_rows(
+            [{'Name': 'Shelter', 'Address': '1 Main St', 'Hours': '9-5'}])
+        db.session.add(CsvDescriptor(csv_storage=csv_storage, name='Hours'))
+        db.session.commit()
+        csv_storage_id = csv_storage.id
+        phases = []
+        counts = run_save_csv(
+            csv_storage_id,
+            lambda phase, done=0, total=0: phases.append((phase, done, total)))
+        self.assertEquals(counts, {'added': 1, 'modified': 0, 'unchanged': 0,
+                                   'removed': 0})
+        self.assertEquals(phases, [('descriptors', 0, 0), ('geocoding', 0, 1),
+                                   ('writing', 0, 1), ('finishing', 1, 1),
+                                   ('publishing', 0, 0),
+                                   ('committing', 0, 0)])
+        db.session.remove()
+        self.assertEquals([r.name for r in Resource.query], ['Shelter'])
+        self.assertRaises(CsvSaveError, run_save_csv, csv_storage_id)
+
+    def test_resume(self):
+        """Test resuming an interrupted save from its checkpoints"""
+        interval = writer.CHECKPOINT_INTERVAL
+        writer.CHECKPOINT_INTERVAL = 2
+        try:
+            for action in ('reset', 'update'):
+                db.session.add(Resource(name='Resource 0', address='0 St',
+                                        content_hash='stale'))
+                csv_storage = CsvStorage(action=action)
+                csv_storage.append_rows([{
+                    'Name': 'Resource %d' % i,
+                    'Address': '%d %s St' % (i, action),
+                    'Hours': '%d-5' % i
+                } for i in range(5)])
+                db.session.add(CsvDescriptor(csv_storage=csv_storage,
+                                             name='Hours'))
+                db.session.commit()
+                if action == 'update':
+                    csv_storage.link_resources()
+                    db.session.commit()
+                geocoded = []
+
+                def geocode(addresses):
+                    geocoded.extend(addresses)
+                    return geocode_many(addresses)
+
+                checkpoints = []
+                # Updates only checkpoint geocoding, as their rows are
+                # written to the live catalog in the final transaction
+                if action == 'reset':
+                    failure = ('saving', 2)
+                    geocoded_before = 5
+                    expected = [('saving', 0), ('geocoding', 2),
+                                ('geocoding', 4), ('geocoding', 5),
+                                ('saving', 2), ('saving', 4), ('saving', 5)]
+                else:
+                    failure = ('geocoding', 4)
+                    geocoded_before = 4
+                    expected = [('geocoding', 2), ('geocoding', 4),
+                                ('geocoding', 5)]
+
+                def checkpoint(phase, row_offset, counts=None):
+                    csv_storage.set_checkpoint(phase, row_offset, counts)
+                    db.session.commit()
+                    checkpoints.append((phase, row_offset))
+                    if (phase, row_offset) == failure:
+                        raise RuntimeError('Worker lost')
+
+                self.assertRaises(RuntimeError, save_csv_storage,
+                                  csv_storage, geocode, None, checkpoint)
+                db.session.rollback()
+                self.assertEquals(sorted(geocoded),
+                                  ['%d %s St' % (i, action)
+                                   for i in range(geocoded_before)])
+                # Nothing of the import is live before it is saved
+                self.assertEquals(
+                    [name for name, _, _, _ in self.associations()],
+                    ['Resource 0'])
+                counts = save_csv_storage(csv_storage, geocode, None,
+                                          checkpoint)
+                db.session.commit()
+                self.assertEquals(len(geocoded), 5)
+                self.assertEquals(checkpoints, expected)
+                if action == 'reset':
+                    self.assertEquals(counts['added'], 5)
+                    self.assertEquals(counts['removed'], 1)
+                else:
+                    self.assertEquals(counts['added'], 4)
+                    self.assertEquals(counts['modified'], 1)
+                self.assertEquals(
+                    [(name, entries) for name, _, _, entries in
+                     self.associations()],
+                    [('Resource %d' % i, {'Hours': '%d-5' % i})
+                     for i in range(5)])
+                self.assertEquals(CsvStorage.query.count(), 0)
+                Resource.query.delete()
+                TextAssociation.query.delete()
+                Descriptor.query.delete()
+                RequiredOptionDescriptor.query.delete()
+                db.session.commit()
+        finally:
+            writer.CHECKPOINT_INTERVAL = interval
@@ -0,0 +1,50 @@
+import unittest
+
+from app import create_app, db
+from app.models import (CatalogCache, Descriptor, DescriptorRegistry,
+                        RequiredOptionDescriptor)
+
+
+class DescriptorRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lookups(self):
+        """Test looking up descriptors and option values"""
+        city = Descriptor(name='city', values=['Seattle', 'Boston', 'Seattle'])
+        description = Descriptor(name='description', values=[])
+        db.session.add_all([city, description])
+        db.session.commit()
+        db.session.add(RequiredOptionDescriptor(descriptor_id=city.id))
+        db.session.commit()
+        registry = DescriptorRegistry.get()
+        self.assertEquals(registry.get_by_name('city').id, city.id)
+        self.assertEquals(registry.get_by_id(city.id).index_of('Seattle'), 0)
+        self.assertEquals(registry.get_by_id(city.id).index_of('Boston'), 1)
+        self.assertEquals(registry.get_by_id(city.id).index_of('Paris'), None)
+        self.assertTrue(registry.get_by_name('description').is_text_descriptor)
+        self.assertEquals(registry.required_option_descriptor.name, 'city')
+        self.assertEquals(registry.get_by_name('missing'), None)
+
+    def test_uncommitted_writes_not_cached(self):
+        """Test that a registry built from uncommitted writes isn't kept"""
+        db.session.add(Descriptor(name='city', values=['Seattle']))
+        db.session.flush()
+        self.assertNotEquals(DescriptorRegistry.get().get_by_name('city'),
+                             None)
+        db.session.rollback()
+        # Reaches the same catalog version as the rolled back transaction
+        db.session.add(Descriptor(name='state', values=['Washington']))
+        db.session.commit()
+        registry = DescriptorRegistry.get()
+        self.assertEquals(registry.get_by_name('city'), None)
+        self.assertNotEquals(registry.get_by_name('state'), None)
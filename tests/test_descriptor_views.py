@@ -0,0 +1,81 @@
+import unittest
+
+from app import create_app, db
+from app.models import (CatalogCache, Descriptor, OptionAssociation,
+                        RequiredOptionDescriptor,
+                        RequiredOptionDescriptorConstructor, Resource, Role,
+                        User)
+
+
+class DescriptorViewsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+        Role.insert_roles()
+        user = User(email='user@example.com', password='password',
+                    confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_review_without_required_descriptor(self):
+        """Test reviewing the required option descriptor when none is being
+        chosen"""
+        for method in (self.client.get, self.client.post):
+            response = method('/descriptor/review-required-option-descriptor')
+            self.assertEquals(response.status_code, 302)
+            self.assertTrue(response.location.endswith('/descriptor/'))
+        db.session.add(RequiredOptionDescriptorConstructor(
+            name='Deleted', values=['Yes']))
+        db.session.commit()
+        response = self.client.post(
+            '/descriptor/review-required-option-descriptor')
+        self.assertEquals(response.status_code, 302)
+        with self.client.session_transaction() as session:
+            self.assertEquals(
+                session['_flashes'][-1],
+                ('error', 'There is no required option descriptor to '
+                 'review.'))
+
+    def test_review_missing_resources(self):
+        """Test setting the options of resources missing the required
+        option descriptor"""
+        languages = Descriptor(name='Languages',
+                               values=['English', 'Spanish', 'French'])
+        shelter = Resource(name='Shelter')
+        clinic = Resource(name='Clinic')
+        clinic.option_descriptors.append(
+            OptionAssociation(descriptor=languages, option=0))
+        db.session.add_all([
+            languages, shelter, clinic,
+            RequiredOptionDescriptorConstructor(
+                name='Languages', values=languages.values)
+        ])
+        db.session.commit()
+        response = self.client.get(
+            '/descriptor/review-required-option-descriptor')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(
+            RequiredOptionDescriptorConstructor.query.one().missing_names,
+            ['Shelter'])
+
+        response = self.client.post(
+            '/descriptor/review-required-option-descriptor',
+            data={'resources-0': ['French', 'Spanish']})
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(sorted(
+            a.option for a in OptionAssociation.query.filter_by(
+                resource_id=shelter.id)), [1, 2])
+        self.assertEquals(RequiredOptionDescriptor.query.one().descriptor_id,
+                          languages.id)
@@ -0,0 +1,217 @@
+import logging
+import unittest
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from app import create_app, db
+from app.geocoding import GeocodeResult
+from app.models import CatalogCache, GeocoderCache
+from app.models.geocoder_cache import AddressLRU, normalize_address
+from app.utils import IN_CHUNK_SIZE
+
+
+class GeocoderCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_queries(self, f):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            result = f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return len(statements), result
+
+    def test_normalize_address(self):
+        """Test that address variants have the same key"""
+        self.assertEquals(normalize_address('  1 Main  St ,Seattle, WA. '),
+                          '1 main st, seattle, wa')
+        self.assertEquals(normalize_address('1 MAIN ST, SEATTLE, WA'),
+                          '1 main st, seattle, wa')
+
+    def test_unique_address_key(self):
+        """Test that an address is only cached once"""
+        db.session.add_all([GeocoderCache(address='1 Main St'),
+                            GeocoderCache(address='1 main st ')])
+        self.assertRaises(IntegrityError, db.session.commit)
+
+    def test_concurrent_store(self):
+        """Test storing an address another batch stored after it was
+        looked up"""
+        rows_by_key = GeocoderCache.__dict__['_rows_by_key']
+        calls = []
+
+        def racing_rows_by_key(keys):
+            if not calls:
+                calls.append(keys)
+                db.session.add(GeocoderCache(address='1 main st',
+                                             latitude=1.0, longitude=2.0))
+                db.session.flush()
+                return {}
+            return rows_by_key.__func__(keys)
+
+        GeocoderCache._rows_by_key = staticmethod(racing_rows_by_key)
+        try:
+            GeocoderCache.store_many({
+                '1 Main St': GeocodeResult('OK', [3.0, 4.0]),
+                '2 Main St': GeocodeResult('OK', [5.0, 6.0])
+            })
+            db.session.commit()
+        finally:
+            GeocoderCache._rows_by_key = rows_by_key
+        self.assertEquals(GeocoderCache.query.count(), 2)
+        cached = GeocoderCache.lookup_many(['1 Main St', '2 Main St'])
+        self.assertEquals(cached['1 Main St'][:3], ('OK', 1.0, 2.0))
+        self.assertEquals(cached['2 Main St'][:3], ('OK', 5.0, 6.0))
+
+    def test_backfill_address_keys(self):
+        """Test setting the keys of rows cached before there were keys"""
+        table = GeocoderCache.__table__
+        db.session.execute(table.insert(), [
+            {'address': '1 Main St', 'latitude': 1.0,
+             'date_updated': datetime(2015, 1, 1)},
+            {'address': '1 MAIN ST ', 'latitude': 2.0,
+             'date_updated': datetime(2016, 1, 1)},
+            {'address': '2 Main St', 'latitude': 3.0,
+             'date_updated': datetime(2016, 1, 1)}
+        ])
+        db.session.commit()
+        self.assertEquals(GeocoderCache.backfill_address_keys(), 1)
+        db.session.commit()
+        self.assertEquals(
+            sorted((c.address_key, c.latitude) for c in GeocoderCache.query),
+            [('1 main st', 2.0), ('2 main st', 3.0)])
+        self.assertEquals(GeocoderCache.backfill_address_keys(), 0)
+
+    def test_lookup_variants(self):
+        """Test looking up variants of a cached address"""
+        db.session.add(
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0))
+        db.session.commit()
+        stats = GeocoderCache.stats()
+        cached = GeocoderCache.lookup_many(['1 MAIN ST', '1 main st.', 'x'])
+        self.assertEquals(sorted(cached), ['1 MAIN ST', '1 main st.'])
+        self.assertEquals(cached['1 MAIN ST'][:3], ('OK', 1.0, 2.0))
+        self.assertEquals(GeocoderCache.stats()['hits'], stats['hits'] + 2)
+        self.assertEquals(GeocoderCache.stats()['misses'],
+                          stats['misses'] + 1)
+
+    def test_resolve_logs_stats(self):
+        """Test that resolving addresses logs how many were cached"""
+        db.session.add(
+            GeocoderCache(address='1 Main St', latitude=1.0, longitude=2.0))
+        db.session.commit()
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = self.app.logger
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            GeocoderCache.resolve_many(
+                ['1 Main St', '2 Main St', '2 MAIN ST'],
+                lambda addresses: dict(
+                    (a, GeocodeResult('OK', [3.0, 4.0])) for a in addresses))
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        stats = GeocoderCache.stats()
+        self.assertEquals(
+            [r.getMessage() for r in records],
+            ['Geocoder cache: 1 of 3 addresses cached, 1 to geocode '
+             '(%d hits and %d misses since start)' % (stats['hits'],
+                                                      stats['misses'])])
+
+    def test_bulk_lookup(self):
+        """Test looking up many addresses with chunked queries"""
+        count = IN_CHUNK_SIZE * 2 + 1
+        db.session.bulk_insert_mappings(GeocoderCache, [{
+            'address': '%d Main St' % i,
+            'address_key': '%d main st' % i,
+            'status': 'OK',
+            'latitude': float(i),
+            'longitude': 0.0
+        } for i in range(count)])
+        db.session.commit()
+        addresses = ['%d Main St' % i for i in range(count + 1)]
+        queries, cached = self.count_queries(
+            lambda: GeocoderCache.lookup_many(addresses))
+        self.assertEquals(queries, 3)
+        self.assertEquals(len(cached), count)
+        self.assertEquals(cached['7 Main St'].latitude, 7.0)
+
+        calls = []
+
+        def geocode_many(addresses):
+            calls.extend(addresses)
+            return dict((a, GeocodeResult('OK', [1.0, 2.0]))
+                        for a in addresses)
+
+        queries, resolved = self.count_queries(
+            lambda: GeocoderCache.resolve_many(addresses, geocode_many))
+        self.assertEquals(calls, ['%d Main St' % count])
+        self.assertEquals(len(resolved), count + 1)
+        # The missing address is looked up again, checked for before it is
+        # stored, and read back after
+        self.assertEquals(queries, 4)
+
+    def test_negative_caching(self):
+        """Test that failures are cached until they expire"""
+        calls = []
+
+        def geocode_many(addresses):
+            calls.extend(addresses)
+            return dict((a, GeocodeResult('ZERO_RESULTS', None))
+                        for a in addresses)
+
+        resolved = GeocoderCache.resolve_many(['Nowhere', 'nowhere '],
+                                              geocode_many)
+        db.session.commit()
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(resolved['Nowhere'].status, 'ZERO_RESULTS')
+        GeocoderCache.resolve_many(['NOWHERE'], geocode_many)
+        self.assertEquals(len(calls), 1)
+
+        self.app.config['GEOCODER_NEGATIVE_TTL'] = 0
+        GeocoderCache.resolve_many(['NOWHERE'], geocode_many)
+        db.session.commit()
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(GeocoderCache.query.count(), 1)
+
+    def test_transient_failures_not_cached(self):
+        """Test that running out of quota is not cached"""
+        GeocoderCache.resolve_many(
+            ['1 Main St'],
+            lambda addresses: dict((a, GeocodeResult('OVER_QUERY_LIMIT',
+                                                     None))
+                                   for a in addresses))
+        db.session.commit()
+        self.assertEquals(GeocoderCache.query.count(), 0)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entries are dropped"""
+        lru = AddressLRU(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        self.assertEquals(lru.get('b'), None)
+        self.assertEquals(lru.get('a'), 1)
+        self.assertEquals(lru.get('c'), 3)
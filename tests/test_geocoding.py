@@ -0,0 +1,87 @@
+import time
+import unittest
+
+from app.geocoding import (GeocodeResult, GeocodingService, KeyPool,
+                           StubBackend, TokenBucket)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class GeocodingTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        """Test that the token bucket allows bursts then limits the rate"""
+        clock = FakeClock()
+        bucket = TokenBucket(2, capacity=3, clock=clock)
+        self.assertEquals([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEquals(bucket.take(), 0.5)
+        clock.sleep(0.5)
+        self.assertEquals(bucket.take(), 0)
+        clock.sleep(100)
+        self.assertEquals([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertTrue(bucket.take() > 0)
+
+    def test_key_pool(self):
+        """Test rotation over keys and leaving out exhausted keys"""
+        clock = FakeClock()
+        pool = KeyPool(['a', 'b'], 1, cooldown=60, clock=clock,
+                       sleep=clock.sleep)
+        self.assertEquals([pool.acquire().key for _ in range(4)],
+                          ['a', 'b', 'a', 'b'])
+        # Waited for a token from one of the keys
+        self.assertEquals(clock.now, 1)
+        pool.exhaust(pool.keys[0])
+        self.assertEquals([pool.acquire().key for _ in range(2)], ['b', 'b'])
+        pool.exhaust(pool.keys[1])
+        self.assertEquals(pool.acquire(), None)
+        clock.sleep(60)
+        self.assertEquals(pool.acquire().key, 'a')
+
+    def test_quota_rotation(self):
+        """Test that an address is retried with the next key"""
+        calls = []
+
+        def backend(address, key):
+            calls.append(key)
+            if key == 'a':
+                return GeocodeResult('OVER_QUERY_LIMIT', None)
+            return GeocodeResult('OK', [1.0, 2.0])
+
+        service = GeocodingService(backend, keys=['a', 'b'], rate=100)
+        self.assertEquals(service.geocode('1 Main St').latlng, [1.0, 2.0])
+        self.assertEquals(service.geocode('2 Main St').latlng, [1.0, 2.0])
+        self.assertEquals(calls, ['a', 'b', 'b'])
+
+        service = GeocodingService(backend, keys=['a'], rate=100)
+        self.assertEquals(
+            service.geocode('1 Main St').status, 'OVER_QUERY_LIMIT')
+
+    def test_geocode_many(self):
+        """Test that addresses are geocoded in parallel"""
+        service = GeocodingService(
+            StubBackend(latency=0.05), keys=['a'], rate=1000, workers=10)
+        addresses = ['%d Main St' % i for i in range(20)] + ['invalid']
+        start = time.time()
+        results = service.geocode_many(addresses + addresses)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(sorted(results), sorted(addresses))
+        self.assertEquals(results['1 Main St'],
+                          StubBackend()('1 Main St', None))
+        self.assertEquals(results['invalid'].status, 'ZERO_RESULTS')
+
+    def test_estimate_seconds(self):
+        """Test estimating the time taken to geocode addresses"""
+        service = GeocodingService(None, keys=['a', 'b'], rate=10, workers=2)
+        self.assertEquals(service.estimate_seconds(0), 0.0)
+        # Limited by the latency of requests over two threads
+        self.assertEquals(service.estimate_seconds(100), 10.0)
+        # Limited by the keys' rate of 20 requests per second
+        self.assertEquals(service.estimate_seconds(100, latency=0.01), 5.0)
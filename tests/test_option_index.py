@@ -0,0 +1,70 @@
+import unittest
+
+from app import create_app, db
+from app.models import (CatalogCache, Descriptor, OptionAssociation,
+                        OptionIndex, Resource)
+
+
+class OptionIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_resource(self, name, descriptor, options):
+        r = Resource(name=name)
+        for option in options:
+            r.option_descriptors.append(
+                OptionAssociation(descriptor=descriptor, option=option))
+        db.session.add(r)
+        db.session.commit()
+        return r
+
+    def test_filters(self):
+        """Test union and intersection of option filters"""
+        d = Descriptor(name='Open', values=['Mon', 'Tue', 'Wed'])
+        r1 = self.add_resource('r1', d, [0, 1])
+        r2 = self.add_resource('r2', d, [1])
+        r3 = self.add_resource('r3', d, [2])
+        index = OptionIndex.get()
+        self.assertEquals(index.resources_with_any(d.id, [0]), set([r1.id]))
+        self.assertEquals(
+            index.resources_with_any(d.id, [1, 2]),
+            set([r1.id, r2.id, r3.id]))
+        self.assertEquals(
+            OptionIndex.resources_with_all([
+                index.resources_with_any(d.id, [0, 1]),
+                index.resources_with_any(d.id, [1, 2])
+            ]), set([r1.id, r2.id]))
+        self.assertEquals(OptionIndex.resources_with_all([]), None)
+
+    def test_invalidated_on_commit(self):
+        """Test that the index is rebuilt after associations change"""
+        d = Descriptor(name='Open', values=['Mon', 'Tue'])
+        r1 = self.add_resource('r1', d, [0])
+        self.assertEquals(OptionIndex.get().resources_with_option(d.id, 0),
+                          set([r1.id]))
+        r2 = self.add_resource('r2', d, [0])
+        self.assertEquals(OptionIndex.get().resources_with_option(d.id, 0),
+                          set([r1.id, r2.id]))
+        OptionAssociation.query.filter_by(resource_id=r1.id).delete()
+        db.session.commit()
+        self.assertEquals(OptionIndex.get().resources_with_option(d.id, 0),
+                          set([r2.id]))
+
+    def test_not_invalidated_on_rollback(self):
+        """Test that a rolled back write keeps the current index"""
+        d = Descriptor(name='Open', values=['Mon', 'Tue'])
+        self.add_resource('r1', d, [0])
+        index = OptionIndex.get()
+        db.session.add(Resource(name='r2'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertTrue(OptionIndex.get() is index)
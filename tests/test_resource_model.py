@@ -1,7 +1,11 @@
+import json
 import unittest
 
+from sqlalchemy import event
+
 from app import create_app, db
-from app.models import Resource, Descriptor, OptionAssociation
+from app.models import (CatalogCache, Descriptor, OptionAssociation, Rating,
+                        Resource, ResourceBase, TextAssociation)
 
 
 class ResourceModelTestCase(unittest.TestCase):
@@ -10,6 +14,7 @@ class ResourceModelTestCase(unittest.TestCase):
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
+        CatalogCache.clear_all()
 
     def tearDown(self):
         db.session.remove()
@@ -28,3 +33,152 @@ class ResourceModelTestCase(unittest.TestCase):
         self.assertEquals(option_assoc.option, 0)
         self.assertEquals(option_assoc.descriptor.name, 'Open')
         self.assertEquals(option_assoc.descriptor.values, options)
+
+    def test_rating_aggregates(self):
+        """Test that rating aggregates follow rating inserts and deletes"""
+        r = Resource(name='test')
+        db.session.add(r)
+        db.session.commit()
+        self.assertEquals(r.get_avg_ratings(), 0.0)
+        db.session.add_all([
+            Rating(resource_id=r.id, rating=5),
+            Rating(resource_id=r.id, rating=2)
+        ])
+        db.session.commit()
+        self.assertEquals(r.rating_count, 2)
+        self.assertEquals(r.get_avg_ratings(), '3.5')
+        db.session.delete(Rating.query.filter_by(rating=2).first())
+        db.session.commit()
+        self.assertEquals(r.get_avg_ratings(), '5.0')
+
+    def test_rebuild_rating_aggregates(self):
+        """Test recomputing rating aggregates from the ratings table"""
+        r1 = Resource(name='r1')
+        r2 = Resource(name='r2')
+        db.session.add_all([r1, r2])
+        db.session.commit()
+        db.session.execute(Rating.__table__.insert(), [
+            {'resource_id': r1.id, 'rating': 4},
+            {'resource_id': r1.id, 'rating': 3},
+        ])
+        db.session.commit()
+        self.assertEquals(r1.rating_count, 0)
+        Resource.rebuild_rating_aggregates()
+        self.assertEquals((r1.rating_count, r1.rating_sum), (2, 7))
+        self.assertEquals((r2.rating_count, r2.rating_sum), (0, 0))
+
+    def add_resources(self, count):
+        """Insert count resources, each with one text and two option
+        associations, using bulk inserts."""
+        text = Descriptor(name='Description', values=[])
+        option = Descriptor(name='Open', values=['True', 'False'])
+        db.session.add_all([text, option])
+        db.session.commit()
+        db.session.execute(ResourceBase.__table__.insert(), [{
+            'id': i + 1,
+            'name': 'resource %d' % i,
+            'type': 'resource'
+        } for i in range(count)])
+        db.session.execute(TextAssociation.__table__.insert(), [{
+            'resource_id': i + 1,
+            'descriptor_id': text.id,
+            'text': 'text %d' % i
+        } for i in range(count)])
+        db.session.execute(OptionAssociation.__table__.insert(), [{
+            'resource_id': i + 1,
+            'descriptor_id': option.id,
+            'option': o
+        } for i in range(count) for o in (0, 1)])
+        db.session.commit()
+        db.session.expunge_all()
+
+    def count_queries(self, serialize):
+        """Return the number of queries made and the dicts produced by
+        serialize."""
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            dicts = serialize()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return len(statements), dicts
+
+    def count_full_dicts_queries(self):
+        """Return the number of queries made and the dicts produced when
+        serializing every resource."""
+        return self.count_queries(lambda: Resource.get_resources_as_full_dicts(
+            Resource.with_associations(Resource.query).all()))
+
+    def count_catalog_queries(self):
+        """Return, for each way of serializing the whole catalog, the number
+        of queries made and the dicts produced."""
+        client = self.app.test_client()
+        return [
+            self.count_full_dicts_queries(),
+            self.count_queries(lambda: list(
+                Resource.iter_resources_as_full_dicts(chunk_size=100))),
+            self.count_queries(lambda: json.loads(
+                client.get('/get-resources').data)),
+        ]
+
+    def test_full_dicts(self):
+        """Test serializing resources with their associations"""
+        self.add_resources(2)
+        _, dicts = self.count_full_dicts_queries()
+        dicts.sort(key=lambda d: d['id'])
+        self.assertEquals(len(dicts), 2)
+        self.assertEquals(dicts[0]['name'], 'resource 0')
+        self.assertEquals(dicts[0]['description'], 'text 0')
+        self.assertEquals(sorted(dicts[1]['open']), ['False', 'True'])
+        self.assertFalse('_sa_instance_state' in dicts[0])
+        self.assertFalse('text_descriptors' in dicts[0])
+
+    def test_full_dicts_query_count(self):
+        """Test that serializing resources, eagerly, streamed or through
+        /get-resources, uses a constant number of queries"""
+        self.add_resources(10)
+        small = self.count_catalog_queries()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        CatalogCache.clear_all()
+        self.add_resources(10000)
+        large = self.count_catalog_queries()
+        for (small_count, small_dicts), (large_count, large_dicts) in zip(
+                small, large):
+            self.assertEquals(len(small_dicts), 10)
+            self.assertEquals(len(large_dicts), 10000)
+            self.assertEquals(small_count, large_count)
+
+    def test_iter_full_dicts(self):
+        """Test that streamed dicts match the eagerly loaded ones"""
+        self.add_resources(7)
+        _, dicts = self.count_full_dicts_queries()
+        dicts.sort(key=lambda d: d['id'])
+        for d in dicts:
+            d['open'].sort()
+        db.session.remove()
+        streamed = list(Resource.iter_resources_as_full_dicts(chunk_size=3))
+        for d in streamed:
+            d['open'].sort()
+        self.assertEquals(streamed, dicts)
+
+    def test_resources_in_city(self):
+        """Test finding the resources associated with a city"""
+        city = Descriptor(name='city', values=['Seattle', 'Philadelphia'])
+        for name, option in [('r1', 0), ('r2', 1), ('r3', 0)]:
+            r = Resource(name=name)
+            r.option_descriptors.append(
+                OptionAssociation(descriptor=city, option=option))
+            db.session.add(r)
+        db.session.commit()
+        names = sorted(r.name for r in Resource.get_resources_in_city(
+            'Seattle'))
+        self.assertEquals(names, ['r1', 'r3'])
+        self.assertEquals(Resource.get_resources_in_city('Boston'), [])
+        self.assertEquals(Resource.get_list_of_cities(),
+                          ['Seattle', 'Philadelphia'])
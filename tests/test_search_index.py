@@ -0,0 +1,127 @@
+import json
+import unittest
+
+from app import create_app, db
+from app.models import (CatalogCache, Descriptor, Resource, SearchIndex,
+                        TextAssociation)
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_resource(self, name, descriptor=None, text=None):
+        r = Resource(name=name)
+        if descriptor is not None:
+            r.text_descriptors.append(
+                TextAssociation(descriptor=descriptor, text=text))
+        db.session.add(r)
+        db.session.commit()
+        return r
+
+    def test_search_names_and_searchable_text(self):
+        """Test ranked search over names and searchable descriptors"""
+        searchable = Descriptor(name='Description', values=[],
+                                is_searchable=True)
+        hidden = Descriptor(name='Notes', values=[], is_searchable=False)
+        r1 = self.add_resource('Downtown Food Bank')
+        r2 = self.add_resource('Shelter', searchable, 'Hot food every day')
+        self.add_resource('Clinic', hidden, 'Food vouchers')
+        self.assertEquals(SearchIndex.search('food'), [r1.id, r2.id])
+        self.assertEquals(SearchIndex.search('FOO'), [r1.id, r2.id])
+        self.assertEquals(SearchIndex.search('food bank'), [r1.id])
+        self.assertEquals(SearchIndex.search('vouchers'), [])
+        self.assertEquals(SearchIndex.search(' "*'), None)
+
+    def test_follows_writes(self):
+        """Test that the index is updated by every kind of write"""
+        d = Descriptor(name='Description', values=[], is_searchable=True)
+        r = self.add_resource('Shelter', d, 'Beds')
+        r.name = 'Library'
+        db.session.commit()
+        self.assertEquals(SearchIndex.search('shelter'), [])
+        self.assertEquals(SearchIndex.search('library'), [r.id])
+
+        r.text_descriptors[0].text = 'Computers'
+        db.session.commit()
+        self.assertEquals(SearchIndex.search('beds'), [])
+        self.assertEquals(SearchIndex.search('computers'), [r.id])
+
+        d.is_searchable = False
+        db.session.commit()
+        self.assertEquals(SearchIndex.search('computers'), [])
+
+        TextAssociation.query.delete()
+        Resource.query.filter_by(id=r.id).update({'name': 'Pantry'})
+        db.session.commit()
+        self.assertEquals(SearchIndex.search('pantry'), [r.id])
+
+        db.session.delete(Resource.query.get(r.id))
+        db.session.commit()
+        self.assertEquals(SearchIndex.search('pantry'), [])
+
+    def test_descriptor_edits(self):
+        """Test that descriptor edits reindex the resources with text for
+        the descriptor only when it is made searchable or not"""
+        d = Descriptor(name='Description', values=[], is_searchable=False)
+        other = Descriptor(name='Notes', values=[], is_searchable=True)
+        r = self.add_resource('Shelter', d, 'Beds')
+        clinic = self.add_resource('Clinic', other, 'Vouchers')
+        rebuild = SearchIndex.__dict__['rebuild']
+        refresh = SearchIndex.__dict__['refresh']
+        refreshed = []
+
+        def record_refresh(session, ids):
+            refreshed.append(set(ids))
+            refresh.__func__(session, ids)
+
+        SearchIndex.rebuild = staticmethod(
+            lambda session=None: self.fail('index rebuilt'))
+        SearchIndex.refresh = staticmethod(record_refresh)
+        try:
+            d.name = 'Summary'
+            db.session.commit()
+            self.assertEquals(refreshed, [])
+
+            d.is_searchable = True
+            db.session.commit()
+            self.assertEquals(refreshed, [set([r.id])])
+            self.assertEquals(SearchIndex.search('beds'), [r.id])
+
+            db.session.delete(d)
+            db.session.commit()
+            self.assertEquals(refreshed[-1], set([r.id]))
+            self.assertEquals(SearchIndex.search('beds'), [])
+        finally:
+            SearchIndex.rebuild = rebuild
+            SearchIndex.refresh = refresh
+        self.assertEquals(SearchIndex.search('vouchers'), [clinic.id])
+
+    def test_rollback_keeps_index(self):
+        """Test that rolled back writes are not indexed"""
+        r = self.add_resource('Shelter')
+        r.name = 'Library'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEquals(SearchIndex.search('library'), [])
+        self.assertEquals(SearchIndex.search('shelter'), [r.id])
+
+    def test_search_resources_view(self):
+        """Test that /search-resources returns ranked matches"""
+        d = Descriptor(name='Description', values=[], is_searchable=True)
+        self.add_resource('Shelter', d, 'Meals and beds')
+        self.add_resource('Meals on Wheels')
+        client = self.app.test_client()
+        response = client.get('/search-resources?name=meals')
+        self.assertEquals(response.status_code, 200)
+        names = [r['name'] for r in json.loads(response.data)]
+        self.assertEquals(names, ['Meals on Wheels', 'Shelter'])
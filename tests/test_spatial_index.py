@@ -0,0 +1,98 @@
+import json
+import random
+import unittest
+
+from app import create_app, db
+from app.models import CatalogCache, Resource, ResourceLocator, SpatialIndex
+from app.models.spatial_index import haversine_km
+
+
+class SpatialIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        CatalogCache.clear_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_matches_linear_scan(self):
+        """Test nearest and radius queries against a linear scan"""
+        rand = random.Random(0)
+        points = [(i, 47.6 + rand.uniform(-0.5, 0.5),
+                   -122.3 + rand.uniform(-0.5, 0.5)) for i in range(2000)]
+        index = SpatialIndex()
+        for resource_id, lat, lng in points:
+            index.insert(resource_id, lat, lng)
+        for lat, lng in [(47.6, -122.3), (47.9, -122.0), (48.5, -121.0)]:
+            scan = sorted((haversine_km(lat, lng, plat, plng), i)
+                          for i, plat, plng in points)
+            self.assertEquals(
+                [i for d, i in index.nearest(lat, lng, 10)],
+                [i for d, i in scan[:10]])
+            self.assertEquals(
+                [i for d, i in index.within(lat, lng, 5)],
+                [i for d, i in scan if d <= 5])
+            even = [i for d, i in scan if i % 2 == 0]
+            self.assertEquals([
+                i for d, i in index.nearest(
+                    lat, lng, 5, accept=lambda i: i % 2 == 0)
+            ], even[:5])
+
+    def test_locator_follows_writes(self):
+        """Test that the resource locator is updated on commit"""
+        r1 = Resource(name='r1', latitude=47.6, longitude=-122.3)
+        r2 = Resource(name='r2', latitude=47.7, longitude=-122.3)
+        db.session.add_all([r1, r2])
+        db.session.commit()
+        nearest = ResourceLocator.nearest(47.6, -122.3, 1)
+        self.assertEquals(nearest[0][1], r1.id)
+
+        r2.latitude = 47.6001
+        r1.latitude = 40.0
+        db.session.commit()
+        nearest = ResourceLocator.nearest(47.6, -122.3, 1)
+        self.assertEquals(nearest[0][1], r2.id)
+
+        db.session.delete(r2)
+        db.session.commit()
+        nearest = ResourceLocator.nearest(47.6, -122.3, 1)
+        self.assertEquals(nearest[0][1], r1.id)
+
+        Resource.query.delete()
+        db.session.commit()
+        self.assertEquals(ResourceLocator.nearest(47.6, -122.3, 1), [])
+
+    def test_resources_near(self):
+        """Test finding the resources nearest to a point"""
+        db.session.add_all([
+            Resource(name='Near', latitude=47.61, longitude=-122.3),
+            Resource(name='Far', latitude=48.6, longitude=-122.3),
+            Resource(name='Nowhere')
+        ])
+        db.session.commit()
+        client = self.app.test_client()
+        response = client.get('/resources/near?lat=47.6&long=-122.3')
+        self.assertEquals(response.status_code, 200)
+        resources = json.loads(response.data)
+        self.assertEquals([r['name'] for r in resources], ['Near', 'Far'])
+        self.assertEquals(resources[0]['distance'], 1.112)
+        response = client.get(
+            '/resources/near?lat=47.6&long=-122.3&radius=10')
+        self.assertEquals([r['name'] for r in json.loads(response.data)],
+                          ['Near'])
+
+    def test_resources_near_invalid(self):
+        """Test that points and radii out of range are rejected"""
+        client = self.app.test_client()
+        for query in ['', 'lat=47.6', 'long=-122.3', 'lat=a&long=-122.3',
+                      'lat=nan&long=-122.3', 'lat=47.6&long=inf',
+                      'lat=91&long=0', 'lat=0&long=-180.5',
+                      'lat=0&long=0&radius=-1', 'lat=0&long=0&radius=nan']:
+            response = client.get('/resources/near?' + query)
+            self.assertEquals(response.status_code, 400, query)
+            self.assertEquals(json.loads(response.data)['status'], 'error')